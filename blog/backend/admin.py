@@ -21,7 +21,7 @@ class AnswerInline(admin.TabularInline):
 @admin.register(Question)
 class QuestionAdmin(admin.ModelAdmin):
     list_display = ('title', 'author', 'created', 'rating')
-    readonly_fields = ('created', 'rating', 'count_answers')
+    readonly_fields = ('created', 'rating', 'count_answers', 'hot_score')
     list_filter = ('tags', 'author')
 
     inlines = [AnswerInline]
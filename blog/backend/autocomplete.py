@@ -0,0 +1,200 @@
+import heapq
+import logging
+import threading
+import time
+from bisect import bisect_left
+from functools import partial
+
+from django.apps import apps
+from django.db import connection, transaction
+
+logger = logging.getLogger(__name__)
+
+AUTOCOMPLETE_LIMIT = 10
+# другие процессы узнают о новых тегах при перестроении раз в столько секунд
+AUTOCOMPLETE_TIMEOUT = 300
+# верхняя граница для bisect: после всех строк с префиксом
+MAX_CHAR = '\U0010ffff'
+
+
+class Entry:
+    __slots__ = ('key', 'name', 'id', 'rating')
+
+    def __init__(self, name, object_id, rating):
+        self.key = (name.lower(), name)
+        self.name = name
+        self.id = object_id
+        self.rating = rating
+
+    def rank(self):
+        return -self.rating, self.name
+
+
+class PrefixIndex:
+    """
+    Имена объектов в отсортированном массиве этого процесса: поиск по префиксу без учета регистра -
+    два bisect и выбор лучших по рейтингу, без запросов к базе. Новые объекты и дельты рейтинга
+    добавляются на месте после коммита; раз в timeout индекс перестраивается в фоновом потоке,
+    отвечая старым. Строит всегда один поток: первый запрос строит синхронно, остальные ждут его
+    """
+    def __init__(self, name, model_label, field='name', timeout=AUTOCOMPLETE_TIMEOUT):
+        self.name = name
+        self.model_label = model_label
+        self.field = field
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.build_lock = threading.Lock()
+        self.keys = []
+        self.entries = []
+        self.by_id = {}
+        self.built_at = None
+        # id объектов, измененных во время перестроения: их строки перечитываются перед подменой
+        self.pending = None
+        self.rebuilds = 0
+        self.last_rebuild_seconds = 0.0
+
+    def queryset(self):
+        model = apps.get_model(self.model_label)
+        return model.objects.order_by().values_list(self.field, 'id', 'rating')
+
+    def rebuild(self):
+        """
+        Строит индекс заново; вызывается под build_lock
+        """
+        started = time.perf_counter()
+        with self.lock:
+            self.pending = set()
+        try:
+            entries = {row[1]: Entry(*row) for row in self.queryset().iterator()}
+            while True:
+                ordered = sorted(entries.values(), key=lambda entry: entry.key)
+                with self.lock:
+                    changed, self.pending = self.pending, set()
+                    if not changed:
+                        self.entries = ordered
+                        self.keys = [entry.key for entry in ordered]
+                        self.by_id = {entry.id: entry for entry in ordered}
+                        self.built_at = time.monotonic()
+                        break
+                # изменения, пришедшие во время чтения таблицы, могли в него не попасть
+                for object_id in changed:
+                    entries.pop(object_id, None)
+                entries.update((row[1], Entry(*row)) for row in self.queryset().filter(id__in=changed))
+        finally:
+            with self.lock:
+                self.pending = None
+        self.rebuilds += 1
+        self.last_rebuild_seconds = time.perf_counter() - started
+        logger.debug('Prefix index %s rebuilt in %.2f ms', self.name, self.last_rebuild_seconds * 1000)
+
+    def refresh_in_background(self):
+        if not self.build_lock.acquire(blocking=False):
+            return
+
+        def run():
+            try:
+                self.rebuild()
+            except Exception:
+                logger.exception('Prefix index %s rebuild failed', self.name)
+            finally:
+                self.build_lock.release()
+                connection.close()
+
+        threading.Thread(target=run, name=f'prefix-index-{self.name}', daemon=True).start()
+
+    def ensure_fresh(self):
+        if self.built_at is None:
+            with self.build_lock:
+                if self.built_at is None:
+                    self.rebuild()
+        elif time.monotonic() - self.built_at > self.timeout:
+            self.refresh_in_background()
+
+    def search(self, prefix, limit=AUTOCOMPLETE_LIMIT):
+        self.ensure_fresh()
+        prefix = prefix.lower()
+        with self.lock:
+            lo = bisect_left(self.keys, (prefix,))
+            hi = bisect_left(self.keys, (prefix + MAX_CHAR,), lo)
+            matches = self.entries[lo:hi]
+            if len(matches) > limit:
+                matches = heapq.nsmallest(limit, matches, key=Entry.rank)
+            else:
+                matches.sort(key=Entry.rank)
+            return [(entry.name, entry.id, entry.rating) for entry in matches]
+
+    def add(self, objects):
+        """
+        Новые объекты, после коммита; до первого построения ничего не делает - они попадут в индекс при нем
+        """
+        rows = [(getattr(obj, self.field), obj.id, obj.rating) for obj in objects]
+        transaction.on_commit(partial(self.apply_add, rows))
+
+    def remove(self, object_id):
+        transaction.on_commit(partial(self.apply_remove, object_id))
+
+    def changed(self, object_id, delta):
+        transaction.on_commit(partial(self.apply_changed, object_id, delta))
+
+    def track(self, object_ids):
+        """
+        Вызывается под lock: идущее перестроение перечитает эти объекты
+        """
+        if self.pending is not None:
+            self.pending.update(object_ids)
+
+    def apply_add(self, rows):
+        with self.lock:
+            self.track(object_id for _, object_id, _ in rows)
+            if self.built_at is None:
+                return
+            for row in rows:
+                entry = Entry(*row)
+                if entry.id in self.by_id:
+                    continue
+                position = bisect_left(self.keys, entry.key)
+                self.keys.insert(position, entry.key)
+                self.entries.insert(position, entry)
+                self.by_id[entry.id] = entry
+
+    def apply_remove(self, object_id):
+        with self.lock:
+            self.track([object_id])
+            entry = self.by_id.pop(object_id, None)
+            if entry is not None:
+                position = bisect_left(self.keys, entry.key)
+                del self.keys[position]
+                del self.entries[position]
+
+    def apply_changed(self, object_id, delta):
+        with self.lock:
+            self.track([object_id])
+            entry = self.by_id.get(object_id)
+            if entry is not None:
+                entry.rating += delta
+
+    def invalidate(self):
+        """
+        Перестроить при следующем поиске: в фоне, пока отвечает текущий индекс
+        """
+        with self.lock:
+            if self.built_at is not None:
+                self.built_at = float('-inf')
+
+    def clear(self):
+        """
+        Забыть индекс целиком (тесты): следующий поиск построит его заново
+        """
+        with self.lock:
+            self.keys, self.entries, self.by_id = [], [], {}
+            self.built_at = None
+
+    def stats(self):
+        return {
+            'size': len(self.entries),
+            'rebuilds': self.rebuilds,
+            'last_rebuild_seconds': self.last_rebuild_seconds,
+        }
+
+
+tags = PrefixIndex('tags', 'backend.Tag')
@@ -0,0 +1,162 @@
+import hashlib
+import time
+from functools import partial
+
+from django.core.cache import cache
+from django.db import transaction
+
+OBJECT_CACHE_TIMEOUT = 300
+PAGE_CACHE_TIMEOUT = 600
+PAGE_LOCK_TIMEOUT = 10
+PAGE_WAIT_SECONDS = 0.05
+# дольше чужой сборки не ждем - строим страницу сами, не кладя ее в кеш
+PAGE_WAIT_LIMIT = 0.3
+
+
+def plain(data):
+    """
+    Данные сериализатора без ссылок на модели: Hyperlink при сохранении в кеш
+    тащит за собой объект и вызывает у него __str__ (лишний запрос на отложенные поля)
+    """
+    if isinstance(data, dict):
+        return {key: plain(value) for key, value in data.items()}
+    if isinstance(data, list):
+        return [plain(value) for value in data]
+    if isinstance(data, str):
+        return str(data)
+    return data
+
+
+class ObjectCache:
+    """
+    Сериализованные объекты по (модель, id, версия). Версия объекта лежит в кеше
+    и увеличивается хуками моделей, старые представления просто истекают
+    """
+    def __init__(self, timeout=OBJECT_CACHE_TIMEOUT):
+        self.timeout = timeout
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def version_key(model, pk):
+        return f'objver:{model._meta.label_lower}:{pk}'
+
+    def get_version(self, model, pk):
+        key = self.version_key(model, pk)
+        version = cache.get(key)
+        if version is None:
+            # после вытеснения начинаем с метки времени, чтобы не совпасть со старыми версиями
+            cache.add(key, int(time.time() * 1000), None)
+            version = cache.get(key)
+        return version
+
+    def invalidate(self, model, pk):
+        """
+        Увеличивает версию после коммита: иначе запрос между увеличением и коммитом
+        прочитает старую строку и положит ее в кеш под новой версией
+        """
+        transaction.on_commit(partial(self.bump_version, model, pk))
+
+    def bump_version(self, model, pk):
+        try:
+            cache.incr(self.version_key(model, pk))
+        except ValueError:  # версии нет - нечего инвалидировать
+            pass
+
+    def key(self, model, pk, variant):
+        return f'obj:{model._meta.label_lower}:{pk}:{self.get_version(model, pk)}:{variant}'
+
+    def get(self, key):
+        data = cache.get(key)
+        if data is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return data
+
+    def set(self, key, data):
+        cache.set(key, data, self.timeout)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0,
+        }
+
+
+class PageCache:
+    """
+    Страницы списков по (адрес с параметрами, поколения коллекций). Запись в коллекцию
+    увеличивает ее поколение; устаревшую страницу перестраивает один запрос,
+    остальные в это время получают старую (stale-while-revalidate)
+    """
+    def __init__(self, timeout=PAGE_CACHE_TIMEOUT):
+        self.timeout = timeout
+
+    @staticmethod
+    def collection(model):
+        return model._meta.model_name + 's'
+
+    @staticmethod
+    def generation_key(collection):
+        return f'pagegen:{collection}'
+
+    def generations(self, collections):
+        keys = [self.generation_key(collection) for collection in collections]
+        found = cache.get_many(keys)
+        for key in keys:
+            if key not in found:
+                cache.add(key, int(time.time() * 1000), None)
+                found[key] = cache.get(key)
+        return tuple(found[key] for key in keys)
+
+    def bump(self, *models):
+        """
+        Увеличивает поколения после коммита, как и ObjectCache.invalidate
+        """
+        transaction.on_commit(partial(self.bump_generations, models))
+
+    def bump_generations(self, models):
+        for model in models:
+            try:
+                cache.incr(self.generation_key(self.collection(model)))
+            except ValueError:  # поколения еще нет - страниц тоже
+                pass
+
+    @staticmethod
+    def key(url):
+        return 'page:' + hashlib.md5(url.encode('utf-8')).hexdigest()
+
+    def get_or_build(self, key, collections, build):
+        """
+        Возвращает (данные, HIT | STALE | MISS)
+        """
+        generation = self.generations(collections)
+        entry = cache.get(key)
+        if entry is not None and entry['generation'] == generation:
+            return entry['data'], 'HIT'
+
+        lock = key + ':lock'
+        deadline = time.monotonic() + PAGE_WAIT_LIMIT
+        locked = cache.add(lock, 1, PAGE_LOCK_TIMEOUT)
+        while not locked:
+            if entry is not None:
+                return entry['data'], 'HIT' if entry['generation'] == generation else 'STALE'
+            if time.monotonic() >= deadline:
+                return build(), 'MISS'
+            # страницу уже строит другой запрос - ждем его результат
+            time.sleep(PAGE_WAIT_SECONDS)
+            entry = cache.get(key)
+            locked = entry is None and cache.add(lock, 1, PAGE_LOCK_TIMEOUT)
+        try:
+            data = build()
+            cache.set(key, {'data': data, 'generation': generation}, self.timeout)
+        finally:
+            cache.delete(lock)
+        return data, 'MISS'
+
+
+object_cache = ObjectCache()
+page_cache = PageCache()
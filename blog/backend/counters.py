@@ -0,0 +1,56 @@
+"""
+Денормализованные счетчики и то, как их посчитать заново одним UPDATE по таблице
+"""
+from django.contrib.contenttypes.models import ContentType
+from django.db.models import Count, F, IntegerField, OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
+
+from backend.models import Question, Answer, Tag, User, Like
+
+
+def aggregate_of(model, field, aggregate, **filters):
+    """
+    aggregate по строкам model, у которых field ссылается на текущий объект; 0, если строк нет
+    """
+    rows = model.objects.filter(**{field: OuterRef('pk')}, **filters).order_by().values(field)
+    subquery = Subquery(rows.annotate(total=aggregate).values('total'), output_field=IntegerField())
+    return Coalesce(subquery, Value(0))
+
+
+def count_of(model, field, **filters):
+    return aggregate_of(model, field, Count('pk'), **filters)
+
+
+def likes_of(model):
+    return count_of(Like, 'object_id', content_type=ContentType.objects.get_for_model(model))
+
+
+def author_rating():
+    # лайк объекта поднимает и рейтинг автора
+    return aggregate_of(Question, 'author', Sum('rating')) + aggregate_of(Answer, 'author', Sum('rating'))
+
+
+# (модель, поле, выражение); рейтинг пользователя - после рейтингов вопросов и ответов
+COUNTERS = (
+    (Question, 'count_answers', lambda: count_of(Answer, 'question')),
+    (Question, 'rating', lambda: likes_of(Question)),
+    (Answer, 'rating', lambda: likes_of(Answer)),
+    (Tag, 'rating', lambda: count_of(Question.tags.through, 'tag')),
+    (User, 'rating', author_rating),
+)
+
+
+def recompute(model, field, expression, queryset=None):
+    """
+    Пересчитывает счетчик одним UPDATE, возвращает число строк
+    """
+    queryset = model.objects.all() if queryset is None else queryset
+    return queryset.update(**{field: expression()})
+
+
+def drifted(model, field, expression, ids):
+    """
+    (id, в базе, по данным) для строк ids, у которых счетчик разошелся с данными; один запрос
+    """
+    return list(model.objects.filter(pk__in=ids).annotate(expected=expression()).exclude(
+        **{field: F('expected')}).order_by('pk').values_list('pk', field, 'expected'))
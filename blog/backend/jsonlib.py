@@ -0,0 +1,69 @@
+"""
+Быстрая библиотека JSON, если установлена (orjson, ujson), иначе - стандартный json.
+Порядок перебора - settings.JSON_BACKENDS.
+Вывод совпадает с JSONRenderer DRF, кроме float в экспоненциальной записи:
+orjson пишет 1e20 и 1e-7, ujson - 1e-7, DRF - 1e+20 и 1e-07. NaN и Infinity ujson
+не кодирует (как DRF), а orjson пишет null
+"""
+import json
+
+from django.conf import settings
+from rest_framework.utils.encoders import JSONEncoder
+
+BACKENDS = ('orjson', 'ujson')
+# как JSONRenderer DRF: U+2028/U+2029 экранируем, чтобы ответ был подмножеством JavaScript
+LINE_SEPARATORS = ((b'\xe2\x80\xa8', b'\\u2028'), (b'\xe2\x80\xa9', b'\\u2029'))
+
+
+def load_orjson():
+    import orjson
+
+    default = JSONEncoder().default
+    # даты - через кодировщик DRF (формат с Z вместо +00:00)
+    option = orjson.OPT_PASSTHROUGH_DATETIME
+    return lambda data: orjson.dumps(data, default=default, option=option), orjson.loads
+
+
+def load_ujson():
+    import ujson
+
+    def dumps(data):
+        return ujson.dumps(data, ensure_ascii=False, escape_forward_slashes=False, allow_nan=False).encode('utf-8')
+
+    return dumps, ujson.loads
+
+
+def load_json():
+    def dumps(data):
+        return json.dumps(data, cls=JSONEncoder, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+    return dumps, json.loads
+
+
+LOADERS = {
+    'orjson': load_orjson,
+    'ujson': load_ujson,
+    'json': load_json,
+}
+
+
+def load_backend(names):
+    """
+    (имя, dumps -> bytes, loads) первой установленной библиотеки из names
+    """
+    for name in tuple(names) + ('json',):
+        try:
+            dumps, loads = LOADERS[name]()
+        except ImportError:
+            continue
+        return name, dumps, loads
+
+
+def escape_separators(content):
+    for raw, escaped in LINE_SEPARATORS:
+        if raw in content:
+            content = content.replace(raw, escaped)
+    return content
+
+
+name, dumps, loads = load_backend(getattr(settings, 'JSON_BACKENDS', BACKENDS))
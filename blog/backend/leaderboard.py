@@ -0,0 +1,149 @@
+import logging
+import time
+
+from django.apps import apps
+from django.core.cache import cache
+from django.db import transaction
+
+logger = logging.getLogger(__name__)
+
+LEADERBOARD_SIZE = 100
+LEADERBOARD_TIMEOUT = 300
+LEADERBOARD_LOCK_TIMEOUT = 5
+LEADERBOARD_LOCK_WAIT = 0.1
+LEADERBOARD_WAIT_SECONDS = 0.005
+
+
+class Leaderboard:
+    """
+    Топ-K объектов по рейтингу в кеше: отдается без запросов к базе,
+    поддерживается дельтами рейтинга и перестраивается одним индексным запросом.
+    В кеше лежат только поля fields, под ключом с поколением: сброс - incr поколения,
+    поэтому запись перестроения, начатого до сброса, уходит в ключ, который уже никто не читает
+    """
+    def __init__(self, name, model_label, fields, size=LEADERBOARD_SIZE, timeout=LEADERBOARD_TIMEOUT):
+        self.name = name
+        self.model_label = model_label
+        self.fields = ('id',) + tuple(fields) + ('rating',)
+        self.size = size
+        self.timeout = timeout
+        self.generation_key = f'leaderboard:{name}:generation'
+        self.lock_key = f'leaderboard:{name}:lock'
+        self.rebuilds = 0
+        self.rebuild_seconds = 0.0
+        self.last_rebuild_seconds = 0.0
+
+    @property
+    def model(self):
+        return apps.get_model(self.model_label)
+
+    def queryset(self):
+        return self.model.objects.order_by('-rating', '-id')
+
+    def generation(self):
+        generation = cache.get(self.generation_key)
+        if generation is None:
+            cache.add(self.generation_key, int(time.time() * 1000), None)
+            generation = cache.get(self.generation_key)
+        return generation
+
+    def key(self, generation):
+        return f'leaderboard:{self.name}:{generation}'
+
+    def top(self, limit):
+        """
+        Экземпляры модели только с полями fields (остальные отложены)
+        """
+        generation = self.generation()
+        rows = cache.get(self.key(generation))
+        if rows is None:
+            rows = self.rebuild(generation)
+        model = self.model
+        # from_db ждет значения в порядке полей модели
+        names = [field.attname for field in model._meta.concrete_fields if field.attname in self.fields]
+        return [model.from_db(model.objects.db, names, [row[name] for name in names]) for row in rows[:limit]]
+
+    def rebuild(self, generation):
+        started = time.perf_counter()
+        rows = list(self.queryset().values(*self.fields)[:self.size])
+        cache.set(self.key(generation), rows, self.timeout)
+        elapsed = time.perf_counter() - started
+        self.rebuilds += 1
+        self.rebuild_seconds += elapsed
+        self.last_rebuild_seconds = elapsed
+        logger.debug('Leaderboard %s rebuilt in %.2f ms', self.name, elapsed * 1000)
+        return rows
+
+    def invalidate(self):
+        try:
+            cache.incr(self.generation_key)
+        except ValueError:  # поколения нет - нет и топа
+            pass
+
+    def changed(self, object_id, delta):
+        """
+        Рейтинг объекта изменился на delta; применяется после коммита, чтобы откат не попал в топ
+        """
+        if delta:
+            transaction.on_commit(lambda: self.apply(object_id, delta))
+
+    def apply(self, object_id, delta):
+        """
+        Обновления топа идут по одному под блокировкой в кеше; не дождались ее - топ сбрасывается
+        """
+        deadline = time.monotonic() + LEADERBOARD_LOCK_WAIT
+        locked = cache.add(self.lock_key, 1, LEADERBOARD_LOCK_TIMEOUT)
+        while not locked and time.monotonic() < deadline:
+            time.sleep(LEADERBOARD_WAIT_SECONDS)
+            locked = cache.add(self.lock_key, 1, LEADERBOARD_LOCK_TIMEOUT)
+        if not locked:
+            self.invalidate()
+            return
+        try:
+            key = self.key(self.generation())
+            rows = cache.get(key)
+            if rows is None:
+                # топ может строиться прямо сейчас по данным без этой дельты
+                self.invalidate()
+            elif self.update(rows, object_id, delta):
+                cache.set(key, rows, self.timeout)
+            else:
+                self.invalidate()
+        finally:
+            cache.delete(self.lock_key)
+
+    def update(self, rows, object_id, delta):
+        """
+        Применяет дельту к строкам топа; False - топ надо перестроить
+        """
+        row = next((row for row in rows if row['id'] == object_id), None)
+        if row is None:
+            if delta < 0:
+                # упавший вне топа ничего не меняет
+                return True
+            if len(rows) < self.size:
+                return False
+            # вырос объект вне топа - входит в него, только если обогнал последнего
+            rating = self.model.objects.filter(id=object_id).values_list('rating', flat=True).first()
+            last = rows[-1]
+            return rating is None or (rating, object_id) < (last['rating'], last['id'])
+        row['rating'] += delta
+        rows.sort(key=lambda row: (-row['rating'], -row['id']))
+        # упал на последнее место - его может обогнать кто-то вне топа
+        return not (delta < 0 and rows[-1] is row and len(rows) == self.size)
+
+    def stats(self):
+        return {
+            'rebuilds': self.rebuilds,
+            'rebuild_seconds': self.rebuild_seconds,
+            'last_rebuild_seconds': self.last_rebuild_seconds,
+        }
+
+
+users = Leaderboard('users', 'backend.User', ('username',))
+tags = Leaderboard('tags', 'backend.Tag', ('name',))
+
+LEADERBOARDS = {
+    'users': users,
+    'tags': tags,
+}
@@ -0,0 +1,79 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+
+from backend.models import Question, Tag, User, Answer, Like
+
+
+class Rollback(Exception):
+    pass
+
+
+def access_paths():
+    """
+    Сортировки и фильтры, которые отдает API
+    """
+    question = Question.objects.order_by('id').first()
+    question_id = question.id if question else 0
+    return [
+        ('questions: -created', Question.objects.all()[:10]),
+        ('questions: -rating', Question.objects.hot_questions('rating')[:10]),
+        ('questions: -count_answers', Question.objects.hot_questions('count_answers')[:10]),
+        ('questions: -hot_score', Question.objects.hot_questions('hot')[:10]),
+        ('answers: -rating, created', Answer.objects.all()[:10]),
+        ('question answers', Answer.objects.filter(question_id=question_id)[:10]),
+        ('top users', User.objects.top_users('rating', 10)),
+        ('top tags', Tag.objects.top_tags('rating', 10)),
+        ('like lookup', Like.objects.filter(content_type_id=1, object_id=question_id, user_id=1)),
+    ]
+
+
+class Command(BaseCommand):
+    help = 'Планы запросов и время основных выборок без индексов и с индексами'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--repeat', type=int, default=20, help='Сколько раз выполнять каждый запрос')
+
+    def handle(self, *args, **options):
+        self.repeat = options['repeat']
+        before = self.measure(drop_indexes=True)
+        after = self.measure(drop_indexes=False)
+        for (name, plan_before, time_before), (_, plan_after, time_after) in zip(before, after):
+            self.stdout.write(self.style.MIGRATE_HEADING(name))
+            self.stdout.write(f'  без индексов: {time_before * 1000:.2f} мс')
+            self.stdout.write(self.indent(plan_before))
+            self.stdout.write(f'  с индексами: {time_after * 1000:.2f} мс')
+            self.stdout.write(self.indent(plan_after))
+
+    def measure(self, drop_indexes):
+        results = []
+        try:
+            with transaction.atomic():
+                if drop_indexes:
+                    self.drop_indexes()
+                for name, queryset in access_paths():
+                    plan = queryset.explain()
+                    started = time.perf_counter()
+                    for _ in range(self.repeat):
+                        list(queryset.all())
+                    results.append((name, plan, (time.perf_counter() - started) / self.repeat))
+                if drop_indexes:
+                    raise Rollback
+        except Rollback:
+            pass
+        return results
+
+    def drop_indexes(self):
+        """
+        Удаляет индексы из Meta.indexes внутри транзакции, которая потом откатывается
+        """
+        schema_editor = connection.schema_editor()
+        with connection.cursor() as cursor:
+            for model in (Question, Answer, Tag, User):
+                for index in model._meta.indexes:
+                    cursor.execute(str(index.remove_sql(model, schema_editor)))
+
+    @staticmethod
+    def indent(text):
+        return '\n'.join('    ' + line for line in text.splitlines())
@@ -0,0 +1,72 @@
+import io
+import random
+import time
+from collections import OrderedDict
+
+from django.core.management.base import BaseCommand
+from faker import Faker
+from rest_framework.parsers import JSONParser
+from rest_framework.renderers import JSONRenderer
+
+from backend import jsonlib
+
+
+def question_page(faker, items):
+    """
+    Ответ списка вопросов в форме QuestionSerializer, без базы
+    """
+    results = []
+    for i in range(items):
+        text = faker.text()
+        results.append(OrderedDict([
+            ('url', f'http://testserver/questions/{i}/'),
+            ('title', faker.sentence()),
+            ('long_text', text),
+            ('author', faker.user_name()),
+            ('rating', random.randint(-10, 500)),
+            ('answers', f'http://testserver/questions/{i}/answers/'),
+            ('tags', [faker.word() for _ in range(random.randint(0, 5))]),
+            ('short_text', text[:100]),
+            ('count_answers', random.randint(0, 50)),
+        ]))
+    return OrderedDict([('count', items), ('count_exact', False), ('next', None), ('previous', None),
+                        ('results', results)])
+
+
+class Command(BaseCommand):
+    help = 'Сравнивает JSONRenderer/JSONParser DRF с библиотеками из backend.jsonlib на сгенерированных данных'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--items', type=int, default=1000, help='Объектов в ответе')
+        parser.add_argument('--repeat', type=int, default=20, help='Сколько раз повторять замер')
+
+    def handle(self, *args, **options):
+        self.repeat = options['repeat']
+        payload = question_page(Faker(), options['items'])
+        expected = JSONRenderer().render(payload)
+        self.stdout.write(f'Ответ: {len(expected) / 1024:.0f} КБ, объектов: {options["items"]}')
+
+        base_render = self.measure(lambda: JSONRenderer().render(payload))
+        base_parse = self.measure(lambda: JSONParser().parse(io.BytesIO(expected)))
+        self.stdout.write(f'{"drf":8} рендер {base_render * 1000:8.2f} мс  разбор {base_parse * 1000:8.2f} мс')
+
+        for name in jsonlib.LOADERS:
+            loaded, dumps, loads = jsonlib.load_backend([name])
+            if loaded != name:
+                self.stdout.write(f'{name:8} не установлен')
+                continue
+            render = self.measure(lambda: jsonlib.escape_separators(dumps(payload)))
+            parse = self.measure(lambda: loads(expected))
+            same = jsonlib.escape_separators(dumps(payload)) == expected
+            self.stdout.write(
+                f'{name:8} рендер {render * 1000:8.2f} мс (x{base_render / render:.1f})  '
+                f'разбор {parse * 1000:8.2f} мс (x{base_parse / parse:.1f})  '
+                f'{"вывод совпадает" if same else "вывод отличается"}'
+            )
+
+    def measure(self, func):
+        func()
+        started = time.perf_counter()
+        for _ in range(self.repeat):
+            func()
+        return (time.perf_counter() - started) / self.repeat
@@ -0,0 +1,58 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from rest_framework.renderers import JSONRenderer
+from rest_framework.request import Request
+from rest_framework.test import APIRequestFactory
+
+from backend.models import Question, Answer, Tag
+from backend.plans import plan_for_serializer
+from backend.readers import QuestionReadSerializer, AnswerReadSerializer, TagReadSerializer
+from backend.serializers import QuestionSerializer, AnswerSerializer, TagSerializer
+
+CASES = (
+    ('questions', Question, QuestionSerializer, QuestionReadSerializer),
+    ('answers', Answer, AnswerSerializer, AnswerReadSerializer),
+    ('tags', Tag, TagSerializer, TagReadSerializer),
+)
+
+
+class Command(BaseCommand):
+    help = 'Сравнивает обычные сериализаторы списков с сериализаторами строк .values() (backend.readers)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--items', type=int, default=1000, help='Объектов на странице')
+        parser.add_argument('--repeat', type=int, default=10, help='Сколько раз повторять замер')
+
+    def handle(self, *args, **options):
+        self.repeat = options['repeat']
+        items = options['items']
+        context = {'request': Request(APIRequestFactory().get('/', HTTP_HOST='localhost'))}
+        for name, model, serializer_class, reader_class in CASES:
+            queryset = model.objects.order_by(*(model._meta.ordering or ['-id']))
+
+            def serialize():
+                page = list(plan_for_serializer(serializer_class).apply(queryset)[:items])
+                return serializer_class(page, many=True, context=context).data
+
+            def read():
+                reader = reader_class(context=context)
+                return reader.represent(reader.values(queryset)[:items])
+
+            slow, slow_queries, slow_data = self.measure(serialize)
+            fast, fast_queries, fast_data = self.measure(read)
+            same = JSONRenderer().render(slow_data) == JSONRenderer().render(fast_data)
+            self.stdout.write(self.style.MIGRATE_HEADING(f'{name}: {len(fast_data)} объектов'))
+            self.stdout.write(f'  сериализатор: {slow * 1000:8.2f} мс, запросов {slow_queries}')
+            self.stdout.write(f'  .values():    {fast * 1000:8.2f} мс, запросов {fast_queries} (x{slow / fast:.1f})')
+            self.stdout.write(f'  {"вывод совпадает" if same else "вывод отличается"}')
+
+    def measure(self, func):
+        with CaptureQueriesContext(connection) as queries:
+            data = func()
+        started = time.perf_counter()
+        for _ in range(self.repeat):
+            func()
+        return (time.perf_counter() - started) / self.repeat, len(queries), data
@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+
+from backend.rating import get_aggregator
+
+
+class Command(BaseCommand):
+    help = 'Сбрасывает накопленные дельты рейтингов в базу (для общего хранилища, например Redis). ' \
+           'Запускать по cron раз в FLUSH_INTERVAL: сам буфер сбрасывается только при следующем лайке'
+
+    def handle(self, *args, **options):
+        count = get_aggregator().flush()
+        self.stdout.write(f'Обновлено объектов: {count}')
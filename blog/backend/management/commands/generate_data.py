@@ -1,7 +1,22 @@
+import json
+import multiprocessing
+import os
+import random
+import time
+from array import array
+from collections import deque
+from functools import lru_cache
+from io import StringIO
+from itertools import accumulate
+
+from django.contrib.contenttypes.models import ContentType
+from django.core.management import call_command
 from django.core.management.base import BaseCommand
-from django_bulk_update.helper import bulk_update
+from django.db import transaction
 from faker import Faker
-import random
+
+from backend import counters, leaderboard
+from backend.cache import page_cache
 from backend.models import Question, Tag, Like, User, Answer
 
 
@@ -11,117 +26,368 @@ QUESTION_COUNT = 100000
 ANSWER_COUNT = 1000000
 LIKE_COUNT = 2000000
 
+PRESETS = {
+    'small': {'users': 100, 'tags': 50, 'questions': 1000, 'answers': 5000, 'likes': 10000},
+    'medium': {'users': 1000, 'tags': 1000, 'questions': 10000, 'answers': 100000, 'likes': 200000},
+    'prod': {'users': USER_COUNT, 'tags': TAG_COUNT, 'questions': QUESTION_COUNT, 'answers': ANSWER_COUNT,
+             'likes': LIKE_COUNT},
+}
+# показатель закона Ципфа для авторов, тегов и лайкаемых объектов; 0 - равномерно
+SKEW = 1.0
+
+CHUNK_SIZE = 5000
 BATCH_SIZE = 500
+STEPS = 8
+
+faker = Faker()
+
+
+def seeded(seed):
+    """
+    Генераторы для одного куска: результат зависит только от seed, а не от процесса, в котором он посчитан
+    """
+    faker.seed_instance(seed)
+    return random.Random(seed)
+
+
+@lru_cache(maxsize=8)
+def zipf_weights(n, skew):
+    # накопленные веса 1/rank^skew: чем меньше номер строки, тем она популярнее
+    return array('d', accumulate(1 / rank ** skew for rank in range(1, n + 1)))
+
+
+def zipf_choices(rng, n, k, skew):
+    if not skew:
+        return [rng.randrange(n) for _ in range(k)]
+    return rng.choices(range(n), cum_weights=zipf_weights(n, skew), k=k)
+
+
+def zipf_sample(rng, n, k, skew):
+    """
+    k разных номеров из n по закону Ципфа; если популярные уже выбраны, добирает равномерно
+    """
+    k = min(k, n)
+    chosen, seen = [], set()
+    for _ in range(3):
+        for i in zipf_choices(rng, n, k - len(chosen), skew):
+            if i not in seen:
+                seen.add(i)
+                chosen.append(i)
+        if len(chosen) == k:
+            return chosen
+    while len(chosen) < k:
+        i = rng.randrange(n)
+        if i not in seen:
+            seen.add(i)
+            chosen.append(i)
+    return chosen
+
+
+# Куски генерируются в процессах-воркерах, поэтому функции - на уровне модуля и без обращений к базе:
+# они возвращают кортежи с номерами связанных строк, а id подставляет основной процесс
+
+def make_users(seed, start, stop, offset):
+    """
+    offset - сколько пользователей уже было: суффикс имени продолжает их нумерацию
+    """
+    seeded(seed)
+    return [(faker.user_name() + str(offset + i), 'passwd{}'.format(i), faker.email()) for i in range(start, stop)]
+
+
+def make_tags(seed, start, stop, offset):
+    seeded(seed)
+    names = []
+    for i in range(start, stop):
+        suffix = str(offset + i)
+        names.append(faker.word()[:Tag._meta.get_field('name').max_length - len(suffix)] + suffix)
+    return names
+
+
+def make_questions(seed, start, stop, users, skew):
+    rng = seeded(seed)
+    max_length = Question._meta.get_field('title').max_length
+    authors = zipf_choices(rng, users, stop - start, skew)
+    return [(faker.sentence()[:rng.randint(20, max_length)], faker.text(), author) for author in authors]
+
+
+def make_question_tags(seed, start, stop, tags, skew):
+    rng = seeded(seed)
+    return [(i, tag) for i in range(start, stop) for tag in zipf_sample(rng, tags, rng.randint(1, 6), skew)]
+
+
+def make_answers(seed, start, stop, users, questions, skew):
+    rng = seeded(seed)
+    authors = zipf_choices(rng, users, stop - start, skew)
+    return [(faker.text(), rng.randrange(questions), author) for author in authors]
+
+
+def make_likes(seed, start, stop, likes, users, objects, skew):
+    """
+    Лайки пользователей start..stop: у каждого свои объекты без повторов, поэтому пары уникальны без проверок
+    """
+    rng = seeded(seed)
+    per_user, extra = divmod(likes, users)
+    return [
+        (i, obj) for i in range(start, stop)
+        for obj in zipf_sample(rng, objects, per_user + (i < extra), skew)
+    ]
+
+
+def ids_of(model):
+    return array('q', model.objects.order_by('id').values_list('id', flat=True).iterator())
+
+
+class Phase:
+    """
+    Замер шага загрузки: строки и строки в секунду
+    """
+    def __init__(self, stdout, step, name):
+        self.stdout = stdout
+        self.title = f'Шаг {step} из {STEPS}. {name}'
+        self.rows = 0
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        if exc_info[0] is None:
+            elapsed = time.perf_counter() - self.started
+            rate = self.rows / elapsed if elapsed else 0
+            self.stdout.write(f'{self.title}: {self.rows} строк за {elapsed:.1f} с, {rate:.0f} строк/с')
+
+
+class Checkpoint:
+    """
+    Прогресс загрузки в JSON-файле: параметры запуска, число строк до него и следующий кусок каждого шага.
+    Файл перезаписывается после коммита каждого куска; без path ничего не сохраняется
+    """
+    def __init__(self, path):
+        self.path = path
+        self.state = None
+        if path and os.path.exists(path):
+            with open(path) as f:
+                self.state = json.load(f)
+
+    def start(self, options, base):
+        self.state = {'options': options, 'base': base, 'phases': {}}
+        self.save()
+
+    def phase(self, key):
+        return self.state['phases'].setdefault(key, {})
+
+    def update(self, key, **progress):
+        self.phase(key).update(progress)
+        self.save()
+
+    def save(self):
+        if not self.path:
+            return
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.state, f)
+        os.replace(tmp, self.path)
+
+    def finish(self):
+        if self.path and os.path.exists(self.path):
+            os.remove(self.path)
 
 
 class Command(BaseCommand):
-    faker = Faker()
+    help = 'Заполняет базу случайными пользователями, тегами, вопросами, ответами и лайками: ' \
+           'строки генерируются кусками в процессах-воркерах и вставляются bulk_create, счетчики ' \
+           'считаются в конце запросами UPDATE. С одинаковыми --seed и объемом данные одинаковые'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--preset', choices=sorted(PRESETS), default='prod',
+                            help='Объем данных; --users и другие перекрывают его')
+        for name in ('users', 'tags', 'questions', 'answers', 'likes'):
+            parser.add_argument(f'--{name}', type=int)
+        parser.add_argument('--seed', type=int, help='Зерно генераторов; по умолчанию случайное и выводится')
+        parser.add_argument('--skew', type=float, default=SKEW,
+                            help='Показатель закона Ципфа для авторов, тегов и лайков; 0 - равномерно')
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                            help='Процессов для генерации; 1 - без воркеров')
+        parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE,
+                            help='Строк в куске: столько держится в памяти на один кусок')
+        parser.add_argument('--checkpoint',
+                            help='Файл прогресса: если он есть, прерванная загрузка продолжается с него '
+                                 'с сохраненными параметрами; после успешной загрузки удаляется')
 
     def handle(self, *args, **options):
-        self.create_users()
-        users = User.objects.all()
-        print("Шаг 1 из 8 Пользователи созданы")
-
-        self.create_tags()
-        tags = Tag.objects.all()
-        print("Шаг 2 из 8 Теги созданы")
-
-        self.create_questions(users=users)
-        questions = Question.objects.all()
-        print("Шаг 3 из 8 Вопросы созданы")
-
-        # self.add_tag_question_relations(questions=questions, tags=tags)
-        # print("Шаг 4 из 8 Добавлены теги")
-
-        self.create_answers(users=users, questions=questions)
-        answers = Answer.objects.all()
-        print("Шаг 5 из 8 Ответы созданы")
-
-        self.update_answer_count(questions=questions)
-        print("Шаг 6 из 8 Обновлен счетчик ответов у вопросов")
-
-        self.update_tag_rating(tags)
-        print("Шаг 7 из 8 Обновлен рейтинг тегов")
-
-        self.create_likes(users=users, answers=answers, questions=questions)
-        print("Шаг 8 из 8 Лайки созданы")
-
-        self.add_tag_question_relations(questions=questions, tags=tags)
-        print("Шаг 4 из 8 Добавлены теги")
-
-    def create_users(self):
-        users = []
-        for i in range(USER_COUNT):
-            user = User(username=self.faker.user_name()+str(i), password='passwd{}'.format(i), email=self.faker.email())
-            users.append(user)
-        User.objects.bulk_create(users, batch_size=BATCH_SIZE)
-
-    def create_tags(self):
-        tags = []
-        for i in range(TAG_COUNT):
-            tag = Tag(name=self.faker.word()+str(i))
-            tags.append(tag)
-        Tag.objects.bulk_create(tags, batch_size=BATCH_SIZE)
-
-    def create_questions(self, users):
-        questions = []
-        for _ in range(QUESTION_COUNT):
-            author = random.choice(users)
-            question = Question(
-                title=self.faker.sentence()[:random.randint(20, 100)],
-                long_text=self.faker.text(),
-                author_id=author.id,
-            )
-            questions.append(question)
-        Question.objects.bulk_create(questions, batch_size=BATCH_SIZE)
-
-    def add_tag_question_relations(self, questions, tags):
-        for question in questions:
-            tag_list = [random.choice(tags) for _ in range(random.randint(1, 6))]
-            tag_id_list = []
-            for tag in tag_list:
-                if tag.pk not in tag_id_list:
-                    tag_id_list.append(tag.pk)
-            question.tags.add(*tag_id_list)
-        bulk_update(questions, batch_size=BATCH_SIZE)
-
-    def create_answers(self, users, questions):
-        answers = []
-        for _ in range(ANSWER_COUNT):
-            answer = Answer(author=random.choice(users), question=random.choice(questions), text=self.faker.text())
-            answers.append(answer)
-        Answer.objects.bulk_create(answers, batch_size=BATCH_SIZE)
-
-    def update_answer_count(self, questions):
-        for question in questions:
-            question.count_answers = question.answers.count()
-        bulk_update(questions, update_fields=['count_answers'], batch_size=BATCH_SIZE)
-
-    def update_tag_rating(self, tags):
-        for tag in tags:
-            tag.rating = tag.questions.count()
-        bulk_update(tags, update_fields=['rating'], batch_size=BATCH_SIZE)
-
-    def create_likes(self, users, answers, questions):
-        big_data = list(answers) + list(questions)
-        author_list = []
-        answer_list = []
-        question_list = []
-        for _ in range(LIKE_COUNT):
-            obj = random.choice(big_data)
-            obj_author = obj.author
-            like_add = Like.set_like(obj=obj, user=random.choice(users))
-            if like_add:
-                obj.rating += 1
-                obj_author.rating += 1
-            else:
-                obj.rating -= 1
-                obj_author.rating -= 1
-            if obj._meta.model == Question:
-                question_list.append(obj)
+        self.checkpoint = Checkpoint(options['checkpoint'])
+        if self.checkpoint.state is None:
+            counts = dict(PRESETS[options['preset']])
+            counts.update({name: options[name] for name in counts if options[name] is not None})
+            seed = random.randrange(2 ** 32) if options['seed'] is None else options['seed']
+            self.checkpoint.start(
+                dict(counts, seed=seed, skew=options['skew'], chunk_size=max(1, options['chunk_size'])),
+                {model.__name__: model.objects.count() for model in (User, Tag, Question, Answer)})
+        else:
+            self.stdout.write(f'Продолжение с {options["checkpoint"]}, параметры из файла')
+        self.counts = self.checkpoint.state['options']
+        self.base = self.checkpoint.state['base']
+        self.seed, self.skew, self.chunk_size = self.counts['seed'], self.counts['skew'], self.counts['chunk_size']
+        self.stdout.write(f'seed {self.seed}')
+
+        self.workers = max(1, options['workers'])
+        self.pool = multiprocessing.Pool(self.workers) if self.workers > 1 else None
+        try:
+            self.load()
+        finally:
+            if self.pool is not None:
+                self.pool.terminate()
+                self.pool.join()
+        self.checkpoint.finish()
+
+    def load(self):
+        # имена уникальны: без сдвига повторный запуск на непустой базе повторил бы их
+        self.insert(1, 'Пользователи', User, make_users, self.counts['users'], self.save_users, self.base['User'])
+        self.insert(2, 'Теги', Tag, make_tags, self.counts['tags'], self.save_tags, self.base['Tag'])
+        user_ids, tag_ids = ids_of(User), ids_of(Tag)
+
+        self.insert(3, 'Вопросы', Question, make_questions, self.counts['questions'], self.save_questions,
+                    len(user_ids), self.skew, user_ids=user_ids)
+        question_ids = ids_of(Question)
+        # теги ставим только новым вопросам
+        new_questions = question_ids[self.base['Question']:]
+        self.insert(4, 'Теги вопросов', Question.tags.through, make_question_tags, len(new_questions),
+                    self.save_question_tags, len(tag_ids), self.skew, question_ids=new_questions, tag_ids=tag_ids)
+
+        self.insert(5, 'Ответы', Answer, make_answers, self.counts['answers'], self.save_answers,
+                    len(user_ids), len(question_ids), self.skew, user_ids=user_ids, question_ids=question_ids)
+        answer_ids = ids_of(Answer)
+
+        likes = self.counts['likes'] if user_ids else 0
+        self.insert(6, 'Лайки', Like, make_likes, len(user_ids) if likes else 0, self.save_likes,
+                    likes, len(user_ids), len(question_ids) + len(answer_ids), self.skew,
+                    chunk=max(1, self.chunk_size * len(user_ids) // likes) if likes else None,
+                    user_ids=user_ids, question_ids=question_ids, answer_ids=answer_ids,
+                    existing=Like.objects.exists())
+        self.once(7, 'Счетчики', self.update_counters)
+        self.once(8, 'hot_score', self.update_hot_scores)
+
+    def generate(self, func, start, total, chunk, *args):
+        """
+        (конец куска, строки) по порядку; воркерам отдается не больше двух кусков на процесс вперед,
+        чтобы готовые куски не копились в памяти, пока основной процесс пишет в базу
+        """
+        tasks = ((f'{self.seed}:{func.__name__}:{begin}', begin, min(begin + chunk, total)) + args
+                 for begin in range(start, total, chunk))
+        if self.pool is None:
+            for task in tasks:
+                yield task[2], func(*task)
+            return
+        pending = deque()
+        for task in tasks:
+            pending.append((task[2], self.pool.apply_async(func, task)))
+            if len(pending) >= 2 * self.workers:
+                stop, result = pending.popleft()
+                yield stop, result.get()
+        while pending:
+            stop, result = pending.popleft()
+            yield stop, result.get()
+
+    def insert(self, step, name, model, func, total, save, *args, chunk=None, **context):
+        """
+        Шаг вставки с продолжением: после каждого куска в checkpoint пишется следующий кусок и число строк.
+        Если строк в таблице больше записанного, кусок закоммичен, а checkpoint не успел сохраниться
+        """
+        key = func.__name__
+        progress = self.checkpoint.phase(key)
+        if progress.get('done'):
+            return
+        chunk = chunk or self.chunk_size
+        rows = model.objects.count()
+        start = progress.get('start', 0)
+        if 'rows' in progress and rows > progress['rows']:
+            start = min(total, start + chunk)
+        self.checkpoint.update(key, start=start, rows=rows)
+        with Phase(self.stdout, step, name) as phase:
+            for stop, batch in self.generate(func, start, total, chunk, *args):
+                with transaction.atomic():
+                    inserted = save(batch, **context)
+                phase.rows += inserted
+                rows += inserted
+                self.checkpoint.update(key, start=stop, rows=rows)
+        self.checkpoint.update(key, done=True)
+
+    def once(self, step, name, func):
+        # пересчеты идемпотентны: после сбоя шаг просто выполняется заново
+        key = func.__name__
+        if self.checkpoint.phase(key).get('done'):
+            return
+        with Phase(self.stdout, step, name) as phase:
+            phase.rows = func()
+        self.checkpoint.update(key, done=True)
+
+    @staticmethod
+    def save_users(rows):
+        User.objects.bulk_create(
+            [User(username=username, password=password, email=email) for username, password, email in rows],
+            batch_size=BATCH_SIZE)
+        return len(rows)
+
+    @staticmethod
+    def save_tags(rows):
+        Tag.objects.bulk_create([Tag(name=name) for name in rows], batch_size=BATCH_SIZE)
+        return len(rows)
+
+    @staticmethod
+    def save_questions(rows, user_ids):
+        Question.objects.bulk_create([
+            Question(title=title, long_text=long_text, author_id=user_ids[author])
+            for title, long_text, author in rows
+        ], batch_size=BATCH_SIZE)
+        return len(rows)
+
+    @staticmethod
+    def save_question_tags(rows, question_ids, tag_ids):
+        # m2m_changed не срабатывает, рейтинг тегов - в update_counters
+        through = Question.tags.through
+        links = [through(question_id=question_ids[question], tag_id=tag_ids[tag]) for question, tag in rows]
+        through.objects.bulk_create(links, batch_size=BATCH_SIZE)
+        return len(links)
+
+    @staticmethod
+    def save_answers(rows, user_ids, question_ids):
+        Answer.objects.bulk_create([
+            Answer(text=text, question_id=question_ids[question], author_id=user_ids[author])
+            for text, question, author in rows
+        ], batch_size=BATCH_SIZE)
+        return len(rows)
+
+    @staticmethod
+    def save_likes(rows, user_ids, question_ids, answer_ids, existing):
+        question_type = ContentType.objects.get_for_model(Question)
+        answer_type = ContentType.objects.get_for_model(Answer)
+        likes = []
+        for user, obj in rows:
+            if obj < len(question_ids):
+                likes.append(Like(user_id=user_ids[user], content_type=question_type, object_id=question_ids[obj]))
             else:
-                answer_list.append(obj)
-            author_list.append(obj_author)
-        bulk_update(question_list, update_fields=['rating'], batch_size=BATCH_SIZE)
-        bulk_update(answer_list, update_fields=['rating'], batch_size=BATCH_SIZE)
-        bulk_update(author_list, update_fields=['rating'], batch_size=BATCH_SIZE)
+                likes.append(Like(user_id=user_ids[user], content_type=answer_type,
+                                  object_id=answer_ids[obj - len(question_ids)]))
+        if existing:
+            # в непустой базе пропускаем лайки, которые уже стоят
+            taken = set(Like.objects.filter(user_id__in={like.user_id for like in likes}).values_list(
+                'content_type_id', 'object_id', 'user_id'))
+            likes = [like for like in likes if (like.content_type_id, like.object_id, like.user_id) not in taken]
+        Like.objects.bulk_create(likes, batch_size=BATCH_SIZE)
+        return len(likes)
+
+    @staticmethod
+    def update_counters():
+        rows = 0
+        for model, field, expression in counters.COUNTERS:
+            with transaction.atomic():
+                rows += counters.recompute(model, field, expression)
+        leaderboard.users.invalidate()
+        leaderboard.tags.invalidate()
+        page_cache.bump(User, Tag, Question, Answer)
+        return rows
+
+    @staticmethod
+    def update_hot_scores():
+        call_command('recompute_hot_scores', stdout=StringIO())
+        return Question.objects.count()
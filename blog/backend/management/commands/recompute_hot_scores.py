@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand
+from django_bulk_update.helper import bulk_update
+
+from backend.models import Question
+from backend.rating import hot_score
+
+BATCH_SIZE = 500
+
+
+class Command(BaseCommand):
+    help = 'Пересчитывает hot_score всех вопросов (после миграции, bulk_create или смены весов)'
+
+    def handle(self, *args, **options):
+        rows = Question.objects.order_by().values_list('id', 'rating', 'count_answers', 'created')
+        batch = []
+        total = 0
+        for question_id, rating, count_answers, created in rows.iterator(chunk_size=BATCH_SIZE):
+            batch.append(Question(id=question_id, hot_score=hot_score(rating, count_answers, created)))
+            if len(batch) == BATCH_SIZE:
+                total += self.save(batch)
+                batch = []
+        total += self.save(batch)
+        self.stdout.write(f'Пересчитано вопросов: {total}')
+
+    @staticmethod
+    def save(questions):
+        bulk_update(questions, update_fields=['hot_score'], batch_size=BATCH_SIZE)
+        return len(questions)
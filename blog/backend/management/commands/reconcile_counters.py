@@ -0,0 +1,98 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+from django_bulk_update.helper import bulk_update
+
+from backend import counters, leaderboard
+from backend.cache import object_cache, page_cache
+from backend.models import Question, Answer, Tag, User
+from backend.rating import get_aggregator, hot_score
+from backend.utils import chunked
+
+BATCH_SIZE = 1000
+
+
+class Command(BaseCommand):
+    help = 'Сверяет денормализованные счетчики (ответы и рейтинги) с данными и исправляет расхождения ' \
+           'пачками: один агрегирующий запрос на пачку и UPDATE только разошедшихся строк'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='Только показать расхождения')
+        parser.add_argument('--hours', type=float,
+                            help='Только вопросы, измененные за последние часы, их ответы, авторы и теги '
+                                 '(лайки и ответы сдвигают modified вопроса); без него - все строки. '
+                                 'Удаление вопроса или ответа и снятие тега с вопроса пересчитывают '
+                                 'рейтинги автора и тегов сразу')
+        parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+        parser.add_argument('--show', type=int, default=10, help='Сколько расхождений выводить на счетчик')
+
+    def handle(self, *args, **options):
+        self.dry_run = options['dry_run']
+        self.batch_size = max(1, options['batch_size'])
+        self.show = options['show']
+        if not self.dry_run:
+            # иначе накопленные дельты лягут сверху уже пересчитанных значений
+            get_aggregator().flush()
+        since = None if options['hours'] is None else timezone.now() - timedelta(hours=options['hours'])
+        scopes = self.scopes(since)
+
+        changed = {}
+        for model, field, expression in counters.COUNTERS:
+            rows = self.reconcile(model, field, expression, scopes[model])
+            if rows:
+                changed.setdefault(model, set()).update(pk for pk, _, _ in rows)
+        if changed and not self.dry_run:
+            self.invalidate(changed)
+
+    @staticmethod
+    def scopes(since):
+        if since is None:
+            return {model: model.objects.all() for model in (Question, Answer, Tag, User)}
+        questions = Question.objects.filter(modified__gte=since)
+        answers = Answer.objects.filter(question__in=questions.values('id'))
+        return {
+            Question: questions,
+            Answer: answers,
+            Tag: Tag.objects.filter(id__in=Question.tags.through.objects.filter(
+                question__in=questions.values('id')).values('tag_id')),
+            User: User.objects.filter(Q(id__in=questions.values('author_id')) | Q(id__in=answers.values('author_id'))),
+        }
+
+    def reconcile(self, model, field, expression, scope):
+        """
+        Сверка одного счетчика; возвращает разошедшиеся строки (id, было, стало)
+        """
+        checked, found = 0, []
+        ids = scope.order_by('pk').values_list('pk', flat=True).iterator(chunk_size=self.batch_size)
+        for batch in chunked(ids, self.batch_size):
+            checked += len(batch)
+            rows = counters.drifted(model, field, expression, batch)
+            if rows and not self.dry_run:
+                with transaction.atomic():
+                    counters.recompute(model, field, expression, model.objects.filter(pk__in=[pk for pk, _, _ in rows]))
+            found.extend(rows)
+
+        name = f'{model.__name__}.{field}'
+        drift = sum(abs(expected - actual) for _, actual, expected in found)
+        action = 'найдено' if self.dry_run else 'исправлено'
+        self.stdout.write(f'{name}: проверено {checked}, {action} расхождений {len(found)}, сумма отклонений {drift}')
+        for pk, actual, expected in found[:self.show]:
+            self.stdout.write(f'  {name} id={pk}: {actual} -> {expected}')
+        return found
+
+    def invalidate(self, changed):
+        if Question in changed:
+            # hot_score складывается из рейтинга и числа ответов
+            for ids in chunked(sorted(changed[Question]), self.batch_size):
+                rows = Question.objects.filter(pk__in=ids).values_list('id', 'rating', 'count_answers', 'created')
+                bulk_update([Question(id=pk, hot_score=hot_score(rating, count_answers, created))
+                             for pk, rating, count_answers, created in rows], update_fields=['hot_score'])
+        for model, ids in changed.items():
+            for pk in ids:
+                object_cache.invalidate(model, pk)
+        leaderboard.users.invalidate()
+        leaderboard.tags.invalidate()
+        page_cache.bump(*changed)
@@ -3,20 +3,71 @@ from django.db import models
 from django.db.models import QuerySet
 
 
+class InvalidSort(ValueError):
+    pass
+
+
+class Sorting:
+    """
+    Разрешенные ключи ?sort= и соответствующие им индексные сортировки,
+    последним полем всегда идет id, чтобы порядок был однозначным
+    """
+    def __init__(self, **orderings):
+        self.orderings = orderings
+
+    def __contains__(self, key):
+        return key in self.orderings
+
+    @property
+    def keys(self):
+        return tuple(self.orderings)
+
+    def ordering(self, key):
+        try:
+            return self.orderings[key]
+        except (KeyError, TypeError):
+            raise InvalidSort(f'Недопустимая сортировка {key!r}, доступны: {", ".join(self.keys)}')
+
+    def apply(self, queryset, key):
+        return queryset.order_by(*self.ordering(key))
+
+
+USER_SORTING = Sorting(
+    rating=('-rating', '-id'),
+)
+
+QUESTION_SORTING = Sorting(
+    rating=('-rating', '-id'),
+    created=('-created', '-id'),
+    count_answers=('-count_answers', '-id'),
+    hot=('-hot_score', '-id'),
+)
+
+TAG_SORTING = Sorting(
+    rating=('-rating', '-id'),
+)
+
+
 class BlogUserManager(UserManager):
+    sorting = USER_SORTING
+
     def top_users(self, key='rating', limit=10):
-        return self.order_by(f'-{key}')[:limit]
+        return self.sorting.apply(self.all(), key)[:limit]
 
 
 class QuestionQuerySet(QuerySet):
+    sorting = QUESTION_SORTING
+
     def hot_questions(self, sort_by='rating'):
-        return self.order_by(f'-{sort_by}')
+        return self.sorting.apply(self, sort_by)
 
 
 class TagQuerySet(QuerySet):
+    sorting = TAG_SORTING
+
     def top_tags(self, key='rating', limit=10):
-        return self.order_by(f'-{key}')[:limit]
+        return self.sorting.apply(self, key)[:limit]
 
 
 TagManager = models.Manager.from_queryset(TagQuerySet)
-QuestionManager = models.Manager.from_queryset(QuestionQuerySet)
\ No newline at end of file
+QuestionManager = models.Manager.from_queryset(QuestionQuerySet)
@@ -0,0 +1,245 @@
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+from django.conf import settings
+
+from backend import autocomplete, leaderboard, querylog
+from backend.cache import object_cache
+
+DEFAULT_SETTINGS = {
+    'ENABLED': True,
+    # доля запросов, для которых считаем SQL и время; счетчик запросов ведется всегда
+    'SAMPLE_RATE': 0.1,
+    # в лог backend.querylog попадают ответы с повторами SQL и запросами медленнее SLOW_QUERY_MS
+    'SLOW_QUERY_MS': 100,
+    # столько запросов одной формы с разными параметрами - уже N+1
+    'REPEAT_THRESHOLD': 5,
+}
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+
+def get_settings():
+    return dict(DEFAULT_SETTINGS, **getattr(settings, 'PROFILING', {}))
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (
+        (name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in labels
+    )
+    return '{' + ','.join(f'{name}="{value}"' for name, value in escaped) + '}'
+
+
+def format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    type = 'counter'
+
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help = help_text
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, labels, amount=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def samples(self):
+        with self.lock:
+            return [(self.name, labels, value) for labels, value in sorted(self.values.items())]
+
+
+class Histogram:
+    """
+    Гистограмма в формате Prometheus: накопительные корзины le, _sum и _count на набор меток
+    """
+    type = 'histogram'
+
+    def __init__(self, name, help_text, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.buckets = tuple(buckets)
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def observe(self, labels, value):
+        with self.lock:
+            series = self.series.get(labels)
+            if series is None:
+                series = self.series[labels] = [[0] * len(self.buckets), 0.0, 0]
+            index = bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def samples(self):
+        with self.lock:
+            series = sorted((labels, list(counts), total, count) for labels, (counts, total, count) in self.series.items())
+        result = []
+        for labels, counts, total, count in series:
+            cumulative = 0
+            for bucket, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                result.append((self.name + '_bucket', labels + (('le', format_value(float(bucket))),), cumulative))
+            result.append((self.name + '_bucket', labels + (('le', '+Inf'),), count))
+            result.append((self.name + '_sum', labels, total))
+            result.append((self.name + '_count', labels, count))
+        return result
+
+
+class Gauge:
+    """
+    Значение снимается в момент выгрузки: callback возвращает {метки: значение}
+    """
+    type = 'gauge'
+
+    def __init__(self, name, help_text, callback):
+        self.name = name
+        self.help = help_text
+        self.callback = callback
+
+    def samples(self):
+        return [(self.name, labels, value) for labels, value in sorted(self.callback().items())]
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.type}')
+            for name, labels, value in metric.samples():
+                lines.append(f'{name}{format_labels(labels)} {format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+
+class Profile:
+    """
+    Замеры одного запроса: SQL через connection.execute_wrapper, участки кода через timed().
+    Запросы группируются по форме (backend.querylog); у повторов и медленных запоминается место вызова
+    """
+    def __init__(self, slow_seconds=None, repeat_threshold=None):
+        config = get_settings()
+        self.slow_seconds = config['SLOW_QUERY_MS'] / 1000 if slow_seconds is None else slow_seconds
+        self.repeat_threshold = config['REPEAT_THRESHOLD'] if repeat_threshold is None else repeat_threshold
+        self.queries = 0
+        self.duplicates = 0
+        self.sql_seconds = 0.0
+        self.timings = {}
+        self.active = set()
+        self.seen = set()
+        self.shapes = {}
+
+    def execute(self, execute, sql, params, many, context):
+        key = (sql, str(params))
+        text = querylog.sql_shape(sql)
+        shape = self.shapes.get(text)
+        if shape is None:
+            shape = self.shapes[text] = querylog.QueryShape(text)
+        if key in self.seen:
+            self.duplicates += 1
+            shape.duplicates += 1
+        else:
+            self.seen.add(key)
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            elapsed = time.perf_counter() - started
+            self.queries += 1
+            self.sql_seconds += elapsed
+            shape.count += 1
+            shape.seconds += elapsed
+            if elapsed >= self.slow_seconds:
+                shape.slow += 1
+            if shape.count > 1 or elapsed >= self.slow_seconds:
+                shape.attribute()
+
+
+_local = threading.local()
+
+
+def current_profile():
+    return getattr(_local, 'profile', None)
+
+
+@contextmanager
+def profiling():
+    profile = _local.profile = Profile()
+    try:
+        yield profile
+    finally:
+        _local.profile = None
+
+
+@contextmanager
+def timed(name):
+    """
+    Добавляет время блока к участку name текущего профиля; вложенные замеры того же участка не суммируются
+    """
+    profile = current_profile()
+    if profile is None or name in profile.active:
+        yield
+        return
+    profile.active.add(name)
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        profile.active.discard(name)
+        profile.timings[name] = profile.timings.get(name, 0.0) + time.perf_counter() - started
+
+
+def object_cache_stats():
+    stats = object_cache.stats()
+    return {(('result', 'hit'),): stats['hits'], (('result', 'miss'),): stats['misses']}
+
+
+def leaderboard_stats(key):
+    return lambda: {(('leaderboard', name),): board.stats()[key] for name, board in leaderboard.LEADERBOARDS.items()}
+
+
+def autocomplete_size():
+    return {(('index', 'tags'),): autocomplete.tags.stats()['size']}
+
+
+registry = Registry()
+requests_total = registry.register(Counter(
+    'blog_requests_total', 'Запросы по маршруту, методу и статусу'))
+request_seconds = registry.register(Histogram(
+    'blog_request_duration_seconds', 'Время ответа (выборочно)'))
+request_queries = registry.register(Histogram(
+    'blog_request_queries', 'SQL-запросов на ответ (выборочно)', COUNT_BUCKETS))
+request_duplicates = registry.register(Histogram(
+    'blog_request_duplicate_queries', 'Повторов одного и того же SQL на ответ (выборочно)', COUNT_BUCKETS))
+request_sql_seconds = registry.register(Histogram(
+    'blog_request_sql_seconds', 'Время SQL на ответ (выборочно)'))
+flagged_queries = registry.register(Counter(
+    'blog_flagged_query_shapes_total', 'Формы SQL с повторами или медленными запросами (выборочно)'))
+request_serializer_seconds = registry.register(Histogram(
+    'blog_request_serializer_seconds', 'Время сериализаторов на ответ, включая ленивые запросы (выборочно)'))
+registry.register(Gauge(
+    'blog_object_cache_lookups', 'Обращения к кешу объектов в этом процессе', object_cache_stats))
+registry.register(Gauge(
+    'blog_leaderboard_rebuilds', 'Перестроений лидерборда в этом процессе', leaderboard_stats('rebuilds')))
+registry.register(Gauge(
+    'blog_leaderboard_rebuild_seconds', 'Суммарное время перестроений лидерборда', leaderboard_stats('rebuild_seconds')))
+registry.register(Gauge(
+    'blog_autocomplete_index_size', 'Строк в индексе автодополнения этого процесса', autocomplete_size))
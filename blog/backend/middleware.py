@@ -0,0 +1,48 @@
+import random
+import time
+
+from django.db import connection
+
+from backend import metrics, querylog
+
+
+def view_labels(request):
+    match = request.resolver_match
+    view = (match.view_name or match.func.__name__) if match is not None else 'unmatched'
+    return ('view', view), ('method', request.method)
+
+
+class ProfilingMiddleware:
+    """
+    Метрики запросов в backend.metrics: счетчик - для всех, SQL, сериализаторы и время -
+    для доли PROFILING['SAMPLE_RATE'], чтобы можно было держать включенным в продакшене.
+    Повторы и медленные SQL этих запросов уходят в лог backend.querylog
+    """
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        config = metrics.get_settings()
+        if not config['ENABLED']:
+            return self.get_response(request)
+        if random.random() >= config['SAMPLE_RATE']:
+            response = self.get_response(request)
+            metrics.requests_total.inc(view_labels(request) + (('status', response.status_code),))
+            return response
+
+        started = time.perf_counter()
+        with metrics.profiling() as profile, connection.execute_wrapper(profile.execute):
+            response = self.get_response(request)
+        elapsed = time.perf_counter() - started
+
+        labels = view_labels(request)
+        metrics.requests_total.inc(labels + (('status', response.status_code),))
+        metrics.request_seconds.observe(labels, elapsed)
+        metrics.request_queries.observe(labels, profile.queries)
+        metrics.request_duplicates.observe(labels, profile.duplicates)
+        metrics.request_sql_seconds.observe(labels, profile.sql_seconds)
+        metrics.request_serializer_seconds.observe(labels, profile.timings.get('serializer', 0.0))
+        flagged = querylog.report(profile, labels[0][1], request.method, request.path)
+        if flagged:
+            metrics.flagged_queries.inc(labels, len(flagged))
+        return response
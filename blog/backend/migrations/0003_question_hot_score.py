@@ -0,0 +1,44 @@
+# Generated by Django 2.1.2 on 2026-10-18 17:13
+
+from django.db import migrations, models
+from django_bulk_update.helper import bulk_update
+
+from backend.rating import hot_score
+
+BATCH_SIZE = 500
+
+
+def fill_hot_scores(apps, schema_editor):
+    """
+    Существующие вопросы без этого остались бы с 0 и ушли в конец ?sort=hot
+    (то же, что recompute_hot_scores)
+    """
+    Question = apps.get_model('backend', 'Question')
+    rows = Question.objects.order_by().values_list('id', 'rating', 'count_answers', 'created')
+    batch = []
+    for question_id, rating, count_answers, created in rows.iterator(chunk_size=BATCH_SIZE):
+        batch.append(Question(id=question_id, hot_score=hot_score(rating, count_answers, created)))
+        if len(batch) == BATCH_SIZE:
+            bulk_update(batch, update_fields=['hot_score'], batch_size=BATCH_SIZE)
+            batch = []
+    bulk_update(batch, update_fields=['hot_score'], batch_size=BATCH_SIZE)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('backend', '0002_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='question',
+            name='hot_score',
+            field=models.FloatField(auto_created=True, default=0, verbose_name='Горячесть'),
+        ),
+        migrations.RunPython(fill_hot_scores, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='question',
+            index=models.Index(fields=['-hot_score', '-id'], name='question_hot_idx'),
+        ),
+    ]
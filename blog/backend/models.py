@@ -1,12 +1,19 @@
+from collections import Counter
+
 from django.contrib.auth.models import AbstractUser
 from django.contrib.contenttypes.fields import GenericForeignKey, GenericRelation
 from django.contrib.contenttypes.models import ContentType
-from django.db import models
-from django.db.models import F
-from django.db.models.signals import post_save, post_delete, m2m_changed
+from django.db import models, transaction, IntegrityError
+from django.db.models import F, IntegerField, Q, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
+from django.db.models.signals import post_save, pre_delete, post_delete, m2m_changed
 from django.dispatch import receiver
+from django.utils import timezone
 
+from backend import autocomplete, leaderboard
+from backend.cache import object_cache, page_cache
 from backend.managers import BlogUserManager, TagManager, QuestionManager
+from backend.rating import change_rating, get_aggregator, group_by_delta, hot_score, HOT_ANSWER_WEIGHT
 
 
 class User(AbstractUser):
@@ -17,6 +24,11 @@ class User(AbstractUser):
     def __str__(self):
         return self.username
 
+    class Meta(AbstractUser.Meta):
+        indexes = [
+            models.Index(fields=['-rating', '-id'], name='user_rating_idx'),
+        ]
+
 
 class Tag(models.Model):
     name = models.CharField(max_length=20, unique=True, verbose_name='Название')
@@ -29,6 +41,9 @@ class Tag(models.Model):
     class Meta:
         verbose_name = 'Тег'
         verbose_name_plural = 'Теги'
+        indexes = [
+            models.Index(fields=['-rating', '-id'], name='tag_rating_idx'),
+        ]
 
 
 class Like(models.Model):
@@ -39,15 +54,23 @@ class Like(models.Model):
 
     @staticmethod
     def set_like(obj, user):
+        """
+        Ставит или снимает лайк, возвращает (лайк стоит, новый рейтинг объекта)
+        """
         obj_type = ContentType.objects.get_for_model(obj)
-        like, is_created = Like.objects.get_or_create(
-            content_type=obj_type, object_id=obj.id, user=user)
-        if not is_created:
-            like.delete()
-            return False
-        return True
+        try:
+            with transaction.atomic():
+                Like.objects.create(content_type=obj_type, object_id=obj.id, user=user)
+            liked = True
+        except IntegrityError:
+            Like.objects.filter(content_type=obj_type, object_id=obj.id, user=user).delete()
+            liked = False
+        model = type(obj)
+        rating = model.objects.filter(id=obj.id).values_list('rating', flat=True).get()
+        return liked, rating + get_aggregator().pending(model, obj.id)
 
-    # Дополнить content_object, content_type -- unique
+    class Meta:
+        unique_together = ('content_type', 'object_id', 'user')
 
 
 class Question(models.Model):
@@ -58,15 +81,25 @@ class Question(models.Model):
     tags = models.ManyToManyField(Tag, verbose_name='Теги', related_name='questions')
     rating = models.IntegerField(default=0, auto_created=True, verbose_name='Рейтинг')
     count_answers = models.PositiveIntegerField(default=0, auto_created=True, verbose_name='Количество ответов')
+    hot_score = models.FloatField(default=0, auto_created=True, verbose_name='Горячесть')
+    modified = models.DateTimeField(auto_now=True, verbose_name='Дата изменения')
     likes = GenericRelation(Like, blank=True, null=True, related_name='likes')
     objects = QuestionManager()
 
+    def save(self, *args, **kwargs):
+        if self._state.adding:
+            self.hot_score = hot_score(self.rating, self.count_answers, self.created or timezone.now())
+        super().save(*args, **kwargs)
+
     @property
     def short_text(self):
-        current_text = self.long_text
-        if len(current_text) <= 100:
-            return current_text
-        return self.long_text[:100] + '...'
+        return self.shorten(self.long_text)
+
+    @staticmethod
+    def shorten(text):
+        if len(text) <= 100:
+            return text
+        return text[:100] + '...'
 
     def __str__(self):
         return self.title
@@ -75,6 +108,12 @@ class Question(models.Model):
         verbose_name = 'Вопрос'
         verbose_name_plural = 'Вопросы'
         ordering = ['-created']
+        indexes = [
+            models.Index(fields=['-created', '-id'], name='question_created_idx'),
+            models.Index(fields=['-rating', '-id'], name='question_rating_idx'),
+            models.Index(fields=['-count_answers', '-id'], name='question_answers_idx'),
+            models.Index(fields=['-hot_score', '-id'], name='question_hot_idx'),
+        ]
 
 
 class Answer(models.Model):
@@ -97,34 +136,155 @@ class Answer(models.Model):
         verbose_name = 'Ответ'
         verbose_name_plural = 'Ответы'
         ordering = ['-rating', 'created']
+        indexes = [
+            models.Index(fields=['question', '-rating', 'created'], name='answer_question_rating_idx'),
+            models.Index(fields=['-rating', 'created'], name='answer_rating_idx'),
+        ]
 
 
 @receiver(post_save, sender=Answer)
 def up_answer_count(sender, instance, created, **kwargs):
     if created:
-        instance.question.count_answers += 1
-        instance.question.save()
+        Question.objects.filter(id=instance.question_id).update(
+            count_answers=F('count_answers') + 1,
+            hot_score=F('hot_score') + HOT_ANSWER_WEIGHT,
+            modified=timezone.now(),
+        )
+        object_cache.invalidate(Question, instance.question_id)
+        page_cache.bump(Question, User)
+    else:
+        Question.objects.filter(id=instance.question_id).update(modified=timezone.now())
+    object_cache.invalidate(Answer, instance.id)
+    page_cache.bump(Answer)
+
+
+@receiver(post_save, sender=Question)
+@receiver(post_delete, sender=Question)
+@receiver(post_delete, sender=Answer)
+def invalidate_object(sender, instance, **kwargs):
+    object_cache.invalidate(sender, instance.id)
+    page_cache.bump(sender, User)
+    if sender is Answer:
+        Question.objects.filter(id=instance.question_id).update(modified=timezone.now())
+
+
+def authored_rating(author_id):
+    """
+    Рейтинг автора по данным: сумма рейтингов его вопросов и ответов, выражение для UPDATE
+    """
+    total = Value(0)
+    for model in (Question, Answer):
+        rows = model.objects.filter(author_id=author_id).order_by().values('author_id')
+        subquery = Subquery(rows.annotate(total=Sum('rating')).values('total'), output_field=IntegerField())
+        total = total + Coalesce(subquery, Value(0))
+    return total
+
+
+@receiver(post_delete, sender=Question)
+@receiver(post_delete, sender=Answer)
+def recount_author_rating(sender, instance, **kwargs):
+    # лайки удаляются каскадом в любом порядке со своим объектом: после удаления его строки
+    # down_rating не находит автора, поэтому рейтинг автора считаем заново
+    User.objects.filter(id=instance.author_id).update(rating=authored_rating(instance.author_id))
+    transaction.on_commit(leaderboard.users.invalidate)
+
+
+@receiver(pre_delete, sender=Question)
+def remember_tags(sender, instance, **kwargs):
+    # связи с тегами удалятся каскадом без m2m_changed
+    instance.deleted_tag_ids = list(
+        Question.tags.through.objects.filter(question_id=instance.id).values_list('tag_id', flat=True))
+
+
+@receiver(post_delete, sender=Question)
+def down_tag_rating(sender, instance, **kwargs):
+    tag_ids = getattr(instance, 'deleted_tag_ids', None)
+    if not tag_ids:
+        return
+    change_tag_ratings(dict.fromkeys(tag_ids, -1))
+    page_cache.bump(Tag)
+
+
+@receiver(post_save, sender=User)
+def invalidate_users(sender, instance, created, update_fields, **kwargs):
+    page_cache.bump(User)
+    if created or (update_fields is not None and 'username' not in update_fields):
+        return
+    # имя автора встроено в закешированные вопросы и ответы и в их списки,
+    # а ETag вопроса и его ответов строится по modified
+    page_cache.bump(Question, Answer)
+    Question.objects.filter(
+        Q(author_id=instance.id) | Q(id__in=Answer.objects.filter(author_id=instance.id).values('question_id'))
+    ).update(modified=timezone.now())
+    for model in (Question, Answer):
+        for pk in model.objects.filter(author_id=instance.id).values_list('id', flat=True).iterator():
+            object_cache.invalidate(model, pk)
 
 
 @receiver(post_save, sender=Like)
 def up_rating(sender, instance, created, **kwargs):
-    obj = instance.content_object
-    obj.rating += 1
-    obj.author.rating += 1
-    obj.author.save()
-    obj.save()
+    if created:
+        model = ContentType.objects.get_for_id(instance.content_type_id).model_class()
+        change_rating(model, instance.object_id, 1)
+        object_cache.invalidate(model, instance.object_id)
+        page_cache.bump(model, User)
 
 
 @receiver(post_delete, sender=Like)
 def down_rating(sender, instance, **kwargs):
-    obj = instance.content_object
-    obj.rating -= 1
-    obj.author.rating -= 1
-    obj.author.save()
-    obj.save()
+    model = ContentType.objects.get_for_id(instance.content_type_id).model_class()
+    change_rating(model, instance.object_id, -1)
+    object_cache.invalidate(model, instance.object_id)
+    page_cache.bump(model, User)
+
+
+def change_tag_ratings(deltas):
+    """
+    {id тега: прирост} - один UPDATE на каждое значение прироста
+    """
+    for delta, tag_ids in group_by_delta(deltas):
+        Tag.objects.filter(id__in=tag_ids).update(rating=F('rating') + delta)
+    for tag_id, delta in deltas.items():
+        leaderboard.tags.changed(tag_id, delta)
+        autocomplete.tags.changed(tag_id, delta)
 
 
 @receiver(m2m_changed, sender=Question.tags.through)
-def up_tag_rating(sender, instance, model, pk_set, action, **kwargs):
-    if action == "post_add":
-        model.objects.filter(id__in=pk_set).update(rating=F('rating')+1)
+def up_tag_rating(sender, instance, model, pk_set, action, reverse, **kwargs):
+    if action == "post_add" and pk_set:
+        # с тега (tag.questions.add) в pk_set вопросы: тег один, прирост - их число
+        change_tag_ratings({instance.id: len(pk_set)} if reverse else dict.fromkeys(pk_set, 1))
+    if action in ("pre_remove", "pre_clear"):
+        # снимаются только существующие связи: remove() принимает и непривязанные id
+        links = sender.objects.filter(**{'tag_id' if reverse else 'question_id': instance.id})
+        if action == "pre_remove":
+            links = links.filter(**{'question_id__in' if reverse else 'tag_id__in': pk_set})
+        links = list(links.values_list('question_id', 'tag_id'))
+        instance.removed_question_ids = sorted({question_id for question_id, _ in links})
+        change_tag_ratings({tag_id: -count for tag_id, count in Counter(tag_id for _, tag_id in links).items()})
+    if action in ("post_add", "post_remove", "post_clear"):
+        if reverse:
+            question_ids = pk_set if action == "post_add" else getattr(instance, 'removed_question_ids', ())
+        else:
+            question_ids = [instance.id]
+        Question.objects.filter(id__in=question_ids).update(modified=timezone.now())
+        for question_id in question_ids:
+            object_cache.invalidate(Question, question_id)
+        page_cache.bump(Question, Tag)
+
+
+@receiver(post_save, sender=Tag)
+def index_tag(sender, instance, created, **kwargs):
+    if created:
+        autocomplete.tags.add([instance])
+
+
+@receiver(post_delete, sender=Tag)
+def unindex_tag(sender, instance, **kwargs):
+    autocomplete.tags.remove(instance.id)
+
+
+@receiver(post_save, sender=Tag)
+@receiver(post_delete, sender=Tag)
+def invalidate_tags(sender, instance, **kwargs):
+    page_cache.bump(Tag)
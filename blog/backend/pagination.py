@@ -0,0 +1,192 @@
+import json
+from base64 import b64decode, b64encode
+from collections import OrderedDict, namedtuple
+from functools import reduce
+from operator import or_
+
+from django.core.cache import cache
+from django.core.exceptions import ValidationError as DjangoValidationError
+from django.db import connection
+from django.db.models import Q, QuerySet
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination, _positive_int
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+Cursor = namedtuple('Cursor', ['values', 'reverse'])
+
+COUNT_CACHE_TIMEOUT = 60
+
+
+def reverse_ordering(ordering):
+    return tuple(field[1:] if field.startswith('-') else '-' + field for field in ordering)
+
+
+class KeysetPagination(BasePagination):
+    """
+    Постраничная выдача по ключу сортировки (keyset): курсор хранит значения всех
+    полей сортировки последней строки, следующая страница - WHERE (rating, id) < (...).
+    Сортировку берет из queryset, поэтому работает с любым ?sort= менеджеров,
+    а страница 10 000 стоит столько же, сколько первая
+    """
+    cursor_query_param = 'cursor'
+    page_size = api_settings.PAGE_SIZE
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+    invalid_cursor_message = 'Неверный курсор'
+    exact_count_query_param = 'exact_count'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.has_next = self.has_previous = False
+        self.page = None
+        if not isinstance(queryset, QuerySet) or not queryset.query.can_filter():
+            # готовый топ (лидерборд или срез) - отдаем одной страницей
+            results = list(queryset)
+            self.count, self.count_exact = len(results), True
+            return results
+
+        self.count, self.count_exact = self.get_count(queryset, request, view)
+
+        self.page_size = self.get_page_size(request)
+        self.base_url = request.build_absolute_uri()
+        self.model = queryset.model
+        self.ordering = self.get_ordering(queryset)
+
+        cursor = self.decode_cursor(request)
+        reverse = cursor is not None and cursor.reverse
+        ordering = reverse_ordering(self.ordering) if reverse else self.ordering
+        queryset = queryset.order_by(*ordering)
+        loaded, deferred = queryset.query.deferred_loading
+        if loaded and not deferred:
+            # курсор читает поля сортировки - они не должны быть отложены only()
+            queryset = queryset.only(*loaded, *(field.lstrip('-') for field in ordering))
+        if cursor is not None:
+            queryset = queryset.filter(self.after(ordering, cursor.values))
+
+        results = list(queryset[:self.page_size + 1])
+        has_more = len(results) > self.page_size
+        results = results[:self.page_size]
+        if reverse:
+            results.reverse()
+            self.has_next, self.has_previous = True, has_more
+        else:
+            self.has_next, self.has_previous = has_more, cursor is not None
+        self.page = results
+        return results
+
+    def get_count(self, queryset, request, view):
+        """
+        (число объектов, точное ли оно): по ?exact_count=1 - COUNT(*),
+        для вложенных списков - счетчик, который ведет view (get_counter),
+        для отфильтрованных - COUNT(*), для целых таблиц - оценка из кеша
+        """
+        if request.query_params.get(self.exact_count_query_param):
+            return queryset.count(), True
+        get_counter = getattr(view, 'get_counter', None)
+        counter = get_counter() if get_counter is not None else None
+        if counter is not None:
+            return counter, False
+        if queryset.query.where:
+            return queryset.count(), True
+        return self.approximate_count(queryset.model), False
+
+    @staticmethod
+    def approximate_count(model):
+        key = f'count:{model._meta.label_lower}'
+        count = cache.get(key)
+        if count is None:
+            if connection.vendor == 'postgresql':
+                with connection.cursor() as cursor:
+                    cursor.execute('SELECT reltuples FROM pg_class WHERE relname = %s', [model._meta.db_table])
+                    row = cursor.fetchone()
+                count = int(row[0]) if row and row[0] > 0 else None
+            if count is None:
+                count = model.objects.count()
+            cache.set(key, count, COUNT_CACHE_TIMEOUT)
+        return count
+
+    def get_page_size(self, request):
+        try:
+            return _positive_int(
+                request.query_params[self.page_size_query_param],
+                strict=True,
+                cutoff=self.max_page_size
+            )
+        except (KeyError, ValueError):
+            return self.page_size
+
+    @staticmethod
+    def get_ordering(queryset):
+        """
+        Сортировка queryset с id в конце, чтобы ключ был уникальным
+        """
+        ordering = list(queryset.query.order_by or queryset.model._meta.ordering or ['-id'])
+        if not {'id', 'pk'} & {field.lstrip('-') for field in ordering}:
+            ordering.append('-id' if ordering[-1].startswith('-') else 'id')
+        return tuple('id' if field == 'pk' else '-id' if field == '-pk' else field for field in ordering)
+
+    @staticmethod
+    def after(ordering, values):
+        """
+        (f1, f2, ...) строго после (v1, v2, ...) в порядке ordering;
+        отдельное условие на f1 дает базе диапазон для поиска по индексу
+        """
+        first = ordering[0]
+        bound = Q(**{first.lstrip('-') + ('__lte' if first.startswith('-') else '__gte'): values[0]})
+        conditions = []
+        for i, field in enumerate(ordering):
+            name = field.lstrip('-')
+            lookup = '__lt' if field.startswith('-') else '__gt'
+            equal = {f.lstrip('-'): value for f, value in zip(ordering[:i], values[:i])}
+            conditions.append(Q(**equal, **{name + lookup: values[i]}))
+        return bound & reduce(or_, conditions)
+
+    def row_values(self, row):
+        values = []
+        for field in self.ordering:
+            name = field.lstrip('-')
+            value = row[name] if isinstance(row, dict) else getattr(row, name)
+            values.append(value.isoformat() if hasattr(value, 'isoformat') else value)
+        return values
+
+    def decode_cursor(self, request):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if encoded is None:
+            return None
+        try:
+            data = json.loads(b64decode(encoded.encode('ascii')).decode('utf-8'))
+            raw_values, reverse = data['v'], bool(data['r'])
+            if len(raw_values) != len(self.ordering):
+                raise ValueError
+            values = [self.model._meta.get_field(field.lstrip('-')).to_python(value)
+                      for field, value in zip(self.ordering, raw_values)]
+        except (TypeError, ValueError, KeyError, DjangoValidationError):
+            raise NotFound(self.invalid_cursor_message)
+        return Cursor(values=values, reverse=reverse)
+
+    def encode_cursor(self, row, reverse):
+        data = json.dumps({'v': self.row_values(row), 'r': int(reverse)}, separators=(',', ':'))
+        encoded = b64encode(data.encode('utf-8')).decode('ascii')
+        return replace_query_param(self.base_url, self.cursor_query_param, encoded)
+
+    def get_next_link(self):
+        if not self.has_next or not self.page:
+            return None
+        return self.encode_cursor(self.page[-1], reverse=False)
+
+    def get_previous_link(self):
+        if not self.has_previous:
+            return None
+        if not self.page:
+            return remove_query_param(self.base_url, self.cursor_query_param)
+        return self.encode_cursor(self.page[0], reverse=True)
+
+    def get_paginated_response(self, data):
+        return Response(OrderedDict([
+            ('count', self.count),
+            ('count_exact', self.count_exact),
+            ('next', self.get_next_link()),
+            ('previous', self.get_previous_link()),
+            ('results', data),
+        ]))
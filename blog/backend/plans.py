@@ -0,0 +1,111 @@
+from functools import lru_cache
+
+from django.core.exceptions import FieldDoesNotExist
+from django.db.models import Prefetch
+from rest_framework.relations import HyperlinkedIdentityField, ManyRelatedField, RelatedField
+
+
+class QueryPlan:
+    """
+    Как загружать queryset под сериализатор: select_related/prefetch_related/only/annotate
+    """
+    def __init__(self, select_related=(), prefetch_related=(), only=(), annotate=None):
+        self.select_related = tuple(select_related)
+        self.prefetch_related = tuple(prefetch_related)
+        self.only = tuple(only)
+        self.annotate = annotate or {}
+
+    def apply(self, queryset):
+        if self.select_related:
+            queryset = queryset.select_related(*self.select_related)
+        if self.prefetch_related:
+            queryset = queryset.prefetch_related(*self.prefetch_related)
+        if self.only:
+            queryset = queryset.only(*self.only)
+        if self.annotate:
+            queryset = queryset.annotate(**self.annotate)
+        return queryset
+
+    def __repr__(self):
+        return (f'QueryPlan(select_related={self.select_related}, prefetch_related={self.prefetch_related}, '
+                f'only={self.only}, annotate={self.annotate})')
+
+
+def prefetch_for(model, name, child):
+    """
+    Prefetch для many-поля: у связанных объектов грузим только то, что выводит поле
+    """
+    relation = model._meta.get_field(name)
+    related_model = relation.related_model
+    columns = [related_model._meta.pk.name]
+    if relation.one_to_many:
+        # обратный ForeignKey - prefetch сопоставляет объекты по нему
+        columns.append(relation.field.attname)
+    slug_field = getattr(child, 'slug_field', None)
+    if slug_field:
+        columns.append(slug_field)
+    elif not child.use_pk_only_optimization():
+        return name
+    queryset = related_model._default_manager.only(*columns)
+    if not related_model._meta.ordering:
+        # без порядка в Meta база вернет связанные объекты как придется
+        queryset = queryset.order_by(related_model._meta.pk.name)
+    return Prefetch(name, queryset=queryset)
+
+
+@lru_cache(maxsize=None)
+def plan_for_serializer(serializer_class):
+    """
+    Выводит план загрузки по полям сериализатора: точечные source и ForeignKey - join,
+    many-поля - prefetch, а без связей - only() по выводимым колонкам
+    """
+    model = serializer_class.Meta.model
+    select_related, prefetch_related, only = [], [], {model._meta.pk.name}
+    only_possible = True
+    for name, field in serializer_class().fields.items():
+        if field.write_only or isinstance(field, HyperlinkedIdentityField) or field.source == '*':
+            continue
+        source_attrs = field.source.split('.')
+        if isinstance(field, ManyRelatedField):
+            prefetch_related.append(prefetch_for(model, source_attrs[0], field.child_relation))
+            continue
+        if isinstance(field, RelatedField) and field.use_pk_only_optimization():
+            only.add(model._meta.get_field(source_attrs[0]).attname)
+            continue
+        try:
+            model_field = model._meta.get_field(source_attrs[0])
+        except FieldDoesNotExist:
+            # свойство модели (short_text) - неизвестно, какие колонки нужны
+            only_possible = False
+            continue
+        if model_field.is_relation and (len(source_attrs) > 1 or isinstance(field, RelatedField)):
+            select_related.append(source_attrs[0])
+        else:
+            only.add(model_field.attname)
+    return QueryPlan(
+        select_related=select_related,
+        prefetch_related=prefetch_related,
+        only=sorted(only) if only_possible and not select_related else (),
+    )
+
+
+class QueryPlanMixin:
+    """
+    План загрузки на каждое действие: query_plans[action], иначе выводится из сериализатора
+    """
+    query_plans = {}
+    planned_actions = ('list', 'retrieve', 'set_like')
+
+    def get_query_plan(self):
+        # у generic-представлений без роутера действия нет - это список
+        action = getattr(self, 'action', 'list')
+        if action in self.query_plans:
+            return self.query_plans[action]
+        if action not in self.planned_actions:
+            return None
+        return plan_for_serializer(self.get_serializer_class())
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        plan = self.get_query_plan()
+        return plan.apply(queryset) if plan is not None else queryset
@@ -0,0 +1,108 @@
+import json
+import logging
+import os
+import re
+import sys
+from functools import lru_cache
+
+logger = logging.getLogger(__name__)
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__)) + os.sep
+PROJECT_DIR = os.path.dirname(os.path.dirname(BACKEND_DIR))
+# свои обертки не считаем местом вызова
+SKIP_FILES = {os.path.join(BACKEND_DIR, name) for name in ('metrics.py', 'middleware.py', 'querylog.py')}
+DRF_SERIALIZERS = os.path.join('rest_framework', 'serializers.py')
+DISPATCHER = os.path.join('django', 'dispatch', 'dispatcher.py')
+MAX_SITES = 3
+MAX_SQL_LENGTH = 500
+
+WHITESPACE = re.compile(r'\s+')
+IN_LIST = re.compile(r'IN \((?:%s, )*%s\)')
+
+
+@lru_cache(maxsize=1024)
+def sql_shape(sql):
+    """
+    Форма запроса: без лишних пробелов и с IN (...) любой длины
+    """
+    return IN_LIST.sub('IN (...)', WHITESPACE.sub(' ', sql).strip())
+
+
+def attribute():
+    """
+    Откуда выполнен запрос: ближайшая строка кода backend, поле сериализатора
+    и получатель сигнала, если запрос выполнен внутри них
+    """
+    site = {}
+    frame = sys._getframe(1)
+    while frame is not None:
+        code = frame.f_code
+        filename = code.co_filename
+        if 'code' not in site and filename.startswith(BACKEND_DIR) and filename not in SKIP_FILES:
+            site['code'] = f'{os.path.relpath(filename, PROJECT_DIR)}:{frame.f_lineno} {code.co_name}'
+        elif 'field' not in site and filename.endswith(DRF_SERIALIZERS) and code.co_name == 'to_representation' \
+                and 'field' in frame.f_locals and 'self' in frame.f_locals:
+            site['field'] = f"{type(frame.f_locals['self']).__name__}.{frame.f_locals['field'].field_name}"
+        elif 'receiver' not in site and filename.endswith(DISPATCHER) and 'receiver' in frame.f_locals:
+            receiver = frame.f_locals['receiver']
+            site['receiver'] = f'{receiver.__module__}.{getattr(receiver, "__qualname__", receiver)}'
+        frame = frame.f_back
+    return site
+
+
+class QueryShape:
+    """
+    Запросы одной формы за время ответа
+    """
+    def __init__(self, shape):
+        self.shape = shape
+        self.count = 0
+        self.duplicates = 0
+        self.seconds = 0.0
+        self.slow = 0
+        self.sites = []
+        self.attributed = 0
+
+    def add_site(self, site):
+        if site not in self.sites and len(self.sites) < MAX_SITES:
+            self.sites.append(site)
+
+    def attribute(self):
+        """
+        Место вызова повтора или медленного запроса: стек обходится не больше MAX_SITES раз
+        на форму, остальные повторы N+1 берут уже найденные места
+        """
+        if self.attributed < MAX_SITES:
+            self.attributed += 1
+            self.add_site(attribute())
+
+    def flagged(self, repeat_threshold):
+        return self.duplicates or self.slow or self.count >= repeat_threshold
+
+    def as_dict(self):
+        return {
+            'sql': self.shape[:MAX_SQL_LENGTH],
+            'count': self.count,
+            'duplicates': self.duplicates,
+            'slow': self.slow,
+            'ms': round(self.seconds * 1000, 2),
+            'sites': self.sites,
+        }
+
+
+def report(profile, view, method, path):
+    """
+    Пишет в лог JSON с повторами и медленными запросами ответа; возвращает найденные формы
+    """
+    flagged = [shape for shape in profile.shapes.values() if shape.flagged(profile.repeat_threshold)]
+    if flagged:
+        logger.warning(json.dumps({
+            'event': 'queries',
+            'view': view,
+            'method': method,
+            'path': path,
+            'queries': profile.queries,
+            'sql_ms': round(profile.sql_seconds * 1000, 2),
+            'flagged': [shape.as_dict() for shape in flagged],
+        }, ensure_ascii=False, default=str))
+    return flagged
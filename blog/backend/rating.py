@@ -0,0 +1,301 @@
+import logging
+import threading
+import time
+import uuid
+from collections import defaultdict
+from datetime import datetime
+
+from django.apps import apps
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.db import transaction
+from django.db.models import F
+from django.dispatch import receiver
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from backend import leaderboard
+from backend.cache import object_cache, page_cache
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 500
+
+DEFAULT_SETTINGS = {
+    'STORE': 'backend.rating.LocMemRatingStore',
+    'OPTIONS': {},
+    # sync - сразу пишем в базу, buffered - копим дельты и сбрасываем пачкой
+    'DURABILITY': 'sync',
+    'FLUSH_INTERVAL': 5,
+}
+
+# "горячесть" вопроса: каждый лайк весит HOT_RATING_WEIGHT, ответ - HOT_ANSWER_WEIGHT,
+# а каждые HOT_DECAY_SECONDS возраста стоят одного лайка. Слагаемые линейные,
+# поэтому лайки и ответы меняют hot_score атомарным F() без пересчета
+HOT_RATING_WEIGHT = 1
+HOT_ANSWER_WEIGHT = 2
+HOT_DECAY_SECONDS = 3600
+HOT_EPOCH = datetime(2018, 1, 1, tzinfo=timezone.utc)
+
+
+def hot_score(rating, count_answers, created):
+    age_bonus = (created - HOT_EPOCH).total_seconds() / HOT_DECAY_SECONDS
+    return rating * HOT_RATING_WEIGHT + count_answers * HOT_ANSWER_WEIGHT + age_bonus
+
+
+def has_field(model, name):
+    return any(field.name == name for field in model._meta.fields)
+
+
+def rating_update(model, delta):
+    """
+    Поля для UPDATE при изменении рейтинга объекта на delta
+    """
+    fields = {'rating': F('rating') + delta}
+    if has_field(model, 'hot_score'):
+        fields['hot_score'] = F('hot_score') + delta * HOT_RATING_WEIGHT
+    if has_field(model, 'modified'):
+        fields['modified'] = timezone.now()
+    return fields
+
+
+def touch_questions(model, ids):
+    """
+    Ответы входят в версию вопроса (ETag списка ответов) - сдвигаем его modified
+    """
+    if not has_field(model, 'question'):
+        return
+    question_model = model._meta.get_field('question').related_model
+    question_ids = model.objects.filter(id__in=ids).values('question_id')
+    question_model.objects.filter(id__in=question_ids).update(modified=timezone.now())
+
+
+def change_rating_now(model, object_id, delta):
+    """
+    Атомарно меняет рейтинг объекта и его автора на delta
+    """
+    author_model = model._meta.get_field('author').related_model
+    with transaction.atomic():
+        author_id = model.objects.filter(id=object_id).values_list('author_id', flat=True).first()
+        if author_id is None:
+            return
+        model.objects.filter(id=object_id).update(**rating_update(model, delta))
+        touch_questions(model, [object_id])
+        author_model.objects.filter(id=author_id).update(rating=F('rating') + delta)
+    leaderboard.users.changed(author_id, delta)
+
+
+def make_key(model, object_id):
+    return f'{model._meta.label_lower}:{object_id}'
+
+
+def parse_key(key):
+    label, object_id = key.rsplit(':', 1)
+    return apps.get_model(label), int(object_id)
+
+
+def group_by_delta(deltas):
+    """
+    {id: delta} -> [(delta, [id, ...])] пачками по BATCH_SIZE, один UPDATE на пачку
+    """
+    groups = defaultdict(list)
+    for object_id, delta in deltas.items():
+        if delta:
+            groups[delta].append(object_id)
+    for delta, ids in groups.items():
+        for i in range(0, len(ids), BATCH_SIZE):
+            yield delta, ids[i:i + BATCH_SIZE]
+
+
+def apply_deltas(deltas):
+    """
+    Применяет накопленные дельты {key: delta} к объектам и их авторам
+    """
+    by_model = defaultdict(lambda: defaultdict(int))
+    for key, delta in deltas.items():
+        model, object_id = parse_key(key)
+        by_model[model][object_id] += delta
+
+    with transaction.atomic():
+        for model, objects in by_model.items():
+            author_model = model._meta.get_field('author').related_model
+            author_deltas = defaultdict(int)
+            for delta, ids in group_by_delta(objects):
+                model.objects.filter(id__in=ids).update(**rating_update(model, delta))
+                touch_questions(model, ids)
+                for object_id in ids:
+                    object_cache.invalidate(model, object_id)
+                for object_id, author_id in model.objects.filter(id__in=ids).values_list('id', 'author_id'):
+                    author_deltas[author_id] += objects[object_id]
+            for delta, ids in group_by_delta(author_deltas):
+                author_model.objects.filter(id__in=ids).update(rating=F('rating') + delta)
+            for author_id, delta in author_deltas.items():
+                leaderboard.users.changed(author_id, delta)
+            page_cache.bump(model, author_model)
+
+
+class LocMemRatingStore:
+    """
+    Дельты в памяти процесса
+    """
+    def __init__(self):
+        self._deltas = defaultdict(int)
+        self._lock = threading.Lock()
+
+    def add(self, key, delta):
+        with self._lock:
+            self._deltas[key] += delta
+
+    def pending(self, key):
+        return self._deltas.get(key, 0)
+
+    def drain(self):
+        """
+        (дельты, квитанция для done) - дельты из буфера изымаются
+        """
+        with self._lock:
+            deltas, self._deltas = self._deltas, defaultdict(int)
+        return dict(deltas), None
+
+    def done(self, receipt):
+        pass
+
+
+class RedisRatingStore:
+    """
+    Дельты в хеше Redis (или совместимого сервера), общие для всех процессов.
+    Сброс переименовывает хеш в {key}:flush:<время>:<uuid> и удаляет его только после
+    коммита в базу; хеш сброса старше lease секунд (процесс умер посередине) забирает
+    следующий сброс. Сброс дольше lease применит эти дельты дважды
+    """
+    def __init__(self, url='redis://localhost:6379/0', key='blog:ratings', lease=300):
+        import redis
+
+        self.client = redis.StrictRedis.from_url(url)
+        self.key = key
+        self.lease = lease
+
+    def flushing_key(self):
+        return f'{self.key}:flush:{int(time.time())}:{uuid.uuid4().hex}'
+
+    def abandoned(self):
+        """
+        Хеши сбросов, не удаленные за lease секунд
+        """
+        prefix = f'{self.key}:flush:'
+        for name in self.client.scan_iter(match=prefix + '*'):
+            name = name.decode()
+            started = name[len(prefix):].split(':')[0]
+            if started.isdigit() and time.time() - int(started) > self.lease:
+                yield name
+
+    def add(self, key, delta):
+        self.client.hincrby(self.key, key, delta)
+
+    def pending(self, key):
+        return int(self.client.hget(self.key, key) or 0)
+
+    def drain(self):
+        import redis
+
+        claimed = []
+        # rename атомарен: брошенный хеш достается одному сбросу
+        for source in [self.key] + list(self.abandoned()):
+            flushing = self.flushing_key()
+            try:
+                self.client.rename(source, flushing)
+            except redis.ResponseError:  # дельт нет или хеш уже забрали
+                continue
+            claimed.append(flushing)
+        deltas = defaultdict(int)
+        for flushing in claimed:
+            for key, delta in self.client.hgetall(flushing).items():
+                deltas[key.decode()] += int(delta)
+        return dict(deltas), claimed
+
+    def done(self, receipt):
+        if receipt:
+            self.client.delete(*receipt)
+
+
+class RatingAggregator:
+    """
+    Изменение рейтингов: сразу в базу или через буфер с периодическим сбросом.
+    Сброс по FLUSH_INTERVAL проверяется только при следующем изменении: без трафика
+    дельты ждут flush_ratings, поэтому с общим хранилищем его запускают по cron.
+    Дельты LocMemRatingStore видит только свой процесс и теряются при его остановке
+    """
+    def __init__(self, store, durability='sync', flush_interval=5):
+        self.store = store
+        self.durability = durability
+        self.flush_interval = flush_interval
+        self.last_flush = time.monotonic()
+
+    @classmethod
+    def from_settings(cls):
+        config = dict(DEFAULT_SETTINGS, **getattr(settings, 'RATING_BUFFER', {}))
+        store = import_string(config['STORE'])(**config['OPTIONS'])
+        return cls(store, config['DURABILITY'], config['FLUSH_INTERVAL'])
+
+    @property
+    def buffered(self):
+        return self.durability == 'buffered'
+
+    def change(self, model, object_id, delta):
+        if not self.buffered:
+            return change_rating_now(model, object_id, delta)
+        try:
+            self.store.add(make_key(model, object_id), delta)
+        except Exception:
+            logger.exception('Rating buffer is unavailable, writing synchronously')
+            return change_rating_now(model, object_id, delta)
+        if time.monotonic() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def pending(self, model, object_id):
+        if not self.buffered:
+            return 0
+        try:
+            return self.store.pending(make_key(model, object_id))
+        except Exception:
+            logger.exception('Rating buffer is unavailable')
+            return 0
+
+    def flush(self):
+        """
+        Сбрасывает дельты в базу, возвращает число затронутых объектов
+        """
+        self.last_flush = time.monotonic()
+        deltas, receipt = self.store.drain()
+        if deltas:
+            try:
+                apply_deltas(deltas)
+            except Exception:
+                # если не вернулись и дельты, их заберет следующий сброс по квитанции
+                for key, delta in deltas.items():
+                    self.store.add(key, delta)
+                self.store.done(receipt)
+                raise
+        self.store.done(receipt)
+        return len(deltas)
+
+
+_aggregator = None
+
+
+def get_aggregator():
+    global _aggregator
+    if _aggregator is None:
+        _aggregator = RatingAggregator.from_settings()
+    return _aggregator
+
+
+@receiver(setting_changed)
+def reset_aggregator(setting, **kwargs):
+    global _aggregator
+    if setting == 'RATING_BUFFER':
+        _aggregator = None
+
+
+def change_rating(model, object_id, delta):
+    get_aggregator().change(model, object_id, delta)
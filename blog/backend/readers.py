@@ -0,0 +1,162 @@
+from collections import OrderedDict, defaultdict
+from operator import itemgetter
+
+from rest_framework import serializers
+from rest_framework.reverse import reverse
+
+from backend.metrics import timed
+from backend.models import Question, Answer, Tag
+
+URL_PLACEHOLDER = '__pk__'
+
+
+class Column:
+    """
+    Значение колонки .values(), при необходимости через to_representation поля DRF
+    """
+    def __init__(self, source, field=None):
+        self.source = source
+        self.columns = (source,)
+        self.field = field
+
+    def bind(self, reader, rows):
+        if self.field is None:
+            return itemgetter(self.source)
+        source, to_representation = self.source, self.field.to_representation
+        return lambda row: None if row[source] is None else to_representation(row[source])
+
+
+class Computed(Column):
+    """
+    Значение, вычисляемое из колонки (свойства модели)
+    """
+    def __init__(self, source, func):
+        super().__init__(source)
+        self.func = func
+
+    def bind(self, reader, rows):
+        source, func = self.source, self.func
+        return lambda row: func(row[source])
+
+
+class Link:
+    """
+    Ссылка как у HyperlinkedIdentityField: reverse() один раз на ответ, дальше - подстановка id
+    """
+    columns = ('id',)
+
+    def __init__(self, view_name, lookup_url_kwarg='pk'):
+        self.view_name = view_name
+        self.lookup_url_kwarg = lookup_url_kwarg
+
+    def bind(self, reader, rows):
+        url = reverse(self.view_name, kwargs={self.lookup_url_kwarg: URL_PLACEHOLDER},
+                      request=reader.context.get('request'))
+        prefix, suffix = url.split(URL_PLACEHOLDER)
+        return lambda row: f'{prefix}{row["id"]}{suffix}'
+
+
+class RelatedLink(Link):
+    """
+    Ссылка на объект по внешнему ключу, как HyperlinkedRelatedField
+    """
+    def __init__(self, view_name, source):
+        super().__init__(view_name)
+        self.source = source
+        self.columns = (source,)
+
+    def bind(self, reader, rows):
+        link = super().bind(reader, rows)
+        source = self.source
+        return lambda row: None if row[source] is None else link({'id': row[source]})
+
+
+class ManySlugs:
+    """
+    Список slug связанных объектов many-to-many, как SlugRelatedField(many=True): один запрос на страницу
+    """
+    columns = ('id',)
+
+    def __init__(self, name, slug_field):
+        self.name = name
+        self.slug_field = slug_field
+
+    def bind(self, reader, rows):
+        field = reader.model._meta.get_field(self.name)
+        source, target = field.m2m_field_name(), field.m2m_reverse_field_name()
+        related = defaultdict(list)
+        ids = [row['id'] for row in rows]
+        if ids:
+            pairs = field.remote_field.through.objects.filter(**{f'{source}_id__in': ids}).order_by(
+                f'{target}_id').values_list(f'{source}_id', f'{target}__{self.slug_field}')
+            for object_id, slug in pairs:
+                related[object_id].append(slug)
+        return lambda row: related.get(row['id'], [])
+
+
+class ReadSerializer:
+    """
+    Сериализатор списков только для чтения: работает со строками .values() и выдает то же,
+    что и обычный сериализатор, без экземпляров моделей и reverse() на каждый объект
+    """
+    model = None
+    fields = ()
+
+    def __init__(self, context=None):
+        self.context = context or {}
+
+    def values(self, queryset):
+        """
+        Строки для страницы: колонки полей и сортировки (ее читает курсор пагинации)
+        """
+        names = ['id']
+        ordering = queryset.query.order_by or self.model._meta.ordering
+        for column in [column for _, field in self.fields for column in field.columns] + \
+                [field.lstrip('-') for field in ordering]:
+            if column not in names:
+                names.append(column)
+        return queryset.prefetch_related(None).values(*names)
+
+    def represent(self, rows):
+        with timed('serializer'):
+            rows = list(rows)
+            getters = [(name, field.bind(self, rows)) for name, field in self.fields]
+            return [OrderedDict([(name, getter(row)) for name, getter in getters]) for row in rows]
+
+
+class QuestionReadSerializer(ReadSerializer):
+    model = Question
+    fields = (
+        ('url', Link('question-detail')),
+        ('title', Column('title')),
+        ('long_text', Column('long_text')),
+        ('author', Column('author__username')),
+        ('rating', Column('rating')),
+        ('answers', Link('question-answers-list', 'question_pk')),
+        ('tags', ManySlugs('tags', 'name')),
+        ('short_text', Computed('long_text', Question.shorten)),
+        ('count_answers', Column('count_answers')),
+    )
+
+
+class AnswerReadSerializer(ReadSerializer):
+    model = Answer
+    fields = (
+        ('url', Link('answer-detail')),
+        ('text', Column('text')),
+        ('author', Column('author__username')),
+        ('created', Column('created', serializers.DateTimeField())),
+        ('right_answer', Column('right_answer')),
+        ('rating', Column('rating')),
+        ('question', RelatedLink('question-detail', 'question_id')),
+    )
+
+
+class TagReadSerializer(ReadSerializer):
+    model = Tag
+    fields = (
+        ('url', Link('tag-detail')),
+        ('name', Column('name')),
+        ('rating', Column('rating')),
+        ('questions', Link('tag-questions-list', 'tag_pk')),
+    )
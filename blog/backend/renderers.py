@@ -0,0 +1,125 @@
+import csv
+import io
+
+from rest_framework.renderers import BaseRenderer, JSONRenderer
+
+from backend import jsonlib
+
+
+class PrometheusRenderer(BaseRenderer):
+    """
+    Текстовый формат Prometheus; ошибки (403 и т.п.) - комментарием
+    """
+    media_type = 'text/plain'
+    format = 'txt'
+    charset = 'utf-8'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        if not isinstance(data, str):
+            data = ''.join(f'# {value}\n' for value in data.values())
+        return data.encode(self.charset)
+
+
+class FastJSONRenderer(JSONRenderer):
+    """
+    JSONRenderer на быстрой библиотеке (backend.jsonlib) с тем же выводом (кроме float
+    в экспоненциальной записи, см. jsonlib). Отступы, ensure_ascii и незнакомые
+    библиотеке типы - через обычный JSONRenderer
+    """
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return bytes()
+        if jsonlib.name == 'json' or self.ensure_ascii or not self.compact \
+                or self.get_indent(accepted_media_type, renderer_context or {}) is not None:
+            return super().render(data, accepted_media_type, renderer_context)
+        try:
+            return jsonlib.escape_separators(jsonlib.dumps(data))
+        except (TypeError, ValueError, OverflowError):
+            return super().render(data, accepted_media_type, renderer_context)
+
+    def stream(self, items, chunk_size=100):
+        """
+        JSON-массив по частям для StreamingHttpResponse: большой список не собирается в памяти целиком
+        """
+        yield b'['
+        separator = b''
+        chunk = []
+        for item in items:
+            chunk.append(item)
+            if len(chunk) == chunk_size:
+                yield separator + self.render(chunk)[1:-1]
+                separator = b','
+                chunk = []
+        if chunk:
+            yield separator + self.render(chunk)[1:-1]
+        yield b']'
+
+
+class NDJSONRenderer(BaseRenderer):
+    """
+    Объект JSON на строку; список - по строке на элемент
+    """
+    media_type = 'application/x-ndjson'
+    format = 'ndjson'
+    charset = None
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return bytes()
+        json_renderer = FastJSONRenderer()
+        return b''.join(json_renderer.render(item) + b'\n' for item in (data if isinstance(data, list) else [data]))
+
+    def stream(self, items, chunk_size=100, fields=None):
+        chunk = []
+        for item in items:
+            chunk.append(item)
+            if len(chunk) == chunk_size:
+                yield self.render(chunk)
+                chunk = []
+        if chunk:
+            yield self.render(chunk)
+
+
+class CSVRenderer(BaseRenderer):
+    """
+    Список словарей в CSV с заголовком; списки в ячейке - через запятую
+    """
+    media_type = 'text/csv'
+    format = 'csv'
+    charset = 'utf-8'
+
+    @staticmethod
+    def cell(value):
+        if value is None:
+            return ''
+        if isinstance(value, bool):
+            return 'true' if value else 'false'
+        if isinstance(value, list):
+            return ','.join(str(item) for item in value)
+        return value
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return bytes()
+        return b''.join(self.stream(data if isinstance(data, list) else [data]))
+
+    def stream(self, items, chunk_size=100, fields=None):
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        if fields is not None:
+            writer.writerow(fields)
+        count = 0
+        for item in items:
+            if fields is None:
+                fields = list(item)
+                writer.writerow(fields)
+            writer.writerow([self.cell(item.get(field)) for field in fields])
+            count += 1
+            if count % chunk_size == 0:
+                yield buffer.getvalue().encode(self.charset)
+                buffer.seek(0)
+                buffer.truncate()
+        if buffer.tell():
+            yield buffer.getvalue().encode(self.charset)
@@ -1,7 +1,27 @@
 from django.contrib.auth import authenticate
+from django.db import transaction
 from rest_framework import serializers
 
+from backend.metrics import timed
 from backend.models import Tag, Question, Answer, User
+from backend.tagging import attach_tags, resolve_tags, unique
+
+
+class TimedListSerializer(serializers.ListSerializer):
+    @property
+    def data(self):
+        with timed('serializer'):
+            return super().data
+
+
+class TimedSerializerMixin:
+    """
+    Время сериализации ответа попадает в профиль запроса (backend.metrics)
+    """
+    @property
+    def data(self):
+        with timed('serializer'):
+            return super().data
 
 
 class CreateUserSerializer(serializers.ModelSerializer):
@@ -33,7 +53,25 @@ class LoginUserSerializer(serializers.Serializer): # DEBUG feature
         raise serializers.ValidationError("Неверные логин или пароль.")
 
 
-class QuestionSerializer(serializers.HyperlinkedModelSerializer):
+class TagNamesField(serializers.ManyRelatedField):
+    """
+    Теги по именам: при записи - только проверка имен без запросов к базе,
+    сами теги ищутся и создаются пачкой в QuestionSerializer (backend.tagging)
+    """
+    def __init__(self, **kwargs):
+        kwargs.setdefault('child_relation', serializers.SlugRelatedField(queryset=Tag.objects.all(), slug_field='name'))
+        super().__init__(**kwargs)
+        self.name_field = serializers.CharField(max_length=Tag._meta.get_field('name').max_length)
+
+    def to_internal_value(self, data):
+        if isinstance(data, str) or not hasattr(data, '__iter__'):
+            self.fail('not_a_list', input_type=type(data).__name__)
+        if not self.allow_empty and len(data) == 0:
+            self.fail('empty')
+        return unique(self.name_field.run_validation(name) for name in data)
+
+
+class QuestionSerializer(TimedSerializerMixin, serializers.HyperlinkedModelSerializer):
     author = serializers.ReadOnlyField(source='author.username')
     rating = serializers.IntegerField(read_only=True)
     count_answers = serializers.IntegerField(read_only=True)
@@ -42,29 +80,51 @@ class QuestionSerializer(serializers.HyperlinkedModelSerializer):
         lookup_url_kwarg='question_pk',
         read_only=True
     )
-    tags = serializers.SlugRelatedField(
-        many=True,
-        queryset=Tag.objects.all(),
-        slug_field='name',
-        required=False,
-     )
+    tags = TagNamesField(required=False)
 
     class Meta:
+        list_serializer_class = TimedListSerializer
         model = Question
         fields = ('url', 'title', 'long_text', 'author', 'rating', 'answers', 'tags', 'short_text', 'count_answers')
 
+    @transaction.atomic
+    def create(self, validated_data):
+        names = validated_data.pop('tags', [])
+        question = super().create(validated_data)
+        attach_tags({question.id: [tag.id for tag in resolve_tags(names)]}, new=True)
+        return question
+
+    @transaction.atomic
+    def update(self, instance, validated_data):
+        names = validated_data.pop('tags', None)
+        instance = super().update(instance, validated_data)
+        if names is not None:
+            instance.tags.set(resolve_tags(names))
+        return instance
 
-class UserSerializer(serializers.HyperlinkedModelSerializer):
+
+class UserSerializer(TimedSerializerMixin, serializers.HyperlinkedModelSerializer):
     """
-    Лист пользователей
+    Лист пользователей; вопросы и ответы - ссылками на списки автора, а не всеми id
     """
+    answers = serializers.HyperlinkedIdentityField(
+        view_name='user-answers-list',
+        lookup_url_kwarg='author_pk',
+        read_only=True
+    )
+    questions = serializers.HyperlinkedIdentityField(
+        view_name='user-questions-list',
+        lookup_url_kwarg='author_pk',
+        read_only=True
+    )
 
     class Meta:
+        list_serializer_class = TimedListSerializer
         model = User
         fields = ('username', 'rating', 'answers', 'questions')
 
 
-class TagSerializer(serializers.HyperlinkedModelSerializer):
+class TagSerializer(TimedSerializerMixin, serializers.HyperlinkedModelSerializer):
     """
     Вопросы по тегу, лист тегов
     """
@@ -76,11 +136,12 @@ class TagSerializer(serializers.HyperlinkedModelSerializer):
     rating = serializers.IntegerField(read_only=True)
 
     class Meta:
+        list_serializer_class = TimedListSerializer
         model = Tag
         fields = ('url', 'name', 'rating', 'questions')
 
 
-class AnswerSerializer(serializers.HyperlinkedModelSerializer):
+class AnswerSerializer(TimedSerializerMixin, serializers.HyperlinkedModelSerializer):
     author = serializers.ReadOnlyField(source='author.username')
     rating = serializers.IntegerField(read_only=True)
     right_answer = serializers.BooleanField(read_only=True)
@@ -90,16 +151,18 @@ class AnswerSerializer(serializers.HyperlinkedModelSerializer):
     )
 
     class Meta:
+        list_serializer_class = TimedListSerializer
         model = Answer
         fields = ('url', 'text', 'author', 'created', 'right_answer', 'rating', 'question')
 
 
-class ProfileSerializer(serializers.HyperlinkedModelSerializer):
+class ProfileSerializer(TimedSerializerMixin, serializers.HyperlinkedModelSerializer):
     """
     Профиль пользователя
     """
     rating = serializers.IntegerField(read_only=True)
 
     class Meta:
+        list_serializer_class = TimedListSerializer
         model = User
         fields = ('avatar', 'rating', 'username', 'email')
\ No newline at end of file
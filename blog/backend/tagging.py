@@ -0,0 +1,73 @@
+"""
+Теги вопросов пачкой: поиск и создание по именам, привязка к вопросам и рейтинг тегов.
+Через through-таблицу напрямую, поэтому m2m_changed не срабатывает - его работу делает attach_tags
+"""
+from collections import Counter
+
+from django.db import connection, transaction, IntegrityError
+from django.db.models import F
+from django.utils import timezone
+
+from backend import autocomplete, leaderboard
+from backend.cache import object_cache, page_cache
+from backend.models import Question, Tag
+from backend.rating import group_by_delta
+
+
+def unique(names):
+    return list(dict.fromkeys(names))
+
+
+def resolve_tags(names):
+    """
+    Теги с именами names в том же порядке, недостающие создаются: один SELECT и один INSERT.
+    Если тег успели создать параллельно, недостающие создаются по одному через get_or_create
+    """
+    names = unique(names)
+    tags = {tag.name: tag for tag in Tag.objects.filter(name__in=names)}
+    missing = [name for name in names if name not in tags]
+    if missing:
+        try:
+            with transaction.atomic():
+                created = Tag.objects.bulk_create([Tag(name=name) for name in missing])
+        except IntegrityError:
+            created = [Tag.objects.get_or_create(name=name)[0] for name in missing]
+        if not connection.features.can_return_ids_from_bulk_insert:
+            # без RETURNING у созданных тегов нет id
+            ids = dict(Tag.objects.filter(name__in=missing).values_list('name', 'id'))
+            for tag in created:
+                tag.id = ids[tag.name]
+                tag._state.adding, tag._state.db = False, Tag.objects.db
+        tags.update((tag.name, tag) for tag in created)
+        autocomplete.tags.add(created)
+    return [tags[name] for name in names]
+
+
+def attach_tags(links, new=False):
+    """
+    Привязывает теги {id вопроса: [id тегов]} одной вставкой в through-таблицу, рейтинг тегов -
+    один UPDATE на каждое значение прироста. new - вопросы только что созданы и связей у них нет
+    """
+    through = Question.tags.through
+    pairs = {(question_id, tag_id) for question_id, tag_ids in links.items() for tag_id in tag_ids}
+    if not new and pairs:
+        pairs -= set(through.objects.filter(question_id__in=links).values_list('question_id', 'tag_id'))
+    if not pairs:
+        return 0
+
+    deltas = Counter(tag_id for _, tag_id in pairs)
+    question_ids = sorted({question_id for question_id, _ in pairs})
+    with transaction.atomic():
+        through.objects.bulk_create([through(question_id=question_id, tag_id=tag_id)
+                                     for question_id, tag_id in sorted(pairs)])
+        for delta, tag_ids in group_by_delta(deltas):
+            Tag.objects.filter(id__in=tag_ids).update(rating=F('rating') + delta)
+        if not new:
+            Question.objects.filter(id__in=question_ids).update(modified=timezone.now())
+    for tag_id, delta in deltas.items():
+        leaderboard.tags.changed(tag_id, delta)
+        autocomplete.tags.changed(tag_id, delta)
+    for question_id in question_ids:
+        object_cache.invalidate(Question, question_id)
+    page_cache.bump(Question, Tag)
+    return len(pairs)
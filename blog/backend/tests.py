@@ -1,13 +1,47 @@
 """
 Тест базового функционала, доступного на фронте before 572 after
 """
+import csv
+import gc
+import io
 import json
+import math
+import os
+import statistics
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from datetime import timedelta
+from decimal import Decimal
+from io import StringIO
+from unittest import mock, skipUnless
+from urllib.parse import urlencode
 
-from django.urls import reverse
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection, transaction, DatabaseError, IntegrityError
+from django.test import TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import get_resolver, reverse
+from django.utils import timezone
+from knox.models import AuthToken
 from rest_framework import status
-from rest_framework.test import APIClient, APITestCase
+from rest_framework.exceptions import ParseError
+from rest_framework.renderers import JSONRenderer
+from rest_framework.request import Request
+from rest_framework.test import APIClient, APIRequestFactory, APITestCase
 
-from backend.models import User, Question, Answer
+from backend import autocomplete, jsonlib, leaderboard, metrics, querylog
+from backend.cache import object_cache, page_cache
+from backend.management.commands.generate_data import Command as GenerateData
+from backend.models import User, Question, Answer, Like, Tag
+from backend.parsers import FastJSONParser
+from backend.rating import get_aggregator, hot_score
+from backend.tagging import attach_tags, resolve_tags
+from backend.renderers import FastJSONRenderer
+from backend.serializers import AnswerSerializer
+from backend.views import QuestionViewSet, AnswerViewSet, TagViewSet, UserListView
 
 
 class BaseViewTest(APITestCase):
@@ -43,7 +77,19 @@ class BaseViewTest(APITestCase):
 
         return self.token
 
+    @contextmanager
+    def assertMaxQueries(self, limit):
+        with CaptureQueriesContext(connection) as context:
+            yield context
+        queries = '\n'.join(query['sql'] for query in context.captured_queries)
+        self.assertLessEqual(len(context), limit, f'{len(context)} запросов вместо {limit}:\n{queries}')
+
     def setUp(self):
+        cache.clear()
+        # TestCase не коммитит: кеши и топы, которые обновляются после коммита, обновляем сразу
+        self.on_commit = mock.patch.object(transaction, 'on_commit', lambda func, using=None: func())
+        self.on_commit.start()
+        self.addCleanup(self.on_commit.stop)
         self.user_admin = User.objects.create_superuser("test_admin", None, "1234412")
         self.admin_password = "1234412"
         self.admin_username = "test_admin"
@@ -118,9 +164,9 @@ class TestQuestion(BaseViewTest):
         )
         return response
 
-    def set_like(self):
+    def set_like(self, **params):
         url = reverse("question-set-like", kwargs={'pk': self.question.pk})
-        response = self.client.put(url)
+        response = self.client.put(url, QUERY_STRING=urlencode(params))
         return response
 
     def test_question_create(self):
@@ -163,18 +209,29 @@ class TestQuestion(BaseViewTest):
         """
         self.login_client(self.bob_username, self.bob_password)
         response = self.set_like()
-        self.assertEqual(1, response.data['rating'])
-        self.assertEqual(self.question.author.username, response.data['author'])
+        self.assertEqual({'liked': True, 'rating': 1}, response.data)
         self.assertEqual(status.HTTP_200_OK, response.status_code)
         author = User.objects.get(id=self.question.author.pk)
         self.assertEqual(1, author.rating)
-        response = self.set_like()
+        response = self.set_like(full=1)
         self.assertEqual(0, response.data['rating'])
         self.assertEqual(self.question.author.username, response.data['author'])
         self.assertEqual(status.HTTP_200_OK, response.status_code)
         author = User.objects.get(id=self.question.author.pk)
         self.assertEqual(0, author.rating)
 
+    def test_question_set_like_queries(self):
+        """
+        Компактный лайк не загружает теги и автора вопроса
+        """
+        self.login_client(self.bob_username, self.bob_password)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.set_like()
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        self.assertFalse([q for q in queries if 'backend_tag' in q['sql']])
+        statements = [q for q in queries if 'SAVEPOINT' not in q['sql']]
+        self.assertLessEqual(len(statements), 9)
+
     def test_question_answer(self):
         """
         Отвечать на вопрос могут только авторизованные пользователи
@@ -200,6 +257,50 @@ class TestQuestion(BaseViewTest):
         )
         self.assertEqual(status.HTTP_200_OK, response.status_code)
 
+    def test_hot_sort(self):
+        """
+        Горячие: лайки и ответы поднимают вопрос, свежий вопрос выше старого
+        """
+        old = Question.objects.create(title="Old", long_text="opa", author_id=self.alice.id)
+        Question.objects.filter(id=old.id).update(created=timezone.now() - timedelta(days=2))
+        call_command('recompute_hot_scores', stdout=StringIO())
+        new = Question.objects.create(title="New", long_text="opa", author_id=self.alice.id)
+        # у "How to" уже есть ответ из setUp
+        self.assertEqual(['How to', 'New', 'Old'], [q.title for q in Question.objects.hot_questions('hot')])
+
+        Like.set_like(old, self.bob)
+        Answer.objects.create(question_id=old.id, text="answer", author_id=self.bob.id)
+        old.refresh_from_db()
+        self.assertEqual(1, old.rating)
+        self.assertEqual(1, old.count_answers)
+        self.assertAlmostEqual(hot_score(1, 1, old.created), old.hot_score)
+
+        url = reverse('question-list')
+        response = self.client.get(url, data={"sort": "hot"})
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        self.assertEqual('Old', response.data['results'][-1]['title'])
+
+    def test_bad_sort(self):
+        """
+        Сортировка только по разрешенным полям
+        """
+        url = reverse('question-list')
+        for sort in ('long_text', 'author__password', '-rating'):
+            response = self.client.get(url, data={"sort": sort})
+            self.assertEqual(status.HTTP_400_BAD_REQUEST, response.status_code)
+            self.assertIn('sort', response.data)
+
+    def test_tag_sort(self):
+        """
+        Сортировка вопросов тега не теряет фильтр по тегу
+        """
+        tag = Tag.objects.create(name='tag')
+        question = Question.objects.create(title="Tagged", long_text="opa", author_id=self.alice.id)
+        question.tags.add(tag)
+        url = reverse('tag-questions-list', kwargs={'tag_pk': tag.pk})
+        response = self.client.get(url, data={"sort": "rating"})
+        self.assertEqual(['Tagged'], [q['title'] for q in response.data['results']])
+
 
 class TestAnswer(BaseViewTest):
     def create_answer(self):
@@ -247,19 +348,43 @@ class TestAnswer(BaseViewTest):
         self.login_client(self.bob_username, self.bob_password)
         url = reverse("answer-set-like", kwargs={'pk': self.answer.pk})
         response = self.client.put(url)
-        self.assertEqual(1, response.data['rating'])
-        self.assertEqual(self.answer.author.username, response.data['author'])
+        self.assertEqual({'liked': True, 'rating': 1}, response.data)
         self.assertEqual(status.HTTP_200_OK, response.status_code)
         author = User.objects.get(id=self.answer.author.pk)
         self.assertEqual(1, author.rating)
-        url = reverse("answer-set-like", kwargs={'pk': self.answer.pk})
-        response = self.client.put(url)
+        response = self.client.put(url, QUERY_STRING='full=1')
         self.assertEqual(0, response.data['rating'])
         self.assertEqual(self.answer.author.username, response.data['author'])
         self.assertEqual(status.HTTP_200_OK, response.status_code)
         author = User.objects.get(id=self.answer.author.pk)
         self.assertEqual(0, author.rating)
 
+    def test_nested_set_like_scoped(self):
+        """
+        Лайк по вложенному маршруту чужого родителя - 404, а не лайк любого объекта
+        """
+        self.login_client(self.bob_username, self.bob_password)
+        other = Question.objects.create(title="Other", long_text="opa", author_id=self.alice.id)
+        tag = Tag.objects.create(name='tag')
+        other.tags.add(tag)
+        for url in (reverse('question-answers-set-like', kwargs={'question_pk': other.pk, 'pk': self.answer.pk}),
+                    reverse('tag-questions-set-like', kwargs={'tag_pk': tag.pk, 'pk': self.question.pk})):
+            for params in ('', 'full=1'):
+                with self.subTest(url=url, params=params):
+                    response = self.client.put(url, QUERY_STRING=params)
+                    self.assertEqual(status.HTTP_404_NOT_FOUND, response.status_code)
+        self.assertFalse(Like.objects.exists())
+
+    def test_set_like_full_flag(self):
+        self.login_client(self.bob_username, self.bob_password)
+        url = reverse("answer-set-like", kwargs={'pk': self.answer.pk})
+        for value in ('0', 'false', 'no', ''):
+            with self.subTest(full=value):
+                response = self.client.put(url, QUERY_STRING=f'full={value}')
+                self.assertEqual({'liked', 'rating'}, set(response.data))
+        response = self.client.put(url, QUERY_STRING='full=true')
+        self.assertIn('author', response.data)
+
     def test_answer_right(self):
         """
         Помечать ответ верным может только автор вопроса
@@ -335,6 +460,179 @@ class TestTag(BaseViewTest):
         self.assertEqual(2, len(response.data['results']))
         self.assertEqual(2, response.data['results'][0]['rating'])
 
+    def test_tags_resolved_in_batch(self):
+        Tag.objects.create(name='old')
+        self.login_client(self.alice_username, self.alice_password)
+        data = {"title": 'batch', "long_text": 'how to?', "tags": ['old', 'new_1', 'new_2', 'new_1']}
+        with CaptureQueriesContext(connection) as context:
+            response = self.create_question_tags(data)
+        self.assertEqual(status.HTTP_201_CREATED, response.status_code)
+        self.assertEqual(['old', 'new_1', 'new_2'], response.data['tags'])
+        # чтение тегов для ответа (INNER JOIN) - уже не создание
+        tag_queries = [query['sql'] for query in context.captured_queries
+                       if ('"backend_tag"' in query['sql'] or '"backend_question_tags"' in query['sql'])
+                       and 'INNER JOIN' not in query['sql']]
+        # SELECT, INSERT тегов, без RETURNING - поиск их id, INSERT связей, UPDATE рейтинга
+        expected = 4 if connection.features.can_return_ids_from_bulk_insert else 5
+        self.assertEqual(expected, len(tag_queries), '\n'.join(tag_queries))
+        self.assertEqual(1, sum(sql.startswith('INSERT INTO "backend_question_tags"') for sql in tag_queries))
+        self.assertEqual({'old': 1, 'new_1': 1, 'new_2': 1}, dict(Tag.objects.values_list('name', 'rating')))
+
+    def test_tag_rating_from_tag_side(self):
+        """
+        tag.questions.add(...) поднимает рейтинг тега на число вопросов, а не рейтинг вопросов
+        """
+        autocomplete.tags.clear()
+        tag = Tag.objects.create(name='tag')
+        other = Question.objects.create(title="Other", long_text="opa", author_id=self.alice.id)
+        tag.questions.add(self.question, other)
+        tag.refresh_from_db()
+        self.assertEqual(2, tag.rating)
+        self.assertEqual([0, 0], list(Question.objects.order_by('id').values_list('rating', flat=True)))
+        self.assertEqual([('tag', tag.id, 2)], autocomplete.tags.search('ta'))
+        self.assertEqual([('tag', 2)], [(t.name, t.rating) for t in leaderboard.tags.top(10)])
+
+    def test_tag_swap_keeps_rating(self):
+        """
+        Замена тегов при правке вопроса снимает рейтинг со старого тега, а не копит его
+        """
+        autocomplete.tags.clear()
+        self.login_client(self.alice_username, self.alice_password)
+        response = self.create_question_tags({"title": 'swap', "long_text": 'how to?', "tags": ['old', 'kept']})
+        url = reverse('question-detail', kwargs={'pk': Question.objects.get(title='swap').pk})
+        for tags in (['new', 'kept'], ['old', 'kept'], ['new', 'kept']):
+            response = self.client.patch(url, data=json.dumps({"tags": tags}), content_type="application/json")
+            self.assertEqual(status.HTTP_200_OK, response.status_code)
+        expected = {'old': 0, 'kept': 1, 'new': 1}
+        self.assertEqual(expected, dict(Tag.objects.values_list('name', 'rating')))
+        self.assertEqual(expected, {name: rating for name, _, rating in autocomplete.tags.search('')})
+        self.assertEqual({'kept': 1, 'new': 1}, {tag.name: tag.rating for tag in leaderboard.tags.top(10) if tag.rating})
+
+    def test_tag_clear_and_remove(self):
+        tag, other = Tag.objects.create(name='tag'), Tag.objects.create(name='other')
+        question = Question.objects.create(title="Other", long_text="opa", author_id=self.alice.id)
+        self.question.tags.add(tag, other)
+        question.tags.add(tag)
+        tag.questions.remove(question, self.answer.question_id + 100)
+        self.question.tags.remove(other, tag.id + 100)
+        self.assertEqual({'tag': 1, 'other': 0}, dict(Tag.objects.values_list('name', 'rating')))
+        tag.questions.clear()
+        self.assertEqual(0, Tag.objects.get(id=tag.id).rating)
+        self.question.tags.add(tag, other)
+        self.question.tags.clear()
+        self.assertEqual({'tag': 0, 'other': 0}, dict(Tag.objects.values_list('name', 'rating')))
+
+    def test_tag_name_too_long(self):
+        self.login_client(self.alice_username, self.alice_password)
+        response = self.create_question_tags({"title": 'long', "long_text": 'how to?', "tags": ['x' * 21]})
+        self.assertEqual(status.HTTP_400_BAD_REQUEST, response.status_code)
+        self.assertFalse(Tag.objects.exists())
+
+    def test_resolve_after_conflict(self):
+        def concurrent_insert(tags):
+            Tag.objects.create(name='raced')
+            raise IntegrityError
+
+        Tag.objects.create(name='old')
+        with mock.patch.object(Tag.objects, 'bulk_create', side_effect=concurrent_insert):
+            tags = resolve_tags(['old', 'raced', 'fresh'])
+        self.assertEqual(['old', 'raced', 'fresh'], [tag.name for tag in tags])
+        self.assertEqual(sorted(Tag.objects.values_list('id', flat=True)), sorted(tag.id for tag in tags))
+
+    def test_attach_skips_existing_links(self):
+        first, second = resolve_tags(['first', 'second'])
+        self.question.tags.add(first)
+        modified = Question.objects.get(id=self.question.id).modified
+        self.assertEqual(1, attach_tags({self.question.id: [first.id, second.id]}))
+        self.assertEqual(['first', 'second'], sorted(self.question.tags.values_list('name', flat=True)))
+        self.assertEqual([1, 1], [tag.rating for tag in Tag.objects.order_by('name')])
+        self.assertGreater(Question.objects.get(id=self.question.id).modified, modified)
+
+
+class TestAutocomplete(BaseViewTest):
+    def setUp(self):
+        super().setUp()
+        autocomplete.tags.clear()
+        for name, rating in (('python', 5), ('Pytest', 9), ('pypy', 1), ('django', 7)):
+            Tag.objects.create(name=name, rating=rating)
+        self.url = reverse('tag-autocomplete')
+
+    def names(self, **params):
+        response = self.client.get(self.url, params)
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        return [(item['name'], item['rating']) for item in response.data]
+
+    def test_prefix_ranked_by_rating(self):
+        self.assertEqual([('Pytest', 9), ('python', 5), ('pypy', 1)], self.names(q='PY'))
+        self.assertEqual([('Pytest', 9)], self.names(q='py', limit=1))
+        self.assertEqual([], self.names(q='go'))
+        self.assertEqual([], self.names(q=''))
+
+    def test_no_queries_after_build(self):
+        self.names(q='py')
+        with self.assertNumQueries(0):
+            autocomplete.tags.search('py')
+
+    def test_updated_in_place(self):
+        self.names(q='py')
+        rebuilds = autocomplete.tags.stats()['rebuilds']
+        self.login_client(self.alice_username, self.alice_password)
+        response = self.client.post(reverse('question-list'), data=json.dumps(
+            {"title": 'new', "long_text": 'how to?', "tags": ['pyramid', 'pypy']}), content_type="application/json")
+        self.assertEqual(status.HTTP_201_CREATED, response.status_code)
+        self.assertEqual([('Pytest', 9), ('python', 5), ('pypy', 2), ('pyramid', 1)], self.names(q='py'))
+        Tag.objects.get(name='pypy').delete()
+        self.assertEqual([('pyramid', 1)], self.names(q='pyr') + self.names(q='pyp'))
+        self.assertEqual(rebuilds, autocomplete.tags.stats()['rebuilds'])
+
+    def test_updated_after_commit(self):
+        """
+        Откаченный тег в индекс не попадает, закоммиченный - после коммита
+        """
+        self.names(q='py')
+        self.on_commit.stop()
+        self.addCleanup(self.on_commit.start)
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            Tag.objects.create(name='pyramid')
+            raise IntegrityError
+        Tag.objects.create(name='pyro')
+        self.assertEqual([], autocomplete.tags.search('pyr'))
+        callbacks, connection.run_on_commit = connection.run_on_commit, []
+        for _, func in callbacks:
+            func()
+        self.assertEqual([('pyro', 0)], [(name, rating) for name, _, rating in autocomplete.tags.search('pyr')])
+
+    def test_changes_during_rebuild_kept(self):
+        index = autocomplete.tags
+        index.search('py')
+        pypy = Tag.objects.get(name='pypy')
+        rows = list(index.queryset())
+
+        def scan():
+            # лайк пришел, пока перестроение читало таблицу
+            Tag.objects.filter(id=pypy.id).update(rating=4)
+            index.apply_changed(pypy.id, 3)
+            return iter(rows)
+
+        with mock.patch.object(index, 'queryset', side_effect=[mock.Mock(iterator=scan), index.queryset()]):
+            index.rebuild()
+        self.assertEqual([('pypy', pypy.id, 4)], index.search('pyp'))
+
+    def test_single_builder(self):
+        index = autocomplete.PrefixIndex('test', 'backend.Tag')
+
+        def slow_scan():
+            time.sleep(0.05)
+            return iter([('python', 1, 5)])
+
+        with mock.patch.object(index, 'queryset', return_value=mock.Mock(iterator=slow_scan)):
+            threads = [threading.Thread(target=index.search, args=('py',)) for _ in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(1, index.stats()['rebuilds'])
+
 
 class TestProfile(BaseViewTest):
     def change_profile(self, data, url):
@@ -353,6 +651,13 @@ class TestProfile(BaseViewTest):
         )
         self.assertEqual(status.HTTP_200_OK, response.status_code)
 
+    def test_bad_sort(self):
+        url = reverse('user-list')
+        response = self.client.get(url, data={"sort": "password", "limit": "10"})
+        self.assertEqual(status.HTTP_400_BAD_REQUEST, response.status_code)
+        response = self.client.get(url, data={"sort": "rating", "limit": "ten"})
+        self.assertEqual(status.HTTP_400_BAD_REQUEST, response.status_code)
+
     def test_profile(self):
         """
         Посмотреть свой профиль может только владелец или админ
@@ -401,4 +706,1051 @@ class TestProfile(BaseViewTest):
                 "username": "alice"
         }
         response = self.change_profile(data, url)
-        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
\ No newline at end of file
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class TestLike(BaseViewTest):
+    def test_toggle(self):
+        """
+        Лайк переключается и сразу возвращает новый рейтинг
+        """
+        self.assertEqual((True, 1), Like.set_like(self.question, self.bob))
+        self.assertEqual((True, 2), Like.set_like(self.question, self.user_admin))
+        self.assertEqual((False, 1), Like.set_like(self.question, self.bob))
+        self.assertEqual(1, Like.objects.count())
+
+    def test_unique(self):
+        """
+        Дубль лайка запрещен на уровне базы
+        """
+        Like.set_like(self.answer, self.alice)
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            Like.objects.create(content_object=self.answer, user=self.alice)
+
+
+class TestPagination(BaseViewTest):
+    def walk(self, url, params, backwards=False):
+        """
+        Проходит все страницы по ссылкам next (или previous), возвращает результаты и запросы
+        """
+        results = []
+        response = self.client.get(url, data=params)
+        while True:
+            self.assertEqual(status.HTTP_200_OK, response.status_code)
+            results.append([item['title'] for item in response.data['results']])
+            link = response.data['previous' if backwards else 'next']
+            if link is None:
+                return results, response
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get(link)
+            self.assertFalse([q for q in queries if 'OFFSET' in q['sql']])
+
+    def test_sorted_pages(self):
+        """
+        Курсор идет по (rating, id): все вопросы ровно по разу при любых повторах рейтинга
+        """
+        for i in range(24):
+            Question.objects.create(title=f"q{i}", long_text="opa", author_id=self.alice.id, rating=i % 3)
+        expected = [q.title for q in Question.objects.hot_questions('rating')]
+        url = reverse('question-list')
+
+        pages, last = self.walk(url, {"sort": "rating"})
+        self.assertEqual([10, 10, 5], [len(page) for page in pages])
+        self.assertEqual(expected, sum(pages, []))
+
+        pages, _ = self.walk(last.data['previous'], {}, backwards=True)
+        self.assertEqual(expected[:20], sum(reversed(pages), []))
+
+    def test_nested_pages(self):
+        for i in range(12):
+            Answer.objects.create(question_id=self.question.id, text=f"a{i}", author_id=self.bob.id)
+        url = reverse('question-answers-list', kwargs={'question_pk': self.question.pk})
+        response = self.client.get(url, data={"page_size": 5})
+        texts = [item['text'] for item in response.data['results']]
+        while response.data['next']:
+            response = self.client.get(response.data['next'])
+            texts += [item['text'] for item in response.data['results']]
+        self.assertEqual(list(Answer.objects.filter(question=self.question).values_list('text', flat=True)), texts)
+
+    def test_count(self):
+        """
+        Общее число: для таблицы - из кеша, по ?exact_count=1 - точное,
+        для вложенных списков - из счетчиков
+        """
+        url = reverse('question-list')
+        response = self.client.get(url)
+        self.assertEqual((1, False), (response.data['count'], response.data['count_exact']))
+        Question.objects.create(title="New", long_text="opa", author_id=self.alice.id)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(1, response.data['count'])
+        self.assertFalse([q for q in queries if 'COUNT' in q['sql']])
+        response = self.client.get(url, data={"exact_count": 1})
+        self.assertEqual((2, True), (response.data['count'], response.data['count_exact']))
+
+        tag = Tag.objects.create(name='tag')
+        self.question.tags.add(tag)
+        url = reverse('tag-questions-list', kwargs={'tag_pk': tag.pk})
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(1, response.data['count'])
+        self.assertFalse([q for q in queries if 'COUNT' in q['sql']])
+
+        url = reverse('question-answers-list', kwargs={'question_pk': self.question.pk})
+        response = self.client.get(url)
+        self.assertEqual(1, response.data['count'])
+
+    def test_bad_cursor(self):
+        url = reverse('question-list')
+        response = self.client.get(url, data={"cursor": "garbage"})
+        self.assertEqual(status.HTTP_404_NOT_FOUND, response.status_code)
+
+
+class TestObjectCache(BaseViewTest):
+    def test_question(self):
+        """
+        Повторная деталка вопроса - из кеша (остается только запрос версии для ETag),
+        лайк/ответ/тег ее инвалидируют
+        """
+        url = reverse('question-detail', kwargs={'pk': self.question.pk})
+        response = self.client.get(url)
+        self.assertEqual('MISS', response['X-Cache'])
+        hits = object_cache.hits
+        with self.assertNumQueries(1):
+            response = self.client.get(url)
+        self.assertEqual('HIT', response['X-Cache'])
+        self.assertEqual(hits + 1, object_cache.hits)
+
+        Like.set_like(self.question, self.bob)
+        response = self.client.get(url)
+        self.assertEqual(('MISS', 1), (response['X-Cache'], response.data['rating']))
+
+        Answer.objects.create(question_id=self.question.id, text="more", author_id=self.bob.id)
+        response = self.client.get(url)
+        self.assertEqual(('MISS', 2), (response['X-Cache'], response.data['count_answers']))
+
+        self.question.tags.add(Tag.objects.create(name='tag'))
+        response = self.client.get(url)
+        self.assertEqual(('MISS', ['tag']), (response['X-Cache'], response.data['tags']))
+        self.assertEqual('HIT', self.client.get(url)['X-Cache'])
+
+    def test_answer(self):
+        url = reverse('answer-detail', kwargs={'pk': self.answer.pk})
+        self.assertEqual('MISS', self.client.get(url)['X-Cache'])
+        self.answer.mark_as_right()
+        self.answer.save()
+        response = self.client.get(url)
+        self.assertEqual(('MISS', True), (response['X-Cache'], response.data['right_answer']))
+
+    def test_invalidated_after_commit(self):
+        """
+        Версия растет только после коммита: до него запрос прочитал бы старую строку
+        """
+        self.on_commit.stop()
+        self.addCleanup(self.on_commit.start)
+        version = object_cache.get_version(Question, self.question.id)
+        Like.set_like(self.question, self.bob)
+        self.assertEqual(version, object_cache.get_version(Question, self.question.id))
+        callbacks, connection.run_on_commit = connection.run_on_commit, []
+        for _, func in callbacks:
+            func()
+        self.assertLess(version, object_cache.get_version(Question, self.question.id))
+
+    def test_author_renamed(self):
+        question_url = reverse('question-detail', kwargs={'pk': self.question.pk})
+        answer_url = reverse('answer-detail', kwargs={'pk': self.answer.pk})
+        self.client.get(question_url)
+        self.client.get(answer_url)
+        self.alice.username = 'alice2'
+        self.alice.save()
+        self.bob.username = 'bob2'
+        self.bob.save()
+        response = self.client.get(question_url)
+        self.assertEqual(('MISS', 'alice2'), (response['X-Cache'], response.data['author']))
+        response = self.client.get(answer_url)
+        self.assertEqual(('MISS', 'bob2'), (response['X-Cache'], response.data['author']))
+
+
+class TestPageCache(BaseViewTest):
+    def test_questions(self):
+        """
+        Анонимный список - из кеша, новый вопрос или лайк меняет поколение
+        """
+        url = reverse('question-list')
+        self.assertEqual('MISS', self.client.get(url, data={"sort": "rating"})['X-Cache'])
+        with self.assertNumQueries(0):
+            response = self.client.get(url, data={"sort": "rating"})
+        self.assertEqual('HIT', response['X-Cache'])
+        self.assertEqual('MISS', self.client.get(url, data={"sort": "created"})['X-Cache'])
+
+        Question.objects.create(title="New", long_text="opa", author_id=self.alice.id)
+        response = self.client.get(url, data={"sort": "rating"})
+        self.assertEqual(('MISS', 2), (response['X-Cache'], len(response.data['results'])))
+
+        Like.set_like(self.question, self.bob)
+        response = self.client.get(url, data={"sort": "rating"})
+        self.assertEqual(('MISS', 1), (response['X-Cache'], response.data['results'][0]['rating']))
+
+    def test_stale_while_revalidate(self):
+        """
+        Пока страницу перестраивает один запрос, остальные получают старую
+        """
+        url = reverse('tag-list')
+        self.client.get(url)
+        Tag.objects.create(name='tag')
+        key = page_cache.key('http://testserver' + url)
+        cache.add(key + ':lock', 1)
+        with self.assertNumQueries(0):
+            response = self.client.get(url)
+        self.assertEqual(('STALE', []), (response['X-Cache'], response.data['results']))
+        cache.delete(key + ':lock')
+        response = self.client.get(url)
+        self.assertEqual(('MISS', 1), (response['X-Cache'], len(response.data['results'])))
+
+    def test_wait_capped(self):
+        """
+        Если страницы нет, а чужая сборка затянулась, запрос строит ее сам и в кеш не кладет
+        """
+        url = reverse('tag-list')
+        key = page_cache.key('http://testserver' + url)
+        cache.add(key + ':lock', 1)
+        response = self.client.get(url)
+        self.assertEqual('MISS', response['X-Cache'])
+        self.assertIsNone(cache.get(key))
+        self.assertEqual(1, cache.get(key + ':lock'))
+
+    def test_author_renamed(self):
+        url = reverse('question-list')
+        self.client.get(url)
+        self.alice.username = 'alice2'
+        self.alice.save()
+        response = self.client.get(url)
+        self.assertEqual(('MISS', 'alice2'), (response['X-Cache'], response.data['results'][0]['author']))
+
+    def test_authenticated(self):
+        self.login_client(self.bob_username, self.bob_password)
+        response = self.client.get(reverse('question-list'))
+        self.assertFalse(response.has_header('X-Cache'))
+
+
+class TestConditionalGet(BaseViewTest):
+    def assertNotModified(self, url, etag):
+        with self.assertNumQueries(1):
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(status.HTTP_304_NOT_MODIFIED, response.status_code)
+
+    def test_question(self):
+        """
+        Неизменившийся вопрос - 304 одним запросом, лайк меняет ETag
+        """
+        url = reverse('question-detail', kwargs={'pk': self.question.pk})
+        response = self.client.get(url)
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        self.assertTrue(response.has_header('Last-Modified'))
+        etag = response['ETag']
+        self.assertNotModified(url, etag)
+
+        Like.set_like(self.question, self.bob)
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        self.assertNotEqual(etag, response['ETag'])
+
+    def test_answers(self):
+        """
+        Список ответов меняет ETag при лайке и пометке ответа
+        """
+        url = reverse('question-answers-list', kwargs={'question_pk': self.question.pk})
+        etag = self.client.get(url)['ETag']
+        self.assertNotModified(url, etag)
+
+        Like.set_like(self.answer, self.alice)
+        new_etag = self.client.get(url)['ETag']
+        self.assertNotEqual(etag, new_etag)
+
+        self.answer.mark_as_right()
+        self.answer.save()
+        self.assertNotEqual(new_etag, self.client.get(url)['ETag'])
+
+    def test_author_renamed(self):
+        """
+        Новое имя автора вопроса или ответа меняет ETag, а не отдает 304 со старым
+        """
+        urls = [reverse('question-detail', kwargs={'pk': self.question.pk}),
+                reverse('question-answers-list', kwargs={'question_pk': self.question.pk})]
+        etags = [self.client.get(url)['ETag'] for url in urls]
+        for user, name in ((self.alice, 'alice2'), (self.bob, 'bob2')):
+            user.username = name
+            user.save()
+            for i, url in enumerate(urls):
+                response = self.client.get(url, HTTP_IF_NONE_MATCH=etags[i])
+                self.assertEqual(status.HTTP_200_OK, response.status_code)
+                self.assertNotEqual(etags[i], response['ETag'])
+                etags[i] = response['ETag']
+
+
+class TestQueryBudget(BaseViewTest):
+    """
+    Число запросов списка не зависит от числа строк на странице
+    """
+    def setUp(self):
+        super().setUp()
+        self.tag = Tag.objects.create(name='tag')
+        for i in range(3):
+            author = User.objects.create_user(f'author{i}', None, 'password')
+            question = Question.objects.create(title=f'q{i}', long_text='text', author=author)
+            question.tags.add(self.tag, Tag.objects.create(name=f'tag{i}'))
+            for j in range(3):
+                Answer.objects.create(question=question, text=f'a{j}', author=author)
+
+    def test_lists(self):
+        endpoints = [
+            (reverse('question-list'), {}, 4),
+            (reverse('question-list'), {'sort': 'hot'}, 4),
+            (reverse('tag-questions-list', kwargs={'tag_pk': self.tag.id}), {}, 5),
+            (reverse('answer-list'), {}, 3),
+            (reverse('question-answers-list', kwargs={'question_pk': self.question.id}), {}, 4),
+            (reverse('user-list'), {}, 2),
+            (reverse('user-list'), {'sort': 'rating', 'limit': 5}, 1),
+            (reverse('user-questions-list', kwargs={'author_pk': self.alice.id}), {}, 4),
+            (reverse('user-answers-list', kwargs={'author_pk': self.bob.id}), {}, 3),
+            (reverse('tag-list'), {}, 2),
+        ]
+        for url, params, limit in endpoints:
+            with self.subTest(url=url, params=params):
+                cache.clear()
+                with self.assertMaxQueries(limit):
+                    response = self.client.get(url, data=params)
+                self.assertEqual(status.HTTP_200_OK, response.status_code)
+                self.assertTrue(response.data['results'])
+
+    def test_user_links(self):
+        """
+        Вопросы и ответы пользователя - ссылками на списки автора, план без prefetch
+        """
+        self.assertEqual((), UserListView().get_query_plan().prefetch_related)
+        response = self.client.get(reverse('user-list'), data={'sort': 'rating', 'limit': 20})
+        alice = next(user for user in response.data['results'] if user['username'] == 'alice')
+        self.assertEqual(reverse('user-questions-list', kwargs={'author_pk': self.alice.id}),
+                         alice['questions'].split('testserver')[1])
+        response = self.client.get(alice['questions'])
+        self.assertEqual([self.question.title], [question['title'] for question in response.data['results']])
+        response = self.client.get(alice['answers'])
+        self.assertEqual([], response.data['results'])
+        response = self.client.get(reverse('user-answers-list', kwargs={'author_pk': self.bob.id}))
+        self.assertEqual([self.answer.text], [answer['text'] for answer in response.data['results']])
+
+
+class TestLeaderboard(BaseViewTest):
+    def test_users(self):
+        """
+        Топ пользователей отдается из кеша и обновляется лайками
+        """
+        rebuilds = leaderboard.users.rebuilds
+        self.assertEqual([self.bob, self.alice, self.user_admin], leaderboard.users.top(10))
+        self.assertEqual(rebuilds + 1, leaderboard.users.rebuilds)
+
+        Like.set_like(self.answer, self.alice)
+        Like.set_like(self.answer, self.user_admin)
+        with self.assertNumQueries(0):
+            top = leaderboard.users.top(2)
+        self.assertEqual([(self.bob.id, 2), (self.alice.id, 0)], [(user.id, user.rating) for user in top])
+
+        url = reverse('user-list')
+        response = self.client.get(url, data={"sort": "rating", "limit": "1"})
+        self.assertEqual(rebuilds + 1, leaderboard.users.rebuilds)
+        self.assertEqual('bob', response.data['results'][0]['username'])
+
+    def test_tags(self):
+        """
+        Топ тегов учитывает новые теги
+        """
+        self.assertEqual([], leaderboard.tags.top(10))
+        tag = Tag.objects.create(name='tag')
+        self.question.tags.add(tag)
+        self.assertEqual([tag], leaderboard.tags.top(10))
+        self.assertEqual(1, leaderboard.tags.top(10)[0].rating)
+
+    def test_only_listed_fields_cached(self):
+        leaderboard.users.top(10)
+        rows = cache.get(leaderboard.users.key(leaderboard.users.generation()))
+        self.assertEqual({'id', 'username', 'rating'}, set(rows[0]))
+
+    def test_growth_outside_top(self):
+        """
+        Рост объекта вне полного топа сбрасывает его, только если объект обогнал последнего
+        """
+        board = leaderboard.Leaderboard('test_users', 'backend.User', ('username',), size=2)
+        User.objects.filter(id=self.bob.id).update(rating=5)
+        User.objects.filter(id=self.alice.id).update(rating=3)
+        board.top(2)
+        User.objects.filter(id=self.user_admin.id).update(rating=2)
+        board.changed(self.user_admin.id, 2)
+        with self.assertNumQueries(0):
+            board.top(2)
+        User.objects.filter(id=self.user_admin.id).update(rating=4)
+        board.changed(self.user_admin.id, 2)
+        self.assertEqual([self.bob, self.user_admin], board.top(2))
+
+    def test_update_without_lock_invalidates(self):
+        board = leaderboard.Leaderboard('test_tags', 'backend.Tag', ('name',))
+        tag = Tag.objects.create(name='tag')
+        board.top(10)
+        cache.add(board.lock_key, 1)
+        Tag.objects.filter(id=tag.id).update(rating=1)
+        board.changed(tag.id, 1)
+        cache.delete(board.lock_key)
+        rebuilds = board.rebuilds
+        self.assertEqual(1, board.top(10)[0].rating)
+        self.assertEqual(rebuilds + 1, board.rebuilds)
+
+
+@override_settings(PROFILING={'SAMPLE_RATE': 1.0})
+class TestMetrics(BaseViewTest):
+    def test_request_profile(self):
+        """
+        Запрос попадает в гистограммы своего маршрута
+        """
+        labels = (('view', 'question-list'), ('method', 'GET'))
+        before = metrics.request_queries.series.get(labels, [None, 0, 0])[2]
+        self.client.get(reverse('question-list'))
+        series = metrics.request_queries.series[labels]
+        self.assertEqual(before + 1, series[2])
+        self.assertGreater(series[1], 0)
+        self.assertIn(labels + (('status', 200),), metrics.requests_total.values)
+
+    def test_duplicates(self):
+        with metrics.profiling() as profile, connection.execute_wrapper(profile.execute):
+            User.objects.get(pk=self.alice.id)
+            User.objects.get(pk=self.alice.id)
+            User.objects.get(pk=self.bob.id)
+        self.assertEqual(3, profile.queries)
+        self.assertEqual(1, profile.duplicates)
+
+    def test_endpoint(self):
+        """
+        /metrics - только админу, в текстовом формате Prometheus
+        """
+        url = reverse('metrics')
+        self.assertEqual(status.HTTP_401_UNAUTHORIZED, self.client.get(url).status_code)
+        self.login_client(self.alice_username, self.alice_password)
+        self.assertEqual(status.HTTP_403_FORBIDDEN, self.client.get(url).status_code)
+
+        self.login_client(self.admin_username, self.admin_password)
+        response = self.client.get(url)
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        self.assertTrue(response['Content-Type'].startswith('text/plain'))
+        body = response.content.decode('utf-8')
+        self.assertIn('# TYPE blog_request_duration_seconds histogram', body)
+        self.assertIn('blog_request_queries_bucket{view="login",method="POST",le="+Inf"}', body)
+
+
+class TestQueryLog(BaseViewTest):
+    def test_serializer_field(self):
+        """
+        Ленивая загрузка автора в сериализаторе - N+1 с указанием поля
+        """
+        for name in ('carol', 'dave'):
+            author = User.objects.create_user(name, None, 'password')
+            Answer.objects.create(question=self.question, text='text', author=author)
+        context = {'request': Request(APIRequestFactory().get('/'))}
+        with metrics.profiling() as profile, connection.execute_wrapper(profile.execute):
+            AnswerSerializer(Answer.objects.all(), many=True, context=context).data
+        user_shapes = [shape for shape in profile.shapes.values() if 'FROM "backend_user"' in shape.shape]
+        self.assertEqual(1, len(user_shapes))
+        self.assertEqual(3, user_shapes[0].count)
+        self.assertIn('AnswerSerializer.author', [site.get('field') for site in user_shapes[0].sites])
+
+    def test_attribution_capped(self):
+        """
+        Стек обходится не на каждый повтор N+1, а не больше MAX_SITES раз на форму
+        """
+        with metrics.profiling() as profile, connection.execute_wrapper(profile.execute), \
+                mock.patch.object(querylog, 'attribute', wraps=querylog.attribute) as attribute:
+            for _ in range(20):
+                User.objects.get(pk=self.alice.id)
+        self.assertEqual(querylog.MAX_SITES, attribute.call_count)
+        self.assertEqual(1, len(profile.shapes))
+
+    def test_default_sample_rate(self):
+        with self.settings(PROFILING={}):
+            self.assertLess(metrics.get_settings()['SAMPLE_RATE'], 1)
+
+    @override_settings(PROFILING={'SAMPLE_RATE': 1.0, 'SLOW_QUERY_MS': 0})
+    def test_report(self):
+        """
+        Медленные запросы ответа уходят в лог JSON с получателем сигнала
+        """
+        url = reverse('question-set-like', kwargs={'pk': self.question.id})
+        with self.assertLogs('backend.querylog', 'WARNING') as logs:
+            self.login_client(self.bob_username, self.bob_password)
+            self.client.put(url)
+        report = json.loads(logs.records[-1].getMessage())
+        self.assertEqual('question-set-like', report['view'])
+        self.assertEqual('PUT', report['method'])
+        receivers = {site.get('receiver') for shape in report['flagged'] for site in shape['sites']}
+        self.assertIn('backend.models.up_rating', receivers)
+
+
+class TestFastJSON(BaseViewTest):
+    def test_same_output(self):
+        """
+        Вывод совпадает с JSONRenderer DRF байт в байт
+        """
+        Question.objects.create(title='Вопрос \u2028 "в кавычках"', long_text='</script>', author=self.bob)
+        response = self.client.get(reverse('question-list'))
+        self.assertEqual(JSONRenderer().render(response.data), response.content)
+
+        data = {
+            'created': timezone.now(), 'score': Decimal('1.5'), 'items': [1, None, True, {}, []],
+            'floats': [0.1, -2.25, 123456.789, 3.0], 'ints': [2 ** 63 - 1, -2 ** 63],
+            'text': 'a/b "q" \\ \t\n\x01 ж \u2029 😀 </script>',
+        }
+        for backend in jsonlib.LOADERS:
+            name, dumps, loads = jsonlib.load_backend([backend])
+            with self.subTest(backend=name), mock.patch.multiple(jsonlib, name=name, dumps=dumps, loads=loads):
+                self.assertEqual(JSONRenderer().render(response.data), FastJSONRenderer().render(response.data))
+                self.assertEqual(JSONRenderer().render(data), FastJSONRenderer().render(data))
+                self.assertEqual(JSONRenderer().render(data, 'application/json; indent=4'),
+                                 FastJSONRenderer().render(data, 'application/json; indent=4'))
+
+    def test_nan(self):
+        """
+        NaN не кодируется ни одной библиотекой, кроме orjson (он пишет null)
+        """
+        for backend in jsonlib.LOADERS:
+            name, dumps, loads = jsonlib.load_backend([backend])
+            with self.subTest(backend=name), mock.patch.multiple(jsonlib, name=name, dumps=dumps, loads=loads):
+                if name == 'orjson':
+                    self.assertEqual(b'[null]', FastJSONRenderer().render([float('nan')]))
+                else:
+                    with self.assertRaises(ValueError):
+                        FastJSONRenderer().render([float('nan')])
+
+    def test_stream(self):
+        items = [{'id': i, 'name': f'имя {i}'} for i in range(5)]
+        renderer = FastJSONRenderer()
+        self.assertEqual(JSONRenderer().render(items), b''.join(renderer.stream(items, chunk_size=2)))
+        self.assertEqual(b'[]', b''.join(renderer.stream([])))
+
+    def test_parser(self):
+        parser = FastJSONParser()
+        self.assertEqual({'name': 'ж', 'tags': [1]}, parser.parse(io.BytesIO('{"name": "ж", "tags": [1]}'.encode())))
+        with self.assertRaises(ParseError):
+            parser.parse(io.BytesIO(b'{"name": '))
+
+
+class TestReadSerializers(BaseViewTest):
+    def test_same_output(self):
+        """
+        Списки через сериализаторы строк .values() совпадают с обычными байт в байт
+        """
+        tags = [Tag.objects.create(name=name) for name in ('b', 'a', 'c')]
+        long_question = Question.objects.create(title='Long', long_text='x' * 150, author=self.bob)
+        long_question.tags.add(tags[2], tags[0])
+        self.question.tags.add(*tags)
+        Answer.objects.create(question=long_question, text='answer', author=self.alice, right_answer=True)
+        urls = [
+            (reverse('question-list'), {}),
+            (reverse('question-list'), {'sort': 'hot'}),
+            (reverse('question-list'), {'page_size': 1}),
+            (reverse('tag-questions-list', kwargs={'tag_pk': tags[0].id}), {}),
+            (reverse('answer-list'), {}),
+            (reverse('question-answers-list', kwargs={'question_pk': self.question.id}), {}),
+            (reverse('tag-list'), {}),
+            (reverse('tag-list'), {'sort': 'rating', 'limit': 2}),
+        ]
+        views = (QuestionViewSet, AnswerViewSet, TagViewSet)
+        for url, params in urls:
+            with self.subTest(url=url, params=params):
+                cache.clear()
+                fast = self.client.get(url, data=params)
+                cache.clear()
+                with mock.patch.multiple(QuestionViewSet, read_serializer_class=None), \
+                        mock.patch.multiple(AnswerViewSet, read_serializer_class=None), \
+                        mock.patch.multiple(TagViewSet, read_serializer_class=None):
+                    slow = self.client.get(url, data=params)
+                self.assertEqual(status.HTTP_200_OK, fast.status_code)
+                self.assertEqual(slow.content, fast.content)
+        self.assertTrue(all(view.read_serializer_class for view in views))
+
+
+class TestExport(BaseViewTest):
+    def export(self, url, **params):
+        response = self.client.get(url, data=params)
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        self.assertTrue(response.streaming)
+        return b''.join(response.streaming_content).decode('utf-8')
+
+    def test_permissions(self):
+        url = reverse('question-export')
+        self.assertEqual(status.HTTP_401_UNAUTHORIZED, self.client.get(url).status_code)
+        self.login_client(self.alice_username, self.alice_password)
+        self.assertEqual(status.HTTP_403_FORBIDDEN, self.client.get(url).status_code)
+
+    def test_ndjson(self):
+        """
+        Строки выгрузки - те же объекты, что и в списке
+        """
+        tag = Tag.objects.create(name='tag')
+        question = Question.objects.create(title='Second', long_text='text', author=self.bob)
+        question.tags.add(tag)
+        listed = self.client.get(reverse('question-list')).data['results']
+
+        self.login_client(self.admin_username, self.admin_password)
+        with mock.patch.object(QuestionViewSet, 'export_chunk_size', 1):
+            lines = self.export(reverse('question-export')).splitlines()
+        self.assertEqual(list(reversed(listed)), [json.loads(line) for line in lines])
+
+        answers = self.export(reverse('question-answers-export', kwargs={'question_pk': self.question.id}))
+        self.assertEqual(['how are you'], [json.loads(line)['text'] for line in answers.splitlines()])
+
+    def test_csv(self):
+        tag = Tag.objects.create(name='tag')
+        self.question.tags.add(tag, Tag.objects.create(name='other'))
+        self.login_client(self.admin_username, self.admin_password)
+        rows = list(csv.reader(io.StringIO(self.export(reverse('question-export'), format='csv'))))
+        self.assertEqual(['url', 'title', 'long_text', 'author', 'rating', 'answers', 'tags', 'short_text',
+                          'count_answers'], rows[0])
+        self.assertEqual(2, len(rows))
+        self.assertEqual(['How to', 'alice', 'tag,other', '1'], [rows[1][1], rows[1][3], rows[1][6], rows[1][8]])
+
+        rows = list(csv.reader(io.StringIO(self.export(reverse('answer-export'), format='csv'))))
+        self.assertEqual('false', rows[1][rows[0].index('right_answer')])
+
+    def test_since(self):
+        Question.objects.filter(pk=self.question.id).update(created=timezone.now() - timedelta(days=10))
+        Question.objects.create(title='New', long_text='text', author=self.bob)
+        self.login_client(self.admin_username, self.admin_password)
+        url = reverse('question-export')
+        since = (timezone.now() - timedelta(days=1)).isoformat()
+        self.assertEqual(['New'], [json.loads(line)['title'] for line in self.export(url, since=since).splitlines()])
+        self.assertEqual(2, len(self.export(url, since='2000-01-01').splitlines()))
+        self.assertEqual(status.HTTP_400_BAD_REQUEST, self.client.get(url, data={'since': 'yesterday'}).status_code)
+
+
+class TestGenerateData(APITestCase):
+    def test_counters_match_rows(self):
+        out = StringIO()
+        call_command('generate_data', stdout=out, users=5, tags=4, questions=6, answers=10, likes=15,
+                     workers=2, chunk_size=3)
+        self.assertEqual(
+            [User.objects.count(), Tag.objects.count(), Question.objects.count(), Answer.objects.count()],
+            [5, 4, 6, 10])
+        self.assertEqual(Like.objects.count(), 15)
+        self.assertIn('строк/с', out.getvalue())
+        for question in Question.objects.all():
+            self.assertEqual(question.count_answers, question.answers.count())
+            self.assertEqual(question.rating, question.likes.count())
+            self.assertTrue(1 <= question.tags.count() <= 4)
+            self.assertTrue(len(question.title) <= 50)
+        for answer in Answer.objects.all():
+            self.assertEqual(answer.rating, answer.likes.count())
+        for tag in Tag.objects.all():
+            self.assertEqual(tag.rating, tag.questions.count())
+        for user in User.objects.all():
+            ratings = [obj.rating for obj in list(user.questions.all()) + list(user.answers.all())]
+            self.assertEqual(user.rating, sum(ratings))
+
+    @staticmethod
+    def snapshot():
+        return sorted(Answer.objects.values_list('text', 'author__username', 'question__title'))
+
+    def test_same_seed_same_data(self):
+        options = dict(users=4, tags=3, questions=5, answers=8, likes=6, seed=11, chunk_size=3)
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            call_command('generate_data', stdout=StringIO(), workers=1, **options)
+            first = self.snapshot()
+            raise IntegrityError
+        call_command('generate_data', stdout=StringIO(), workers=2, **options)
+        self.assertEqual(self.snapshot(), first)
+
+    def test_append_same_seed(self):
+        """
+        Повторный запуск с тем же seed дописывает данные, а не падает на уникальных именах
+        """
+        options = dict(users=4, tags=3, questions=5, answers=8, likes=6, seed=11, workers=1)
+        call_command('generate_data', stdout=StringIO(), **options)
+        call_command('generate_data', stdout=StringIO(), **options)
+        self.assertEqual([User.objects.count(), Tag.objects.count(), Question.objects.count()], [8, 6, 10])
+
+    def test_resume_from_checkpoint(self):
+        path = os.path.join(tempfile.mkdtemp(), 'checkpoint.json')
+        save_answers, calls = GenerateData.save_answers, []
+
+        def crash_on_second_chunk(rows, **context):
+            calls.append(rows)
+            if len(calls) == 2:
+                raise RuntimeError
+            return save_answers(rows, **context)
+
+        with mock.patch.object(GenerateData, 'save_answers', staticmethod(crash_on_second_chunk)), \
+                self.assertRaises(RuntimeError):
+            call_command('generate_data', stdout=StringIO(), users=4, tags=3, questions=5, answers=8, likes=6,
+                         workers=1, chunk_size=3, checkpoint=path)
+        self.assertEqual(Answer.objects.count(), 3)
+        out = StringIO()
+        call_command('generate_data', stdout=out, workers=1, checkpoint=path)
+        self.assertIn('Продолжение', out.getvalue())
+        self.assertNotIn('Пользователи', out.getvalue())
+        self.assertEqual([User.objects.count(), Answer.objects.count(), Like.objects.count()], [4, 8, 6])
+        self.assertFalse(os.path.exists(path))
+
+
+class TestReconcileCounters(BaseViewTest):
+    def setUp(self):
+        super().setUp()
+        self.tag = Tag.objects.create(name='tag')
+        self.question.tags.add(self.tag)
+        Like.set_like(self.answer, self.alice)
+        self.old_question = Question.objects.create(title="Old", long_text="opa", author_id=self.bob.id)
+
+    def drift(self):
+        Question.objects.filter(id=self.question.id).update(count_answers=5, rating=3)
+        Question.objects.filter(id=self.old_question.id).update(count_answers=2, modified=timezone.now() - timedelta(days=2))
+        Answer.objects.filter(id=self.answer.id).update(rating=4)
+        Tag.objects.filter(id=self.tag.id).update(rating=7)
+        User.objects.filter(id=self.bob.id).update(rating=9)
+
+    def counters(self):
+        return [
+            list(Question.objects.order_by('id').values_list('count_answers', 'rating')),
+            Answer.objects.get(id=self.answer.id).rating,
+            Tag.objects.get(id=self.tag.id).rating,
+            User.objects.get(id=self.bob.id).rating,
+        ]
+
+    def test_dry_run_reports_without_changes(self):
+        self.drift()
+        before = self.counters()
+        out = StringIO()
+        call_command('reconcile_counters', dry_run=True, stdout=out)
+        self.assertEqual(before, self.counters())
+        self.assertIn(f'Question.count_answers id={self.question.id}: 5 -> 1', out.getvalue())
+        self.assertIn('Tag.rating: проверено 1, найдено расхождений 1, сумма отклонений 6', out.getvalue())
+
+    def test_full_run_fixes_all(self):
+        self.drift()
+        call_command('reconcile_counters', batch_size=1, stdout=StringIO())
+        self.assertEqual([[(1, 0), (0, 0)], 1, 1, 1], self.counters())
+        question = Question.objects.get(id=self.question.id)
+        self.assertAlmostEqual(question.hot_score, hot_score(0, 1, question.created))
+
+    def test_incremental_run_skips_old_rows(self):
+        self.drift()
+        call_command('reconcile_counters', hours=1, stdout=StringIO())
+        self.assertEqual([[(1, 0), (2, 0)], 1, 1, 1], self.counters())
+
+    def test_delete_keeps_counters(self):
+        """
+        Удаление вопроса с лайкнутыми вопросом и ответом не оставляет расхождений у автора и тегов,
+        которые прогон по --hours уже не нашел бы
+        """
+        Like.set_like(self.question, self.bob)
+        self.question.delete()
+        out = StringIO()
+        call_command('reconcile_counters', dry_run=True, stdout=out)
+        self.assertNotIn('id=', out.getvalue())
+        self.assertEqual([0, 0], [User.objects.get(id=self.bob.id).rating, Tag.objects.get(id=self.tag.id).rating])
+
+
+class BrokenRatingStore:
+    def add(self, key, delta):
+        raise ConnectionError('store is down')
+
+    def pending(self, key):
+        raise ConnectionError('store is down')
+
+
+@override_settings(RATING_BUFFER={'DURABILITY': 'buffered', 'FLUSH_INTERVAL': 3600})
+class TestRatingBuffer(BaseViewTest):
+    def test_flush(self):
+        """
+        В режиме buffered лайк копится в буфере и попадает в базу при сбросе
+        """
+        self.assertEqual((True, 1), Like.set_like(self.question, self.bob))
+        self.assertEqual((True, 1), Like.set_like(self.answer, self.alice))
+        self.question.refresh_from_db()
+        self.assertEqual(0, self.question.rating)
+
+        self.assertEqual(2, get_aggregator().flush())
+        self.question.refresh_from_db()
+        self.answer.refresh_from_db()
+        self.alice.refresh_from_db()
+        self.bob.refresh_from_db()
+        self.assertEqual(1, self.question.rating)
+        self.assertEqual(1, self.answer.rating)
+        self.assertEqual(1, self.alice.rating)
+        self.assertEqual(1, self.bob.rating)
+
+    def test_failed_flush_keeps_deltas(self):
+        Like.set_like(self.question, self.bob)
+        with mock.patch('backend.rating.apply_deltas', side_effect=DatabaseError), \
+                self.assertRaises(DatabaseError):
+            get_aggregator().flush()
+        self.assertEqual(1, get_aggregator().pending(Question, self.question.id))
+        self.assertEqual(1, get_aggregator().flush())
+        self.question.refresh_from_db()
+        self.assertEqual(1, self.question.rating)
+
+    def test_fallback(self):
+        """
+        Недоступный буфер - пишем в базу синхронно
+        """
+        with mock.patch.object(get_aggregator(), 'store', BrokenRatingStore()), \
+                self.assertLogs('backend.rating', 'ERROR'):
+            Like.set_like(self.question, self.bob)
+        self.question.refresh_from_db()
+        self.assertEqual(1, self.question.rating)
+
+
+class TestConcurrentLikes(TransactionTestCase):
+    """
+    Параллельные лайки не теряют обновлений рейтинга
+    """
+    THREADS = 8
+
+    def setUp(self):
+        cache.clear()
+        self.author = User.objects.create_user("author", None, "1234412f")
+        self.users = [User.objects.create_user(f"user_{i}", None, "1234412f") for i in range(self.THREADS)]
+        self.question = Question.objects.create(title="How to", long_text="opa", author_id=self.author.id)
+        self.answer = Answer.objects.create(question_id=self.question.id, text="how are you", author_id=self.author.id)
+
+    def like_concurrently(self, obj):
+        barrier = threading.Barrier(self.THREADS)
+        errors = []
+
+        def worker(user):
+            try:
+                barrier.wait()
+                Like.set_like(obj, user)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=worker, args=(user,)) for user in self.users]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual([], errors)
+
+    def test_question_likes(self):
+        self.like_concurrently(self.question)
+        self.question.refresh_from_db()
+        self.author.refresh_from_db()
+        self.assertEqual(self.THREADS, self.question.rating)
+        self.assertEqual(self.THREADS, self.author.rating)
+
+    def test_answer_likes(self):
+        self.like_concurrently(self.answer)
+        self.answer.refresh_from_db()
+        self.author.refresh_from_db()
+        self.assertEqual(self.THREADS, self.answer.rating)
+        self.assertEqual(self.THREADS, self.author.rating)
+
+
+PERF_BASELINE = os.path.join(os.path.dirname(__file__), 'perf_baseline.json')
+PERF_DATA = {'users': 50, 'tags': 30, 'questions': 200, 'answers': 600, 'likes': 400}
+PERF_SCALE = float(os.environ.get('PERF_SCALE', 1))
+PERF_SEED = int(os.environ.get('PERF_SEED', 1))
+PERF_REPEAT = int(os.environ.get('PERF_REPEAT', 20))
+PERF_TOLERANCE = float(os.environ.get('PERF_TOLERANCE', 3))
+PERF_SLACK_MS = float(os.environ.get('PERF_SLACK_MS', 20))
+
+
+def percentile(samples, share):
+    ordered = sorted(samples)
+    return ordered[max(0, math.ceil(share * len(ordered)) - 1)]
+
+
+def registered_routes(patterns=None):
+    """
+    Имена всех маршрутов blog/urls.py и backend/urls.py (админка - не наша)
+    """
+    routes = set()
+    for pattern in get_resolver().url_patterns if patterns is None else patterns:
+        if hasattr(pattern, 'url_patterns'):
+            if pattern.app_name != 'admin':
+                routes |= registered_routes(pattern.url_patterns)
+        else:
+            routes.add(pattern.name or '/' + str(pattern.pattern))
+    return routes
+
+
+@override_settings(PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'])
+class TestPerformanceBudget(APITestCase):
+    """
+    Бюджет каждого маршрута на данных generate_data: число запросов, время SQL и p50/p95
+    ответа не больше зафиксированных в perf_baseline.json. Кеш очищается перед каждым
+    запросом - меряется холодный путь. По умолчанию проверяется только число запросов,
+    время - с PERF_TIMINGS=1 (на общем CI оно плавает). PERF_SCALE и PERF_SEED меняют данные,
+    PERF_REPEAT - число повторов, PERF_UPDATE_BASELINE=1 перезаписывает базовую линию вместо проверки
+    """
+    @classmethod
+    def setUpTestData(cls):
+        cache.clear()
+        autocomplete.tags.clear()
+        cls.counts = {key: max(1, int(count * PERF_SCALE)) for key, count in PERF_DATA.items()}
+        call_command('generate_data', stdout=StringIO(), workers=1, seed=PERF_SEED, **cls.counts)
+        cls.admin = User.objects.create_superuser('perf_admin', None, 'password')
+        cls.user = User.objects.create_user('perf_user', None, 'password')
+        cls.question = Question.objects.order_by('-count_answers', 'id').first()
+        cls.answer = cls.question.answers.order_by('id').first()
+        cls.tag = Tag.objects.order_by('-rating', 'id').first()
+        cls.tag_question = cls.tag.questions.order_by('id').first()
+
+    def endpoints(self):
+        """
+        (метка, маршрут, метод, kwargs адреса, параметры или тело, кто запрашивает)
+        """
+        question, answer, tag = {'pk': self.question.id}, {'pk': self.answer.id}, {'tag_pk': self.tag.id}
+        nested_answer = {'question_pk': self.question.id, 'pk': self.answer.id}
+        tag_question = {'tag_pk': self.tag.id, 'pk': self.tag_question.id}
+        login = {'username': 'perf_user', 'password': 'password'}
+        return [
+            ('api-root', '/', 'get', {}, {}, None),
+            ('question-list', 'question-list', 'get', {}, {}, None),
+            ('question-list?sort=hot', 'question-list', 'get', {}, {'sort': 'hot'}, None),
+            ('question-detail', 'question-detail', 'get', question, {}, None),
+            ('question-set-like', 'question-set-like', 'put', question, {}, self.user),
+            ('answer-list', 'answer-list', 'get', {}, {}, None),
+            ('answer-detail', 'answer-detail', 'get', answer, {}, None),
+            ('answer-mark-as-right', 'answer-mark-as-right', 'put', answer, {}, self.admin),
+            ('answer-set-like', 'answer-set-like', 'put', answer, {}, self.user),
+            ('tag-list', 'tag-list', 'get', {}, {}, None),
+            ('tag-list?sort=rating', 'tag-list', 'get', {}, {'sort': 'rating', 'limit': 10}, None),
+            ('tag-detail', 'tag-detail', 'get', {'pk': self.tag.id}, {}, None),
+            ('tag-autocomplete', 'tag-autocomplete', 'get', {}, {'q': self.tag.name[:2]}, None),
+            ('question-answers-list', 'question-answers-list', 'get', {'question_pk': self.question.id}, {}, None),
+            ('question-answers-detail', 'question-answers-detail', 'get', nested_answer, {}, None),
+            ('question-answers-mark-as-right', 'question-answers-mark-as-right', 'put', nested_answer, {}, self.admin),
+            ('question-answers-set-like', 'question-answers-set-like', 'put', nested_answer, {}, self.user),
+            ('tag-questions-list', 'tag-questions-list', 'get', tag, {}, None),
+            ('tag-questions-detail', 'tag-questions-detail', 'get', tag_question, {}, None),
+            ('tag-questions-set-like', 'tag-questions-set-like', 'put', tag_question, {}, self.user),
+            ('user-profile', 'user-profile', 'get', {'pk': self.user.id}, {}, self.user),
+            ('user-list', 'user-list', 'get', {}, {}, None),
+            ('user-list?sort=rating', 'user-list', 'get', {}, {'sort': 'rating', 'limit': 10}, None),
+            ('user-questions-list', 'user-questions-list', 'get', {'author_pk': self.question.author_id}, {}, None),
+            ('user-answers-list', 'user-answers-list', 'get', {'author_pk': self.answer.author_id}, {}, None),
+            ('register', 'register', 'post', {}, lambda i: {'username': f'perf_new_{i}', 'password': 'password'}, None),
+            ('login', 'login', 'post', {}, login, None),
+            ('logout', 'logout', 'post', {}, {}, 'token'),
+            ('debug_logout', 'debug_logout', 'get', {}, {}, None),
+            ('metrics', 'metrics', 'get', {}, {}, self.admin),
+            ('question-export', 'question-export', 'get', {}, {}, self.admin),
+            ('question-export?format=csv', 'question-export', 'get', {}, {'format': 'csv'}, self.admin),
+            ('answer-export', 'answer-export', 'get', {}, {}, self.admin),
+            ('question-answers-export', 'question-answers-export', 'get', {'question_pk': self.question.id}, {},
+             self.admin),
+            ('tag-questions-export', 'tag-questions-export', 'get', tag, {}, self.admin),
+        ]
+
+    def request(self, route, method, kwargs, data, user, i):
+        self.client.force_authenticate(None)
+        self.client.credentials()
+        if user == 'token':
+            self.client.credentials(HTTP_AUTHORIZATION='Token ' + AuthToken.objects.create(self.user))
+        elif user is not None:
+            self.client.force_authenticate(user)
+        url = route if route.startswith('/') else reverse(route, kwargs=kwargs)
+        data = data(i) if callable(data) else data
+        return lambda: getattr(self.client, method)(url, data=data, format=None if method == 'get' else 'json')
+
+    def measure(self, route, method, kwargs, data, user, repeat=PERF_REPEAT):
+        timings, queries, sql = [], [], []
+
+        def timer(execute, sql_text, params, many, context):
+            started = time.perf_counter()
+            try:
+                return execute(sql_text, params, many, context)
+            finally:
+                request_sql.append(time.perf_counter() - started)
+
+        # первый запрос - прогрев (импорты, кеши Django), в замеры не идет
+        for i in range(repeat + 1):
+            cache.clear()
+            send = self.request(route, method, kwargs, data, user, i)
+            request_sql = []
+            gc.collect()
+            with connection.execute_wrapper(timer):
+                started = time.perf_counter()
+                response = send()
+                if response.streaming:
+                    b''.join(response.streaming_content)
+                elapsed = time.perf_counter() - started
+            self.assertLess(response.status_code, 400, f'{route}: {response.status_code}')
+            if i:
+                timings.append(elapsed)
+                queries.append(len(request_sql))
+                sql.append(sum(request_sql))
+        return {
+            'queries': max(queries),
+            'sql_ms': round(statistics.median(sql) * 1000, 2),
+            'p50_ms': round(percentile(timings, 0.5) * 1000, 2),
+            'p95_ms': round(percentile(timings, 0.95) * 1000, 2),
+        }
+
+    @staticmethod
+    def time_budget(baseline):
+        return max(baseline * PERF_TOLERANCE, baseline + PERF_SLACK_MS)
+
+    def test_routes_covered(self):
+        """
+        Новый маршрут без бюджета - ошибка
+        """
+        covered = {route for _, route, *_ in self.endpoints()}
+        self.assertEqual(set(), registered_routes() - covered)
+
+    def baseline(self, same_data=False):
+        """
+        Бюджеты из perf_baseline.json; same_data - снятые на других данных не сравниваются (время)
+        """
+        with open(PERF_BASELINE) as f:
+            baseline = json.load(f)
+        data = {'data': self.counts, 'seed': PERF_SEED}
+        recorded = {'data': baseline['data'], 'seed': baseline.get('seed')}
+        if same_data and data != recorded:
+            self.skipTest(f'базовая линия снята на {recorded}, а данные теста - {data}')
+        return baseline['endpoints']
+
+    def test_queries(self):
+        """
+        Число запросов не зависит ни от времени, ни от объема данных - проверяется всегда, по одному замеру
+        """
+        baseline = self.baseline()
+        failures = []
+        for label, route, method, kwargs, data, user in self.endpoints():
+            if label not in baseline:
+                failures.append(f'{label}: нет в базовой линии')
+                continue
+            queries = self.measure(route, method, kwargs, data, user, repeat=1)['queries']
+            if queries > baseline[label]['queries']:
+                failures.append(f"{label}: запросов {queries} > {baseline[label]['queries']}")
+        self.assertEqual([], failures)
+
+    @skipUnless(os.environ.get('PERF_TIMINGS') or os.environ.get('PERF_UPDATE_BASELINE'),
+                'время ответа проверяется только с PERF_TIMINGS=1')
+    def test_budgets(self):
+        measured = {label: self.measure(*spec) for label, *spec in self.endpoints()}
+        if os.environ.get('PERF_UPDATE_BASELINE'):
+            with open(PERF_BASELINE, 'w') as f:
+                json.dump({'data': self.counts, 'seed': PERF_SEED, 'repeat': PERF_REPEAT, 'endpoints': measured},
+                          f, ensure_ascii=False, indent=2, sort_keys=True)
+                f.write('\n')
+            return
+
+        baseline = self.baseline(same_data=True)
+        failures = []
+        for label, result in measured.items():
+            if label not in baseline:
+                failures.append(f'{label}: нет в базовой линии')
+                continue
+            expected = baseline[label]
+            for metric in ('sql_ms', 'p50_ms', 'p95_ms'):
+                budget = self.time_budget(expected[metric])
+                if result[metric] > budget:
+                    failures.append(f'{label}: {metric} {result[metric]} > {budget:.2f}')
+        self.assertEqual([], failures)
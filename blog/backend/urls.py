@@ -22,5 +22,8 @@ urlpatterns = [
     path('', include(question_router.urls)),
     path('', include(tag_router.urls)),
     path('users/<int:pk>/profile/', views.ProfileView.as_view(), name='user-profile'),
-    path('users/', views.UserListView.as_view(), name='user-list')
+    path('users/', views.UserListView.as_view(), name='user-list'),
+    path('users/<int:author_pk>/questions/', views.QuestionViewSet.as_view({'get': 'list'}), name='user-questions-list'),
+    path('users/<int:author_pk>/answers/', views.AnswerViewSet.as_view({'get': 'list'}), name='user-answers-list'),
+    path('metrics', views.MetricsView.as_view(), name='metrics'),
 ]
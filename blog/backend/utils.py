@@ -0,0 +1,12 @@
+def chunked(iterable, size):
+    """
+    Списки по size элементов из iterable, последний - сколько осталось
+    """
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
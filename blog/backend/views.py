@@ -1,20 +1,63 @@
+import hashlib
+from calendar import timegm
+from datetime import datetime, time
+
 from django.contrib.auth import login, user_logged_out, logout
+from django.db.models import QuerySet
+from django.http import StreamingHttpResponse
+from django.utils import timezone
+from django.utils.cache import get_conditional_response
+from django.utils.dateparse import parse_date, parse_datetime
+from django.utils.http import http_date, quote_etag
 from knox.auth import TokenAuthentication
 from knox.models import AuthToken
 from knox.views import LoginView as KnoxLoginView
 from rest_framework.authtoken.serializers import AuthTokenSerializer
-from rest_framework.pagination import CursorPagination
 from rest_framework.permissions import IsAuthenticated, IsAuthenticatedOrReadOnly, IsAdminUser, AllowAny
 from rest_framework import generics, viewsets, permissions, status, mixins
 from rest_framework.decorators import action, api_view
+from rest_framework.exceptions import ValidationError
 from rest_framework.response import Response
 from rest_framework.reverse import reverse as rest_reverse
 from rest_framework.views import APIView
 
+from backend import autocomplete, leaderboard, metrics
+from backend.cache import object_cache, page_cache, plain
+from backend.managers import InvalidSort
 from backend.models import Question, User, Answer, Tag, Like
 from backend.permissions import IsQuestionOwner, IsUserOwner
+from backend.plans import QueryPlanMixin
+from backend.readers import QuestionReadSerializer, AnswerReadSerializer, TagReadSerializer
+from backend.renderers import PrometheusRenderer, NDJSONRenderer, CSVRenderer
 from backend.serializers import QuestionSerializer, UserSerializer, AnswerSerializer, TagSerializer, ProfileSerializer, \
     LoginUserSerializer, CreateUserSerializer
+from backend.utils import chunked
+
+
+MAX_LIMIT = 100
+
+
+def get_limit(request):
+    limit = request.GET.get('limit')
+    if limit is None:
+        return None
+    try:
+        limit = int(limit)
+    except ValueError:
+        raise ValidationError({'limit': 'Ожидается целое число.'})
+    if not 0 < limit <= MAX_LIMIT:
+        raise ValidationError({'limit': f'Допустимо от 1 до {MAX_LIMIT}.'})
+    return limit
+
+
+def sorted_queryset(sort, *args):
+    """
+    Сортировка через менеджер, недопустимый ключ - 400
+    """
+    try:
+        return sort(*args)
+    except InvalidSort as e:
+        raise ValidationError({'sort': str(e)})
 
 
 @api_view(['GET'])
@@ -72,59 +115,218 @@ class LogoutView(APIView):
         return Response(None, status=status.HTTP_204_NO_CONTENT)
 
 
-class QuestionViewSet(viewsets.ModelViewSet):
-    permission_classes = (IsAuthenticatedOrReadOnly,)
-    queryset = Question.objects.prefetch_related('tags', 'author')
-    serializer_class = QuestionSerializer
-    pagination_class = CursorPagination
+class ConditionalGetMixin:
+    """
+    ETag и Last-Modified по версии вопроса (рейтинг, число ответов, modified):
+    If-None-Match/If-Modified-Since отвечаются 304 одним маленьким запросом,
+    без загрузки тегов, автора и сериализации
+    """
+    def get_conditional_question_id(self):
+        return None
+
+    def conditional(self, request, respond):
+        question_id = self.get_conditional_question_id()
+        version = None
+        if question_id is not None and str(question_id).isdigit():
+            version = Question.objects.filter(pk=question_id).values_list(
+                'rating', 'count_answers', 'modified').order_by().first()
+        if version is None:
+            return respond()
+        rating, count_answers, modified = version
+        tag = f'{question_id}:{rating}:{count_answers}:{modified.isoformat()}:' \
+              f'{request.accepted_renderer.format}:{request.build_absolute_uri()}'
+        etag = quote_etag(hashlib.md5(tag.encode('utf-8')).hexdigest())
+        last_modified = timegm(modified.utctimetuple())
+        response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+        if response is None:
+            response = respond()
+        if response.status_code in (status.HTTP_200_OK, status.HTTP_304_NOT_MODIFIED):
+            response['ETag'] = etag
+            response['Last-Modified'] = http_date(last_modified)
+        return response
+
+    def retrieve(self, request, *args, **kwargs):
+        return self.conditional(request, lambda: super(ConditionalGetMixin, self).retrieve(request, *args, **kwargs))
+
+    def list(self, request, *args, **kwargs):
+        return self.conditional(request, lambda: super(ConditionalGetMixin, self).list(request, *args, **kwargs))
+
+
+class CachedRetrieveMixin:
+    """
+    Деталка объекта из кеша сериализованных представлений (backend.cache)
+    """
+    def retrieve(self, request, *args, **kwargs):
+        if set(kwargs) != {self.lookup_field}:
+            # вложенный маршрут проверяет родителя запросом - не кешируем
+            return super().retrieve(request, *args, **kwargs)
+        model = self.queryset.model
+        key = object_cache.key(model, kwargs[self.lookup_field], request.build_absolute_uri('/'))
+        data = object_cache.get(key)
+        if data is not None:
+            return Response(data, headers={'X-Cache': 'HIT'})
+        response = super().retrieve(request, *args, **kwargs)
+        object_cache.set(key, plain(response.data))
+        response['X-Cache'] = 'MISS'
+        return response
+
+
+class CachedListMixin:
+    """
+    Страницы списков для анонимов из кеша, page_collections - от каких коллекций зависят
+    """
+    page_collections = ()
+
+    def list(self, request, *args, **kwargs):
+        if request.user.is_authenticated or not self.page_collections:
+            return super().list(request, *args, **kwargs)
+        build = super().list
+        data, state = page_cache.get_or_build(
+            page_cache.key(request.build_absolute_uri()),
+            self.page_collections,
+            lambda: plain(build(request, *args, **kwargs).data),
+        )
+        return Response(data, headers={'X-Cache': state})
+
+
+class ReadSerializerMixin:
+    """
+    Список через легкий сериализатор строк .values() (backend.readers), если он задан
+    """
+    read_serializer_class = None
+
+    def list(self, request, *args, **kwargs):
+        queryset = self.filter_queryset(self.get_queryset())
+        reader = None
+        if self.read_serializer_class is not None and isinstance(queryset, QuerySet):
+            reader = self.read_serializer_class(context=self.get_serializer_context())
+            queryset = reader.values(queryset)
+
+        page = self.paginate_queryset(queryset)
+        rows = queryset if page is None else page
+        data = reader.represent(rows) if reader is not None else self.get_serializer(rows, many=True).data
+        return Response(data) if page is None else self.get_paginated_response(data)
+
+
+class ExportMixin:
+    """
+    Выгрузка всего списка потоком для интеграций, только админам: NDJSON (по умолчанию)
+    или CSV (?format=csv), поля - как у read_serializer_class, ?since= - созданные не раньше
+    """
+    export_chunk_size = 500
+
+    def get_export_queryset(self):
+        queryset = self.get_queryset().order_by('created', 'id')
+        since = self.request.query_params.get('since')
+        if since:
+            parsed = parse_datetime(since)
+            if parsed is None:
+                date = parse_date(since)
+                parsed = datetime.combine(date, time.min) if date is not None else None
+            if parsed is None:
+                raise ValidationError({'since': 'Ожидается дата или дата и время в ISO 8601.'})
+            if timezone.is_naive(parsed):
+                parsed = timezone.make_aware(parsed)
+            queryset = queryset.filter(created__gte=parsed)
+        return queryset
 
-    def perform_create(self, serializer):
-        serializer.save(author=self.request.user)
+    @action(detail=False, permission_classes=(IsAdminUser,), renderer_classes=(NDJSONRenderer, CSVRenderer))
+    def export(self, request, *args, **kwargs):
+        reader = self.read_serializer_class(context=self.get_serializer_context())
+        rows = reader.values(self.get_export_queryset()).iterator(chunk_size=self.export_chunk_size)
+        items = (item for chunk in chunked(rows, self.export_chunk_size) for item in reader.represent(chunk))
+        renderer = request.accepted_renderer
+        fields = [name for name, _ in reader.fields]
+        response = StreamingHttpResponse(
+            renderer.stream(items, self.export_chunk_size, fields),
+            content_type=renderer.media_type if renderer.charset is None
+            else f'{renderer.media_type}; charset={renderer.charset}',
+        )
+        response['Content-Disposition'] = f'attachment; filename="{self.basename}.{renderer.format}"'
+        return response
 
-    def create(self, request, *args, **kwargs):
-        serializer = self.get_serializer(data=request.data)
 
-        tags = serializer.initial_data.get('tags', [])
-        for name_tag in tags:
-            Tag.objects.get_or_create(name=name_tag)
+class LikeMixin:
+    """
+    Лайк объекта: по умолчанию отдает {liked, rating}, с ?full=1 - объект целиком
+    """
+    def is_full_like(self):
+        return self.request.query_params.get('full', '').lower() in ('1', 'true', 'yes')
 
-        serializer.is_valid(raise_exception=True)
-        self.perform_create(serializer)
-        headers = self.get_success_headers(serializer.data)
-        return Response(serializer.data, status=status.HTTP_201_CREATED, headers=headers)
+    def is_compact_like(self):
+        return getattr(self, 'action', None) == 'set_like' and not self.is_full_like()
+
+    def get_query_plan(self):
+        # короткому ответу нужен только id - без join и prefetch плана
+        return None if self.is_compact_like() else super().get_query_plan()
 
     @action(detail=True, methods=['put'], permission_classes=(IsAuthenticated,))
-    def set_like(self, *args, **kwargs):
-        user = self.request.user
-        question = self.get_object()
-        Like.set_like(question, user)
-        return Response(
-            QuestionSerializer(self.get_object(), context=self.get_serializer_context()).data,
-            status=status.HTTP_200_OK
-        )
+    def set_like(self, request, *args, **kwargs):
+        obj = self.get_object()
+        liked, rating = Like.set_like(obj, request.user)
+        if self.is_full_like():
+            obj.rating = rating
+            return Response(self.get_serializer(obj).data, status=status.HTTP_200_OK)
+        return Response({'liked': liked, 'rating': rating}, status=status.HTTP_200_OK)
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        if self.is_compact_like():
+            # фильтры вложенных маршрутов (question_pk, tag_pk) остаются
+            return queryset.only('id')
+        return queryset
+
+
+class QuestionViewSet(ConditionalGetMixin, CachedListMixin, CachedRetrieveMixin, LikeMixin, ExportMixin,
+                      QueryPlanMixin, ReadSerializerMixin, viewsets.ModelViewSet):
+    permission_classes = (IsAuthenticatedOrReadOnly,)
+    queryset = Question.objects.all()
+    serializer_class = QuestionSerializer
+    read_serializer_class = QuestionReadSerializer
+    page_collections = ('questions',)
+
+    def perform_create(self, serializer):
+        serializer.save(author=self.request.user)
 
     def get_queryset(self):
         sort_by = self.request.GET.get('sort')
         queryset = super().get_queryset()
-        if sort_by:
-            return queryset.hot_questions(sort_by)
         tag_pk = self.kwargs.get('tag_pk')
         if tag_pk:
-            return queryset.filter(tags__id=tag_pk)
+            queryset = queryset.filter(tags__id=tag_pk)
+        author_pk = self.kwargs.get('author_pk')
+        if author_pk:
+            queryset = queryset.filter(author_id=author_pk)
+        if sort_by:
+            return sorted_queryset(queryset.hot_questions, sort_by)
         return queryset
 
+    def get_conditional_question_id(self):
+        if self.action == 'retrieve' and 'tag_pk' not in self.kwargs:
+            return self.kwargs.get('pk')
+        return None
+
+    def get_counter(self):
+        tag_pk = self.kwargs.get('tag_pk')
+        if tag_pk:
+            return Tag.objects.filter(pk=tag_pk).values_list('rating', flat=True).first() or 0
+        return None
+
 
-class UserListView(generics.ListAPIView):
+class UserListView(CachedListMixin, QueryPlanMixin, generics.ListAPIView):
     serializer_class = UserSerializer
     queryset = User.objects.all()
     permission_classes = (IsAuthenticatedOrReadOnly,)
+    page_collections = ('users',)
 
     def get_queryset(self):
         sort_by = self.request.GET.get('sort')
         queryset = super().get_queryset()
-        limit = self.request.GET.get('limit')
+        limit = get_limit(self.request)
         if sort_by and limit:
-            return User.objects.top_users(sort_by, int(limit))
+            if sort_by == 'rating':
+                return leaderboard.users.top(limit)
+            return sorted_queryset(User.objects.top_users, sort_by, limit)
         return queryset
 
 
@@ -134,25 +336,18 @@ class ProfileView(generics.RetrieveUpdateAPIView):
     permission_classes = (IsUserOwner|IsAdminUser,)
 
 
-class AnswerViewSet(viewsets.ModelViewSet):
-    queryset = Answer.objects.prefetch_related('author')
+class AnswerViewSet(ConditionalGetMixin, CachedListMixin, CachedRetrieveMixin, LikeMixin, ExportMixin,
+                    QueryPlanMixin, ReadSerializerMixin, viewsets.ModelViewSet):
+    queryset = Answer.objects.all()
     serializer_class = AnswerSerializer
+    read_serializer_class = AnswerReadSerializer
     permission_classes = (IsAuthenticatedOrReadOnly,)
+    page_collections = ('answers',)
 
     def perform_create(self, serializer):
         question_id = self.kwargs.get('question_pk')
         serializer.save(author=self.request.user, question_id=question_id)
 
-    @action(detail=True, methods=['put'], permission_classes=(IsAuthenticated,))
-    def set_like(self,  *args, **kwargs):
-        user = self.request.user
-        answer = self.get_object()
-        Like.set_like(answer, user)
-        return Response(
-            AnswerSerializer(self.get_object(), context=self.get_serializer_context()).data,
-            status=status.HTTP_200_OK
-        )
-
     @action(detail=True, methods=['put'], permission_classes=(IsQuestionOwner|IsAdminUser,))
     def mark_as_right(self,  *args, **kwargs):
         answer = self.get_object()
@@ -168,18 +363,61 @@ class AnswerViewSet(viewsets.ModelViewSet):
         queryset = super().get_queryset()
         if question_id:
             return queryset.filter(question_id=question_id)
+        author_pk = self.kwargs.get('author_pk')
+        if author_pk:
+            return queryset.filter(author_id=author_pk)
         return queryset
 
+    def get_conditional_question_id(self):
+        if self.action == 'list':
+            return self.kwargs.get('question_pk')
+        return None
+
+    def get_counter(self):
+        question_id = self.kwargs.get('question_pk')
+        if question_id:
+            return Question.objects.filter(pk=question_id).values_list('count_answers', flat=True).first() or 0
+        return None
+
 
-class TagViewSet(viewsets.GenericViewSet, mixins.ListModelMixin, mixins.RetrieveModelMixin):
+class TagViewSet(CachedListMixin, QueryPlanMixin, ReadSerializerMixin, viewsets.GenericViewSet,
+                 mixins.ListModelMixin, mixins.RetrieveModelMixin):
     queryset = Tag.objects.all()
     serializer_class = TagSerializer
+    read_serializer_class = TagReadSerializer
     permission_classes = (IsAuthenticatedOrReadOnly,)
+    page_collections = ('tags',)
 
     def get_queryset(self):
         sort_by = self.request.GET.get('sort')
-        limit = self.request.GET.get('limit')
+        limit = get_limit(self.request)
         queryset = super().get_queryset()
         if sort_by and limit:
-            return queryset.top_tags(sort_by, int(limit))
+            if sort_by == 'rating':
+                return leaderboard.tags.top(limit)
+            return sorted_queryset(queryset.top_tags, sort_by, limit)
         return queryset
+
+    @action(detail=False)
+    def autocomplete(self, request, *args, **kwargs):
+        """
+        Теги, начинающиеся с ?q= (без учета регистра), по убыванию рейтинга; из индекса процесса, без базы
+        """
+        prefix = request.query_params.get('q', '').strip()
+        if not prefix:
+            return Response([])
+        limit = get_limit(request) or autocomplete.AUTOCOMPLETE_LIMIT
+        return Response([
+            {'name': name, 'rating': rating} for name, _, rating in autocomplete.tags.search(prefix, limit)
+        ])
+
+
+class MetricsView(APIView):
+    """
+    Метрики процесса для Prometheus (backend.metrics), только для админов
+    """
+    permission_classes = (IsAdminUser,)
+    renderer_classes = (PrometheusRenderer,)
+
+    def get(self, request, format=None):
+        return Response(metrics.registry.render())
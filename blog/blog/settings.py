@@ -45,6 +45,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'backend.middleware.ProfilingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -82,6 +83,17 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
+        'TEST': {
+            # файловая база, чтобы потоки в тестах видели одни данные и ждали блокировок
+            'NAME': os.path.join(BASE_DIR, 'test_db.sqlite3'),
+        },
+    }
+}
+
+# Кеш сериализованных объектов, лидербордов и счетчиков; в проде - memcached/redis
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
     }
 }
 
@@ -143,9 +155,15 @@ LOGGING = {
     },
     'loggers': {
         # ...
+        'backend.querylog': {
+            'handlers': ['console'],
+            'level': 'WARNING',
+            'propagate': False,
+        },
         'django.db': {
             'handlers': ['console'],
-            'level': 'DEBUG',  # <----<<<
+            # DJANGO_DB_LOG_LEVEL=DEBUG - печатать каждый SQL-запрос; профиль запросов - /metrics
+            'level': os.environ.get('DJANGO_DB_LOG_LEVEL', 'INFO'),
             'propagate': False,
         }
     }
@@ -157,11 +175,39 @@ REST_FRAMEWORK = {
         'rest_framework.authentication.SessionAuthentication', # DEBUG only
         'rest_framework.authentication.BasicAuthentication', # DEBUG only
     ),
-    # 'DEFAULT_PAGINATION_CLASS': 'rest_framework.pagination.CursorPagination',
-    'DEFAULT_PAGINATION_CLASS': 'rest_framework.pagination.LimitOffsetPagination',
+    'DEFAULT_RENDERER_CLASSES': (
+        'backend.renderers.FastJSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ),
+    'DEFAULT_PARSER_CLASSES': (
+        'backend.parsers.FastJSONParser',
+        'rest_framework.parsers.FormParser',
+        'rest_framework.parsers.MultiPartParser',
+    ),
+    'DEFAULT_PAGINATION_CLASS': 'backend.pagination.KeysetPagination',
     'PAGE_SIZE': 10,
 }
 
+# быстрые библиотеки JSON по порядку предпочтения, без них - стандартный json
+JSON_BACKENDS = ('orjson', 'ujson')
+
+RATING_BUFFER = {
+    'STORE': 'backend.rating.LocMemRatingStore',
+    # 'STORE': 'backend.rating.RedisRatingStore',
+    # 'OPTIONS': {'url': 'redis://localhost:6379/0'},
+    # 'buffered' - копить лайки и сбрасывать раз в FLUSH_INTERVAL секунд; сброс проверяется при
+    # следующем лайке, поэтому с Redis нужен еще cron: manage.py flush_ratings раз в FLUSH_INTERVAL
+    'DURABILITY': 'sync',
+    'FLUSH_INTERVAL': 5,
+}
+
+PROFILING = {
+    'ENABLED': True,
+    'SAMPLE_RATE': 0.1,  # доля запросов с замером SQL и времени
+    'SLOW_QUERY_MS': 100,
+    'REPEAT_THRESHOLD': 5,
+}
+
 REST_KNOX = {
   'SECURE_HASH_ALGORITHM':  'cryptography.hazmat.primitives.hashes.SHA512',
   'AUTH_TOKEN_CHARACTER_LENGTH': 64,